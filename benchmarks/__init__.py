@@ -0,0 +1,9 @@
+"""Benchmarks for WsgiService. They are not part of the distribution.
+
+Run a benchmark as a module from the repository root, for example::
+
+    python -m benchmarks.process_pool
+
+``python -m benchmarks`` runs the microbenchmarks of the components which
+handle every request, see :mod:`benchmarks.components`.
+"""
@@ -0,0 +1,9 @@
+"""Runs the microbenchmarks of :mod:`benchmarks.components`::
+
+    python -m benchmarks --help
+"""
+import sys
+
+from benchmarks.components import main
+
+sys.exit(main())
@@ -0,0 +1,394 @@
+"""Microbenchmarks of the components which handle every request.
+
+Measures in isolation:
+
+    - ``router``: :class:`wsgiservice.routing.Router` with 10, 100 and 1000
+      routes, for the first and the last route and a path which doesn't
+      match.
+    - ``call_method``: :func:`wsgiservice.Resource.call_method` for methods
+      with 0, 2, 5 and 10 validated parameters.
+    - ``negotiation``: :func:`wsgiservice.Resource.get_content_type` with an
+      extension and with the Accept headers of browsers and API clients.
+    - ``serialize``: The JSON and XML serializers of the resources for
+      payloads of different shapes.
+    - ``content_md5``: :func:`wsgiservice.Resource.set_response_content_md5`
+      for small and large bodies.
+
+And end to end through :func:`wsgiservice.application.Application.__call__`
+with synthetic WSGI environments (``app``).
+
+Each benchmark is run in batches that take at least ``--min-time`` seconds.
+The minimum, median and maximum time per call over ``--repeat`` batches are
+printed as JSON. With ``--compare`` the results are compared to a baseline
+saved from an earlier run. Benchmarks that are slower than the baseline by
+more than ``--threshold`` are flagged, and the exit status is 1.
+
+Usage::
+
+    python -m benchmarks [--filter router] [--repeat 5] [--min-time 0.1]
+                         [--output results.json] [--compare baseline.json]
+                         [--threshold 0.1]
+"""
+import argparse
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+
+import webob
+
+import wsgiservice
+from wsgiservice import xmlserializer
+from wsgiservice.routing import Router
+
+#: Registered benchmarks as a list of tuples of the name and a function
+#: returning the function to measure.
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Decorator registering a function which prepares a benchmark and
+    returns the function to measure."""
+    def wrap(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return wrap
+
+
+def get_resources(count):
+    """Returns a list of resource classes mounted at ``/resource<i>/{id}``.
+    """
+    resources = []
+    for i in range(count):
+        resource = type('Resource{0}'.format(i), (wsgiservice.Resource,), {})
+        resources.append(wsgiservice.mount(
+            '/resource{0}/{{id}}'.format(i))(resource))
+    return resources
+
+
+def add_router_benchmarks():
+    """Registers the routing benchmarks for each table size."""
+    for size in (10, 100, 1000):
+        for position in ('first', 'last', 'miss'):
+            benchmark('router.{0}[routes={1}]'.format(position, size))(
+                _get_router_setup(size, position))
+
+
+def _get_router_setup(size, position):
+    def setup():
+        router = Router(get_resources(size))
+        path = {'first': router._routes[0][1]._path,
+                'last': router._routes[-1][1]._path,
+                'miss': '/missing/{id}'}[position].replace('{id}', '42')
+        return lambda: router(path)
+    return setup
+
+
+def add_call_method_benchmarks():
+    """Registers the benchmarks of call_method for each number of
+    parameters."""
+    for count in (0, 2, 5, 10):
+        benchmark('call_method[params={0}]'.format(count))(
+            _get_call_method_setup(count))
+
+
+def _get_call_method_setup(count):
+    def setup():
+        names = ['p{0}'.format(i) for i in range(count)]
+        namespace = {}
+        exec('def GET(self{0}):\n    return None\n'.format(
+            ''.join(', ' + name for name in names)), namespace)
+        method = namespace['GET']
+        for name in names:
+            method = wsgiservice.validate(name, re='[0-9]+', convert=int)(
+                method)
+        resource = type('Params', (wsgiservice.Resource,), {'GET': method})
+        query = '&'.join('{0}={1}'.format(name, i)
+                         for i, name in enumerate(names))
+        instance = resource(request=webob.Request.blank('/?' + query),
+                            response=webob.Response(), path_params={})
+
+        def run():
+            instance._data = None
+            instance.call_method('GET')
+        return run
+    return setup
+
+
+ACCEPT_HEADERS = [
+    ('extension', None),
+    ('browser', 'text/html,application/xhtml+xml,application/xml;q=0.9,'
+                'image/avif,image/webp,*/*;q=0.8'),
+    ('json', 'application/json'),
+    ('any', '*/*'),
+    ('weighted', 'application/json;q=0.5, text/xml;q=0.9, text/plain;q=0.1'),
+]
+
+
+def add_negotiation_benchmarks():
+    """Registers the content negotiation benchmarks for each Accept
+    header."""
+    for name, accept in ACCEPT_HEADERS:
+        benchmark('negotiation[{0}]'.format(name))(
+            _get_negotiation_setup(accept))
+
+
+def _get_negotiation_setup(accept):
+    def setup():
+        if accept is None:
+            request = webob.Request.blank('/document.json')
+            path_params = {'_extension': '.json'}
+        else:
+            request = webob.Request.blank('/document',
+                                          headers={'Accept': accept})
+            path_params = {}
+        instance = wsgiservice.Resource(request=request,
+                                        response=webob.Response(),
+                                        path_params=path_params)
+
+        def run():
+            instance.response.vary = None
+            instance.get_content_type()
+        return run
+    return setup
+
+
+PAYLOADS = [
+    ('flat', dict(('key{0}'.format(i), 'value {0}'.format(i))
+                  for i in range(10))),
+    ('nested', {'a': {'b': {'c': {'d': {'e': [1, 2, {'f': 'g'}]}}}}}),
+    ('list', [{'id': i, 'name': 'Item {0}'.format(i), 'price': i * 1.5,
+               'tags': ['a', 'b']} for i in range(100)]),
+    ('text', {'text': 'Lorem ipsum dolor sit amet & <more>. ' * 1000}),
+]
+
+
+def add_serialize_benchmarks():
+    """Registers the serialization benchmarks for each payload and
+    format."""
+    for name, payload in PAYLOADS:
+        benchmark('serialize.json[{0}]'.format(name))(
+            _get_serialize_setup(payload, 'to_application_json'))
+        benchmark('serialize.xml[{0}]'.format(name))(
+            _get_serialize_setup(payload, 'to_text_xml'))
+    benchmark('xmlserializer.dumps[list]')(
+        lambda: lambda: xmlserializer.dumps(PAYLOADS[2][1], 'response'))
+
+
+def _get_serialize_setup(payload, method):
+    def setup():
+        instance = wsgiservice.Resource(request=webob.Request.blank('/'),
+                                        response=webob.Response(),
+                                        path_params={})
+        convert = getattr(instance, method)
+        return lambda: convert(payload)
+    return setup
+
+
+def add_content_md5_benchmarks():
+    """Registers the Content-MD5 benchmarks for each body size."""
+    for size in (1000, 100000):
+        benchmark('content_md5[bytes={0}]'.format(size))(
+            _get_content_md5_setup(size))
+
+
+def _get_content_md5_setup(size):
+    def setup():
+        instance = wsgiservice.Resource(request=webob.Request.blank('/'),
+                                        response=webob.Response(),
+                                        path_params={})
+        instance.response.body = b'x' * size
+        return instance.set_response_content_md5
+    return setup
+
+
+@wsgiservice.mount('/documents/{id}')
+class Document(wsgiservice.Resource):
+    """Resource of the end to end benchmarks."""
+    NOT_FOUND = (KeyError,)
+
+    @wsgiservice.validate('id', re='[0-9]+', convert=int)
+    def GET(self, id):
+        if id == 0:
+            raise KeyError(id)
+        return {'id': id, 'title': 'Document {0}'.format(id),
+                'tags': ['a', 'b', 'c']}
+
+    def get_etag(self, id):
+        return 'document-{0}'.format(id)
+
+
+APP_REQUESTS = [
+    ('json', '/documents/1', {'HTTP_ACCEPT': 'application/json'}),
+    ('xml', '/documents/1', {'HTTP_ACCEPT': 'text/xml'}),
+    ('not_modified', '/documents/1',
+     {'HTTP_ACCEPT': 'application/json',
+      'HTTP_IF_NONE_MATCH': '"document-1"'}),
+    ('not_found', '/documents/0', {}),
+    ('no_route', '/missing', {}),
+]
+
+
+def add_app_benchmarks():
+    """Registers the end to end benchmarks for each request."""
+    for name, path, headers in APP_REQUESTS:
+        benchmark('app[{0}]'.format(name))(_get_app_setup(path, headers))
+
+
+def _get_app_setup(path, headers):
+    def setup():
+        app = wsgiservice.get_app({'Document': Document}, add_help=False)
+        environ = {
+            'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '', 'PATH_INFO': path,
+            'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.url_scheme': 'http', 'wsgi.version': (1, 0),
+            'wsgi.errors': sys.stderr, 'wsgi.multithread': False,
+            'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        }
+        environ.update(headers)
+
+        def start_response(status, headerlist, exc_info=None):
+            pass
+
+        def run():
+            env = dict(environ)
+            env['wsgi.input'] = io.BytesIO()
+            b''.join(app(env, start_response))
+        return run
+    return setup
+
+
+add_router_benchmarks()
+add_call_method_benchmarks()
+add_negotiation_benchmarks()
+add_serialize_benchmarks()
+add_content_md5_benchmarks()
+add_app_benchmarks()
+
+
+def measure(func, repeat=5, min_time=0.1):
+    """Returns a dictionary with the ``min``, ``median`` and ``max`` time
+    per call in seconds over `repeat` batches, and the ``number`` of calls
+    per batch. The batch size is chosen so a batch takes at least `min_time`
+    seconds."""
+    number = 1
+    while True:
+        elapsed = _time(func, number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    times = [elapsed / number]
+    for i in range(repeat - 1):
+        times.append(_time(func, number) / number)
+    return {'min': min(times), 'median': statistics.median(times),
+            'max': max(times), 'number': number}
+
+
+def _time(func, number):
+    """Returns the time in seconds it takes to call func number times."""
+    loop = range(number)
+    start = time.perf_counter()
+    for i in loop:
+        func()
+    return time.perf_counter() - start
+
+
+def run(names=None, repeat=5, min_time=0.1, log=None):
+    """Runs the benchmarks and returns the results as a dictionary with the
+    environment and the measurements of each benchmark.
+
+    :param names: Only run the benchmarks whose names contain one of these
+                  strings. None runs all of them.
+    :type names: list
+    :param log: File to print the progress to.
+    :type log: file
+    """
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and not [part for part in names if part in name]:
+            continue
+        results[name] = measure(setup(), repeat=repeat, min_time=min_time)
+        if log is not None:
+            log.write('{0:<40} {1:>12}\n'.format(
+                name, _format_time(results[name]['min'])))
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'wsgiservice': getattr(wsgiservice, '__version__', None),
+            'benchmarks': results}
+
+
+def compare(results, baseline, threshold=0.1):
+    """Compares the minimum times of the results to the baseline. Returns a
+    list of dictionaries with the ``name``, the ``baseline`` and ``current``
+    times, their ``ratio`` and whether it's a ``regression``: slower than
+    the baseline by more than the `threshold` fraction. Benchmarks missing
+    in either are skipped."""
+    rows = []
+    for name, current in sorted(results['benchmarks'].items()):
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            continue
+        ratio = current['min'] / base['min']
+        rows.append({'name': name, 'baseline': base['min'],
+                     'current': current['min'], 'ratio': ratio,
+                     'regression': ratio > 1 + threshold})
+    return rows
+
+
+def _format_time(seconds):
+    """Formats a duration with a suitable unit."""
+    for unit, factor in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * factor >= 1:
+            return '{0:.2f} {1}'.format(seconds * factor, unit)
+    return '{0:.1f} ns'.format(seconds * 1e9)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description=__doc__.split('\n\n')[0])
+    parser.add_argument('--filter', action='append',
+                        help="Only run benchmarks whose names contain this "
+                             "string. Can be given several times.")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.1)
+    parser.add_argument('--output', help="File to write the JSON to instead "
+                                         "of the standard output.")
+    parser.add_argument('--compare', help="JSON file of an earlier run to "
+                                          "compare to.")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Slowdown which counts as a regression.")
+    parser.add_argument('--list', action='store_true',
+                        help="List the benchmarks and exit.")
+    args = parser.parse_args(argv)
+    if args.list:
+        for name, setup in BENCHMARKS:
+            print(name)
+        return 0
+    results = run(args.filter, repeat=args.repeat, min_time=args.min_time,
+                  log=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    if not args.compare:
+        return 0
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    rows = compare(results, baseline, args.threshold)
+    sys.stderr.write('\n{0:<40} {1:>12} {2:>12} {3:>8}\n'.format(
+        'benchmark', 'baseline', 'current', 'ratio'))
+    for row in rows:
+        sys.stderr.write('{0:<40} {1:>12} {2:>12} {3:>7.2f}x{4}\n'.format(
+            row['name'], _format_time(row['baseline']),
+            _format_time(row['current']), row['ratio'],
+            '  REGRESSION' if row['regression'] else ''))
+    regressions = [row for row in rows if row['regression']]
+    sys.stderr.write('{0} of {1} benchmarks regressed by more than '
+                     '{2:.0%}.\n'.format(len(regressions), len(rows),
+                                         args.threshold))
+    return 1 if regressions else 0
@@ -0,0 +1,103 @@
+"""Throughput of CPU-bound resource methods with and without
+:func:`wsgiservice.decorators.cpu_bound`.
+
+Sends requests from a number of client threads to a resource which hashes
+its input repeatedly. Without the decorator the threads serialize on the
+interpreter lock, so the throughput stays flat. With the decorator it scales
+with the number of worker processes up to the number of CPUs.
+
+Usage::
+
+    python -m benchmarks.process_pool [--requests 200] [--rounds 20000]
+"""
+import argparse
+import hashlib
+import os
+import threading
+import time
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.concurrency import ProcessPool, set_process_pool
+
+
+def digest(data, rounds):
+    value = data.encode()
+    for i in range(int(rounds)):
+        value = hashlib.sha256(value).digest()
+    return value.hex()
+
+
+@wsgiservice.mount('/thread')
+class ThreadResource(wsgiservice.Resource):
+    def GET(self, data, rounds):
+        return digest(data, rounds)
+
+
+@wsgiservice.mount('/process')
+class ProcessResource(wsgiservice.Resource):
+    @wsgiservice.cpu_bound(pool='benchmark')
+    def GET(self, data, rounds):
+        return digest(data, rounds)
+
+
+def run(app, path, requests, clients):
+    """Sends the requests from the given number of client threads. Returns
+    the number of requests per second."""
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            res = app._handle_request(Request.blank(path))
+            assert res.status_int == 200, res
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return requests / (time.time() - start)
+
+
+def get_sizes():
+    """Returns the pool sizes to measure: powers of two up to the number of
+    CPUs."""
+    cpus = os.cpu_count() or 1
+    sizes = []
+    size = 1
+    while size < cpus:
+        sizes.append(size)
+        size *= 2
+    sizes.append(cpus)
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=20000)
+    args = parser.parse_args()
+    app = wsgiservice.get_app(globals())
+    query = '?data=benchmark&rounds={0}'.format(args.rounds)
+    print("{0:<10} {1:>8} {2:>12}".format('mode', 'workers', 'requests/s'))
+    for size in get_sizes():
+        rate = run(app, '/thread' + query, args.requests, size)
+        print("{0:<10} {1:>8} {2:>12.1f}".format('thread', size, rate))
+    for size in get_sizes():
+        pool = ProcessPool('benchmark', size=size, max_queue=size)
+        set_process_pool(pool)
+        pool.start()
+        rate = run(app, '/process' + query, args.requests, size)
+        print("{0:<10} {1:>8} {2:>12.1f}".format('process', size, rate))
+    pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Throughput of one application served from a growing number of threads.
+
+Sends requests from client threads directly to the application, without a
+server, for three kinds of resources:
+
+    - ``cpu``: Pure Python computation. With the interpreter lock the
+      throughput stays flat, on free-threaded builds it scales with the
+      number of cores.
+    - ``framework``: A trivial method with validation, memoization and a
+      bulkhead, so mostly the work WsgiService does per request. Shows the
+      contention on the shared state of the framework.
+    - ``io``: A method which sleeps, standing in for a database call. Scales
+      with the number of threads on all builds.
+
+Prints the requests per second and the speedup over a single thread.
+
+Usage::
+
+    python -m benchmarks.thread_scaling [--requests 2000] [--threads 1,2,4,8]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+from webob import Request
+
+import wsgiservice
+
+
+@wsgiservice.mount('/cpu')
+class CpuResource(wsgiservice.Resource):
+    @wsgiservice.validate('rounds', convert=int)
+    def GET(self, rounds):
+        value = 0
+        for i in range(rounds):
+            value = (value * 31 + i) % 1000003
+        return {'value': value}
+
+
+@wsgiservice.mount('/framework/{id}')
+class FrameworkResource(wsgiservice.Resource):
+    BULKHEAD = 1000
+
+    @wsgiservice.validate('id', re='^[0-9]+$', convert=int)
+    @wsgiservice.memoize()
+    def GET(self, id):
+        return {'id': id}
+
+
+@wsgiservice.mount('/io')
+class IoResource(wsgiservice.Resource):
+    def GET(self):
+        time.sleep(0.001)
+        return {}
+
+
+def run(app, paths, requests, clients):
+    """Sends the requests from the given number of client threads, cycling
+    through the paths. Returns the number of requests per second."""
+    counter = [0]
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                i = counter[0]
+                if i == requests:
+                    return
+                counter[0] += 1
+            res = app._handle_request(Request.blank(paths[i % len(paths)]))
+            assert res.status_int == 200, res
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return requests / (time.time() - start)
+
+
+def get_threads():
+    """Returns the thread counts to measure: powers of two up to twice the
+    number of CPUs."""
+    cpus = os.cpu_count() or 1
+    threads = []
+    count = 1
+    while count <= cpus * 2:
+        threads.append(count)
+        count *= 2
+    return threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=2000)
+    parser.add_argument('--threads', default=None,
+                        help="Comma-separated thread counts.")
+    args = parser.parse_args()
+    if args.threads:
+        threads = [int(t) for t in args.threads.split(',')]
+    else:
+        threads = get_threads()
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)
+    print("Python {0}, {1} CPUs, GIL {2}".format(
+        sys.version.split()[0], os.cpu_count(),
+        'enabled' if is_gil_enabled() else 'disabled'))
+    app = wsgiservice.get_app(globals())
+    workloads = [
+        ('cpu', ['/cpu?rounds={0}'.format(args.rounds)]),
+        ('framework', ['/framework/{0}'.format(i) for i in range(100)]),
+        ('io', ['/io']),
+    ]
+    print("{0:<10} {1:>8} {2:>12} {3:>8}".format(
+        'workload', 'threads', 'requests/s', 'speedup'))
+    for name, paths in workloads:
+        base = None
+        for count in threads:
+            rate = run(app, paths, args.requests, count)
+            if base is None:
+                base = rate
+            print("{0:<10} {1:>8} {2:>12.1f} {3:>7.2f}x".format(
+                name, count, rate, rate / base))
+
+
+if __name__ == '__main__':
+    main()
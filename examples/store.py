@@ -12,6 +12,18 @@ logging.basicConfig(level=logging.DEBUG, stream=sys.stderr)
 
 data = {}
 
+#: Number of lookups in the storage. Each one would be a round trip to the
+#: database in a real service.
+round_trips = 0
+
+
+def get_documents(ids):
+    """Returns a dictionary with all the documents of the given IDs in one
+    round trip."""
+    global round_trips
+    round_trips += 1
+    return dict((id, data[id]) for id in ids if id in data)
+
 
 @mount('/{id}')
 @validate('id', re=r'[-0-9a-zA-Z]{36}', doc='User ID, must be a valid UUID.')
@@ -21,10 +33,16 @@ class Document(Resource):
     restarted.
     """
     NOT_FOUND = (KeyError,)
+    NEGATIVE_CACHE_TTL = 5
 
     def GET(self, id):
         "Return the document indicated by the ID."
-        return data[id]
+        return self.get_loader(Document).load(id)
+
+    def load_many(self, ids):
+        """Batch method for the loader, see
+        :func:`wsgiservice.Resource.get_loader`."""
+        return get_documents(ids)
 
     def PUT(self, id):
         """Overwrite or create the document indicated by the ID. Parameters
@@ -40,6 +58,19 @@ class Document(Resource):
 
 @mount('/')
 class Documents(Resource):
+    def GET(self):
+        """Return all the documents. The loader looks up all the documents
+        in one round trip and the individual calls of Document.GET are
+        served from it. Without it each call would be a separate round
+        trip."""
+        ids = sorted(data)
+        before = round_trips
+        self.get_loader(Document).load_many(ids)
+        retval = [self.get_resource(Document).GET(id) for id in ids]
+        logging.debug("Loaded %d documents in %d round trip(s).", len(ids),
+                      round_trips - before)
+        return retval
+
     def POST(self):
         """Create a new document, assigning a unique ID. Parameters are
         passed in as key/value pairs in the POST data."""
@@ -52,5 +83,5 @@ app = get_app(globals())
 
 if __name__ == '__main__':
     from wsgiref.simple_server import make_server
-    print "Running on port 8001"
+    print("Running on port 8001")
     make_server('', 8001, app).serve_forever()
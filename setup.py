@@ -11,7 +11,7 @@ setup(
     ]),
     url='http://github.com/pneff/wsgiservice/tree/master',
     download_url='http://pypi.python.org/pypi/WsgiService',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     install_requires=[
         'decorator',
         'webob >= 1.2b2',
@@ -22,15 +22,15 @@ setup(
         'mox3',
     ],
     test_suite='nose.collector',
+    python_requires='>=3.7',
     license='BSD',
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Environment :: Web Environment',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Internet :: WWW/HTTP :: WSGI :: Application',
     ]
 )
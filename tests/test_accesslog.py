@@ -0,0 +1,117 @@
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.accesslog import AccessLog
+
+
+def test_access_log():
+    """Requests are logged as JSON lines after the response."""
+    output = io.StringIO()
+    app = wsgiservice.get_app(globals())
+    app.ACCESS_LOG = AccessLog(output, headers=['User-Agent'])
+    app._handle_request(Request.blank('/logged?a=1', headers={
+        'X-Request-Id': 'abc', 'User-Agent': 'test'}))
+    app._handle_request(Request.blank('/logged', method='DELETE'))
+    app.ACCESS_LOG.close()
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    print(records)
+    assert len(records) == 2
+    record = records[0]
+    assert record['method'] == 'GET'
+    assert record['path'] == '/logged'
+    assert record['query'] == 'a=1'
+    assert record['status'] == 200
+    assert record['size'] > 0
+    assert record['latency_ms'] >= 10
+    assert record['resource'] == 'LoggedResource'
+    assert record['request_id'] == 'abc'
+    assert record['headers'] == {'User-Agent': 'test'}
+    assert record['time'].endswith('Z')
+    assert 'sample_rate' not in record
+    assert records[1]['status'] == 405
+    assert app.ACCESS_LOG.get_stats()['written'] == 2
+
+
+def test_sampling():
+    """Only the configured fraction of each status class is logged."""
+    output = io.StringIO()
+    values = iter([0.5, 0.005])
+    log = AccessLog(output, sample_rates={2: 0.01},
+                    random=lambda: next(values))
+    app = wsgiservice.get_app(globals())
+    app.ACCESS_LOG = log
+    for i in range(2):
+        app._handle_request(Request.blank('/logged'))
+    app._handle_request(Request.blank('/missing'))
+    log.flush()
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    print(records)
+    assert [r['status'] for r in records] == [200, 404]
+    assert records[0]['sample_rate'] == 0.01
+    assert log.get_stats() == {'written': 2, 'dropped': 0, 'sampled_out': 1}
+    log.close()
+
+
+def test_dropped():
+    """Records are dropped when the queue is full."""
+    writing = threading.Event()
+    release = threading.Event()
+
+    class BlockingOutput(io.StringIO):
+        def write(self, value):
+            writing.set()
+            release.wait(5)
+            return io.StringIO.write(self, value)
+    log = AccessLog(BlockingOutput(), max_queue=1)
+    app = wsgiservice.get_app(globals())
+    app.ACCESS_LOG = log
+    app._handle_request(Request.blank('/logged'))
+    writing.wait(5)
+    for i in range(2):
+        app._handle_request(Request.blank('/logged'))
+    release.set()
+    log.close()
+    assert log.get_stats() == {'written': 2, 'dropped': 1, 'sampled_out': 0}
+
+
+def test_file():
+    """The log can be written to a file."""
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'access.log')
+        app = wsgiservice.get_app(globals())
+        app.ACCESS_LOG = AccessLog(filename)
+        app._handle_request(Request.blank('/logged'))
+        app.ACCESS_LOG.close()
+        with open(filename) as f:
+            assert json.loads(f.read())['status'] == 200
+    finally:
+        shutil.rmtree(path)
+
+
+def test_log_request_disabled():
+    """The request information is only computed if it's logged."""
+    app = wsgiservice.get_app(globals())
+    logger = logging.getLogger('wsgiservice.application')
+    level = logger.level
+    logger.setLevel(logging.WARNING)
+    try:
+        app._log_request(None)
+    finally:
+        logger.setLevel(level)
+
+
+@wsgiservice.mount('/logged')
+class LoggedResource(wsgiservice.Resource):
+    def GET(self):
+        time.sleep(0.01)
+        return {'logged': True}
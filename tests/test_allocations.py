@@ -0,0 +1,157 @@
+import importlib.util
+import json
+import logging
+import os
+import tracemalloc
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.allocations import (AllocationTracker, assert_budget,
+    measure)
+
+#: Lists allocated by AllocatingResource, kept to retain the memory.
+kept = []
+
+
+def test_tracker():
+    """The peak and retained memory are recorded per resource and method,
+    the lines which retained memory are aggregated."""
+    app = wsgiservice.get_app(globals(), add_allocations=True)
+    app.INTERNAL_TOKEN = 'secret'
+    tracker = app.ALLOCATION_TRACKER
+    tracker.sample_rate = 1.0
+    try:
+        for i in range(2):
+            res = app._handle_request(Request.blank('/allocating'))
+            assert res.status_int == 200
+        stats = tracker.get_stats()
+        print(stats)
+        assert len(stats) == 1
+        row = stats[0]
+        assert (row['resource'], row['method']) == ('AllocatingResource',
+                                                    'GET')
+        assert row['count'] == 2
+        assert row['peak_max'] >= 80000
+        assert row['retained_total'] >= 2 * 80000
+        top = tracker.get_top(1)
+        print(top)
+        assert top[0]['location'] == '{0}:{1}'.format(
+            __file__.replace('.pyc', '.py'),
+            AllocatingResource.GET.__code__.co_firstlineno + 1)
+        assert top[0]['size'] >= 2 * 80000
+        assert not tracemalloc.is_tracing()
+        res = app._handle_request(Request.blank(
+            '/_internal/allocations.json?top=1',
+            headers={'X-Internal-Token': 'secret'}))
+        assert res.status_int == 200
+        data = json.loads(res.body)
+        assert [row['resource'] for row in data['resources']] == [
+            'AllocatingResource']
+        assert data['top'][0]['location'] == top[0]['location']
+        res = app._handle_request(Request.blank('/_internal/allocations'))
+        assert res.status_int == 403
+    finally:
+        del kept[:]
+
+
+def test_tracing_started():
+    """Tracing which was started by someone else keeps running."""
+    tracker = AllocationTracker(sample_rate=1.0)
+    app = wsgiservice.get_app(globals())
+    app.ALLOCATION_TRACKER = tracker
+    tracemalloc.start()
+    try:
+        app._handle_request(Request.blank('/allocating'))
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+        del kept[:]
+    assert tracker.get_stats()[0]['retained_total'] >= 80000
+
+
+def test_busy():
+    """Requests are not measured while another one is, or if they are not
+    sampled."""
+    tracker = AllocationTracker(sample_rate=0.5, random=lambda: 0.9)
+    app = wsgiservice.get_app(globals())
+    app.ALLOCATION_TRACKER = tracker
+    app._handle_request(Request.blank('/allocating'))
+    tracker.sample_rate = 1.0
+    tracker._measuring.acquire()
+    try:
+        app._handle_request(Request.blank('/allocating'))
+    finally:
+        tracker._measuring.release()
+        del kept[:]
+    assert tracker.get_stats() == []
+
+
+def test_budget():
+    """Requests allocating more than their budget fail the assertion."""
+    app = wsgiservice.get_app(globals())
+    result = assert_budget(app, '/small', peak=20000, retained=1000)
+    print(result)
+    try:
+        assert_budget(app, '/small', peak=result['peak'] // 2)
+    except AssertionError as e:
+        print(e)
+        assert str(e).startswith('Request to /small allocated a peak of ')
+    else:
+        assert False, 'Budget not enforced'
+
+
+def test_store_budgets():
+    """Allocation budgets of the requests to the store example. Catches
+    regressions in the request handling, call_method and the
+    serializers. The peaks vary with the Python and WebOb versions, so they
+    are relative to the peak of the cheapest request, a document which
+    doesn't exist. No request retains memory."""
+    store = load_example('store')
+    app = store.app
+    for i in range(10):
+        res = app._handle_request(Request.blank('/', method='POST',
+                                                POST={'key': str(i)}))
+        assert res.status_int == 201
+    path = res.headers['Location']
+    baseline = measure(app, '/' + '0' * 36)['peak']
+    print('baseline', baseline)
+    budgets = [
+        ('/', {}, 4),
+        (path, {}, 3),
+        (path + '.xml', {}, 3),
+        (path, {'method': 'PUT', 'POST': {'key': 'value'}}, 3),
+    ]
+    for path, kwargs, factor in budgets:
+        result = assert_budget(app, path, peak=baseline * factor,
+                               retained=256, **kwargs)
+        print(path, kwargs, result)
+
+
+def load_example(name):
+    """Imports the example module of the given name. Restores the logging
+    configuration it changes."""
+    root = logging.getLogger()
+    level, handlers = root.level, list(root.handlers)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(
+        os.path.dirname(__file__), '..', 'examples', name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        root.setLevel(level)
+        root.handlers[:] = handlers
+    return module
+
+
+@wsgiservice.mount('/allocating')
+class AllocatingResource(wsgiservice.Resource):
+    def GET(self):
+        kept.append([0] * 10000)
+        return {'kept': len(kept)}
+
+
+@wsgiservice.mount('/small')
+class SmallResource(wsgiservice.Resource):
+    def GET(self):
+        return {'small': True}
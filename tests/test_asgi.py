@@ -0,0 +1,356 @@
+import asyncio
+import json
+import logging
+import threading
+
+import wsgiservice
+from wsgiservice.allocations import AllocationTracker
+from wsgiservice.asgi import ASGIApplication, fan_out
+from wsgiservice.cache import ResponseCache
+from wsgiservice.concurrency import ThreadPool
+
+
+def test_async_get():
+    """Coroutine resource methods are awaited."""
+    status, headers, body = call('GET', '/async/foo',
+        headers=[(b'accept', b'application/json')])
+    print(status, headers, body)
+    assert status == 200
+    assert json.loads(body) == {'id': 'foo', 'thread': 'main'}
+    assert headers[b'content-type'] == b'application/json; charset=UTF-8'
+    assert headers[b'etag'] == b'"foo_json"'
+
+
+def test_async_get_etag():
+    """Coroutine get_etag methods are used for conditional requests."""
+    status, headers, body = call('GET', '/async/foo',
+        headers=[(b'if-none-match', b'"foo_xml"')])
+    print(status, headers, body)
+    assert status == 304
+    assert body == b''
+
+
+def test_async_not_found():
+    """NOT_FOUND exceptions of coroutines return a 404."""
+    status, headers, body = call('GET', '/async/missing')
+    assert status == 404
+    assert body == b'<response><error>Not Found</error></response>'
+
+
+def test_async_post_body():
+    """The request body is read from all the body messages."""
+    status, headers, body = call('POST', '/async/foo',
+        headers=[(b'content-type', b'application/x-www-form-urlencoded')],
+        body=[b'value=he', b'llo'])
+    print(status, headers, body)
+    assert status == 200
+    assert body == b'<response>foo=hello</response>'
+
+
+def test_sync_resource():
+    """Synchronous resources are called in a thread."""
+    status, headers, body = call('GET', '/sync.json', query=b'x=1')
+    print(status, headers, body)
+    assert status == 200
+    assert json.loads(body) == {'x': '1', 'thread': 'other'}
+
+
+def test_head():
+    """HEAD requests don't get a body."""
+    status, headers, body = call('HEAD', '/sync', query=b'x=1')
+    assert status == 200
+    assert body == b''
+
+
+def test_not_found_resource():
+    """Unknown paths use the not found resource."""
+    status, headers, body = call('GET', '/unknown')
+    assert status == 404
+
+
+def test_lifespan():
+    """The lifespan events are acknowledged."""
+    app = ASGIApplication(wsgiservice.get_app(globals()))
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(app({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+
+
+def test_offload_pool_resource():
+    """Resources are called in the thread pool set by OFFLOAD_POOL."""
+    app = ASGIApplication(wsgiservice.get_app(globals()))
+    status, headers, body = call('GET', '/report', app=app)
+    print(body)
+    assert status == 200
+    assert body.startswith(b'<response>wsgiservice-reports')
+    assert app.pools['reports'].get_stats()['completed'] == 1
+    assert 'default' not in app.pools
+
+
+def test_offload_method():
+    """Methods marked with offload are called in their pool."""
+    app = ASGIApplication(wsgiservice.get_app(globals()))
+    status, headers, body = call('GET', '/mixed', app=app)
+    print(headers, body)
+    assert status == 200
+    assert headers[b'etag'].startswith(b'"wsgiservice-etags')
+    assert body == b'<response>main</response>'
+
+
+def test_offload_pool_full():
+    """Requests are rejected with 503 once the queue of a pool is full."""
+    app = ASGIApplication(wsgiservice.get_app(globals()),
+        pools={'reports': ThreadPool('reports', size=1, max_queue=1)})
+    ReportResource.event = threading.Event()
+
+    async def run():
+        calls = [asyncio.ensure_future(call_async(app, 'GET', '/report'))
+                 for i in range(3)]
+        await asyncio.sleep(0.1)
+        ReportResource.event.set()
+        return await asyncio.gather(*calls)
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        ReportResource.event = None
+    statuses = sorted(status for status, headers, body in results)
+    print(statuses)
+    assert statuses == [200, 200, 503]
+    stats = app.pools['reports'].get_stats()
+    print(stats)
+    assert stats['rejected'] == 1
+    assert stats['completed'] == 2
+    assert stats['queue_time'] > 0.05
+
+
+def test_fan_out():
+    """fan_out awaits coroutines and calls other methods in threads."""
+    status, headers, body = call('GET', '/aggregate',
+        headers=[(b'accept', b'application/json')])
+    print(body)
+    assert status == 200
+    assert json.loads(body) == [{'id': 'a', 'thread': 'main'},
+                                {'x': 'b', 'thread': 'other'}]
+
+
+def test_fan_out_not_found():
+    """NOT_FOUND exceptions of the calls are handled as usual."""
+    status, headers, body = call('GET', '/aggregate', query=b'id=missing')
+    assert status == 404
+
+
+def test_fan_out_timeout():
+    """Calls which take longer than the timeout return a 504."""
+    status, headers, body = call('GET', '/aggregate', query=b'timeout=0')
+    assert status == 504
+
+
+def test_memoize_async():
+    """Memoized coroutine methods cache their result, concurrent calls
+    await the same call."""
+    MemoizedResource.calls = 0
+    MemoizedResource.GET.invalidate(MemoizedResource)
+    for i in range(2):
+        status, headers, body = call('GET', '/memoized/a')
+        print(status, body)
+        assert status == 200
+        assert body == b'<response>a</response>'
+    assert MemoizedResource.calls == 1
+    app = ASGIApplication(wsgiservice.get_app(globals()))
+
+    async def concurrent():
+        return await asyncio.gather(
+            *[call_async(app, 'GET', '/memoized/b') for i in range(3)])
+    results = asyncio.run(concurrent())
+    assert [status for status, headers, body in results] == [200] * 3
+    assert MemoizedResource.calls == 2
+
+
+def test_coalesce_async():
+    """Identical concurrent requests of coroutine resources are
+    coalesced."""
+    CountingResource.calls = 0
+    app = ASGIApplication(wsgiservice.get_app(globals()))
+    app.application.COALESCE_REQUESTS = True
+
+    async def concurrent():
+        return await asyncio.gather(
+            *[call_async(app, 'GET', '/counting') for i in range(3)])
+    results = asyncio.run(concurrent())
+    print(results)
+    assert [body for status, headers, body in results] == [
+        b'<response>1</response>'] * 3
+    assert CountingResource.calls == 1
+    assert app.application.coalesced_requests == 2
+
+
+def test_response_cache_async():
+    """Responses of coroutine resources are cached, stale ones are
+    refreshed in the background."""
+    now = [1000.0]
+    CountingResource.calls = 0
+    app = ASGIApplication(wsgiservice.get_app(globals()))
+    app.application.RESPONSE_CACHE = ResponseCache(currtime=lambda: now[0])
+
+    async def requests():
+        bodies = []
+        for i in range(2):
+            bodies.append((await call_async(app, 'GET', '/counting'))[2])
+        now[0] += 15
+        bodies.append((await call_async(app, 'GET', '/counting'))[2])
+        for i in range(100):
+            if not app.application.RESPONSE_CACHE._refreshing:
+                break
+            await asyncio.sleep(0.01)
+        bodies.append((await call_async(app, 'GET', '/counting'))[2])
+        return bodies
+    bodies = asyncio.run(requests())
+    print(bodies)
+    assert bodies == [b'<response>1</response>'] * 3 + [
+        b'<response>2</response>']
+    assert CountingResource.calls == 2
+
+
+def test_thread_options_warning():
+    """Options which don't apply to coroutine resources are warned about
+    once."""
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    log = logging.getLogger('wsgiservice.asgi')
+    log.addHandler(handler)
+    app = ASGIApplication(wsgiservice.get_app(globals()))
+    app.application.ALLOCATION_TRACKER = AllocationTracker()
+    try:
+        call('GET', '/sync', query=b'x=1', app=app)
+        assert records == []
+        for i in range(2):
+            call('GET', '/async/foo', app=app)
+    finally:
+        log.removeHandler(handler)
+    print(records)
+    assert [record.getMessage() for record in records] == [
+        "ALLOCATION_TRACKER doesn't apply to coroutine resources served "
+        "through ASGI."]
+
+
+def call(method, path, query=b'', headers=None, body=None, app=None):
+    """Calls the ASGI application of this module in-process. Returns a
+    three-item tuple of status, headers dictionary and body."""
+    if app is None:
+        app = ASGIApplication(wsgiservice.get_app(globals()))
+    return asyncio.run(call_async(app, method, path, query, headers, body))
+
+
+async def call_async(app, method, path, query=b'', headers=None, body=None):
+    """Coroutine version of call."""
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query, 'headers': headers or [],
+             'http_version': '1.1', 'scheme': 'http'}
+    chunks = list(body or [b''])
+    sent = []
+
+    async def receive():
+        chunk = chunks.pop(0)
+        return {'type': 'http.request', 'body': chunk,
+                'more_body': bool(chunks)}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    assert sent[0]['type'] == 'http.response.start'
+    return (sent[0]['status'], dict(sent[0]['headers']),
+            b''.join(m['body'] for m in sent[1:]))
+
+
+def thread_name():
+    if threading.current_thread() is threading.main_thread():
+        return 'main'
+    return 'other'
+
+
+@wsgiservice.mount('/async/{id}')
+class AsyncResource(wsgiservice.Resource):
+    NOT_FOUND = (KeyError,)
+
+    async def GET(self, id):
+        await asyncio.sleep(0)
+        if id == 'missing':
+            raise KeyError(id)
+        return {'id': id, 'thread': thread_name()}
+
+    async def POST(self, id, value):
+        return '{0}={1}'.format(id, value)
+
+    async def get_etag(self, id):
+        return id
+
+
+@wsgiservice.mount('/sync')
+class SyncResource(wsgiservice.Resource):
+    def GET(self, x):
+        return {'x': x, 'thread': thread_name()}
+
+
+@wsgiservice.mount('/report')
+@wsgiservice.offload('reports')
+class ReportResource(wsgiservice.Resource):
+    event = None
+
+    def GET(self):
+        if self.event:
+            self.event.wait(1)
+        return threading.current_thread().name
+
+
+@wsgiservice.mount('/mixed')
+class MixedResource(wsgiservice.Resource):
+    async def GET(self):
+        return thread_name()
+
+    @wsgiservice.offload('etags')
+    def get_etag(self):
+        return threading.current_thread().name
+
+
+@wsgiservice.mount('/memoized/{id}')
+class MemoizedResource(wsgiservice.Resource):
+    calls = 0
+
+    @wsgiservice.memoize()
+    async def GET(self, id):
+        MemoizedResource.calls += 1
+        await asyncio.sleep(0.01)
+        return id
+
+
+@wsgiservice.mount('/counting')
+@wsgiservice.cache_policy(max_age=10, stale_while_revalidate=20)
+class CountingResource(wsgiservice.Resource):
+    calls = 0
+
+    async def GET(self):
+        CountingResource.calls += 1
+        await asyncio.sleep(0.01)
+        return CountingResource.calls
+
+
+@wsgiservice.mount('/aggregate')
+class AggregateResource(wsgiservice.Resource):
+    NOT_FOUND = (KeyError,)
+
+    async def GET(self, id='a', timeout=None):
+        return await fan_out(self, [
+            (AsyncResource, 'GET', {'id': id}),
+            (SyncResource, 'GET', {'x': 'b'}),
+        ], timeout=float(timeout) if timeout else None)
@@ -0,0 +1,639 @@
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.cache import (BloomFilter, CachePolicy, MemcachedCache,
+    MemoryCache, NegativeCache, ResponseCache)
+
+
+def test_memory_cache_get_set():
+    """MemoryCache returns stored values and None for missing keys."""
+    cache = MemoryCache()
+    cache.set('foo', {'bar': 1})
+    assert cache.get('foo') == {'bar': 1}
+    assert cache.get('baz') is None
+    cache.delete('foo')
+    assert cache.get('foo') is None
+
+
+def test_memory_cache_ttl():
+    """MemoryCache expires values after their time to live."""
+    now = [1000.0]
+    cache = MemoryCache(currtime=lambda: now[0])
+    cache.set('foo', 'bar', ttl=10)
+    assert cache.get('foo') == 'bar'
+    now[0] += 10
+    assert cache.get('foo') is None
+
+
+def test_memory_cache_lru():
+    """MemoryCache evicts the least recently used entry."""
+    cache = MemoryCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 1, 'c': 3}
+
+
+def test_memcached_get_set():
+    """MemcachedCache stores bytes and Python values."""
+    server = FakeMemcachedServer()
+    cache = MemcachedCache([server.address])
+    try:
+        cache.set('foo', b'raw bytes')
+        cache.set('bar', {'list': [1, 2]}, ttl=60)
+        assert cache.get('foo') == b'raw bytes'
+        assert cache.get('bar') == {'list': [1, 2]}
+        assert cache.get('baz') is None
+        cache.delete('foo')
+        assert cache.get('foo') is None
+    finally:
+        server.stop()
+
+
+def test_memcached_ttl():
+    """MemcachedCache rounds TTLs up to whole seconds, as an expiration time
+    of zero never expires."""
+    server = FakeMemcachedServer()
+    cache = MemcachedCache([server.address])
+    try:
+        cache.set('short', b'value', ttl=0.5)
+        cache.set('long', b'value', ttl=1.5)
+        cache.set('forever', b'value')
+        assert server.exptimes == {
+            cache._get_cache_key('short'): 1,
+            cache._get_cache_key('long'): 2,
+            cache._get_cache_key('forever'): 0,
+        }
+    finally:
+        server.stop()
+
+
+def test_memcached_invalid_keys():
+    """Keys with whitespace or too long keys are hashed."""
+    server = FakeMemcachedServer()
+    cache = MemcachedCache([server.address])
+    try:
+        cache.set('with space', 1)
+        cache.set('x' * 300, 2)
+        assert cache.get('with space') == 1
+        assert cache.get('x' * 300) == 2
+    finally:
+        server.stop()
+
+
+def test_memcached_get_many_pipelined():
+    """get_many sends a single get command per server."""
+    servers = [FakeMemcachedServer(), FakeMemcachedServer()]
+    cache = MemcachedCache([s.address for s in servers])
+    try:
+        keys = ['key{0}'.format(i) for i in range(20)]
+        for i, key in enumerate(keys):
+            cache.set(key, i)
+        for server in servers:
+            server.commands = []
+        result = cache.get_many(keys + ['missing'])
+        print(result)
+        assert result == dict((key, i) for i, key in enumerate(keys))
+        gets = [c for s in servers for c in s.commands if c == b'get']
+        assert len(gets) == 2
+    finally:
+        for server in servers:
+            server.stop()
+
+
+def test_memcached_fail_open():
+    """An unreachable server leads to misses instead of exceptions."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    cache = MemcachedCache([address], timeout=0.1)
+    cache.set('foo', 'bar')
+    assert cache.get('foo') is None
+    assert cache.get_many(['foo', 'bar']) == {}
+
+
+def test_memcached_timeout():
+    """A server which doesn't answer is a miss after the timeout."""
+    server = FakeMemcachedServer(delay=1)
+    cache = MemcachedCache([server.address], timeout=0.1)
+    try:
+        start = time.time()
+        assert cache.get('foo') is None
+        assert time.time() - start < 0.9
+    finally:
+        server.stop()
+
+
+def test_memcached_garbled_response():
+    """A garbled response is a miss and the connection is dropped."""
+    server = FakeMemcachedServer()
+    cache = MemcachedCache([server.address], timeout=0.1)
+    try:
+        server.data[b'foo'] = (b'x', b'bar')
+        assert cache.get('foo') is None
+        assert cache._pools[0]._idle == []
+    finally:
+        server.stop()
+
+
+def test_memcached_threads():
+    """The connection pool can be shared by many threads."""
+    server = FakeMemcachedServer()
+    cache = MemcachedCache([server.address], pool_size=4)
+    errors = []
+
+    def work(num):
+        try:
+            for i in range(50):
+                key = 't{0}_{1}'.format(num, i)
+                cache.set(key, i)
+                assert cache.get(key) == i
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+    finally:
+        server.stop()
+
+
+def test_policy_cache_control():
+    """CachePolicy precomputes the Cache-Control header."""
+    policy = CachePolicy(max_age=timedelta(minutes=1), s_maxage=600,
+        stale_while_revalidate=30, stale_if_error=3600)
+    assert policy.cache_control == 'max-age=60, s-maxage=600, ' \
+        'stale-while-revalidate=30, stale-if-error=3600'
+    assert policy.shared
+    assert policy.shared_max_age == 600
+    policy = CachePolicy(private=True, max_age=60)
+    assert policy.cache_control == 'private, max-age=60'
+    assert not policy.shared
+    assert CachePolicy(no_store=True).cache_control == 'no-store'
+
+
+def test_policy_class_attribute():
+    """The CACHE_POLICY attribute sets headers on GET responses."""
+    app = wsgiservice.get_app(globals())
+    req = Request.blank('/policy/abc')
+    res = app._handle_request(req)
+    print(res._headers)
+    assert res.status_int == 200
+    assert res._headers['Cache-Control'] == 'max-age=60, s-maxage=300'
+    assert res._headers['Expires'] == 'Mon, 20 Apr 2009 17:54:27 GMT'
+    assert res._headers['Surrogate-Key'] == 'policies policy-abc'
+    assert res._headers['Vary'] == 'Accept, Accept-Language'
+
+
+def test_policy_not_applied_to_post():
+    """The cache policy is not applied to POST requests or errors."""
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/policy/abc',
+        {'REQUEST_METHOD': 'POST'}))
+    assert 'Cache-Control' not in res._headers
+    res = app._handle_request(Request.blank('/policy/fail'))
+    assert res.status_int == 500
+    assert 'Cache-Control' not in res._headers
+
+
+def test_policy_not_found():
+    """Not found responses only get the caching headers of the
+    NEGATIVE_CACHE_TTL."""
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/policy/missing'))
+    assert res.status_int == 404
+    assert 'Cache-Control' not in res._headers
+    res = app._handle_request(Request.blank('/negative-policy/missing'))
+    print(res._headers)
+    assert res.status_int == 404
+    assert res._headers['Cache-Control'] == 'max-age=10, s-maxage=10'
+    assert res._headers['Expires'] == 'Mon, 20 Apr 2009 17:53:37 GMT'
+    assert res._headers['Surrogate-Key'] == 'policies policy-missing'
+    res = app._handle_request(Request.blank('/negative-policy/abc'))
+    assert res._headers['Cache-Control'] == 'max-age=60, s-maxage=300'
+    policy = CachePolicy(max_age=5, stale_while_revalidate=30)
+    assert policy.get_error_policy(10).cache_control == 'max-age=5'
+    assert policy.get_error_policy(10) is policy.get_error_policy(10)
+
+
+def test_policy_decorator():
+    """The cache_policy decorator overrides the class policy."""
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/decorated'))
+    print(res._headers)
+    assert res._headers['Cache-Control'] == 'private, max-age=10'
+    assert 'Surrogate-Key' not in res._headers
+
+
+def test_response_cache_fresh():
+    """Fresh responses are served from the response cache."""
+    now = [1000.0]
+    app = wsgiservice.get_app(globals())
+    app.RESPONSE_CACHE = ResponseCache(currtime=lambda: now[0])
+    CachedResource.calls = 0
+    res1 = app._handle_request(Request.blank('/cached'))
+    now[0] += 5
+    res2 = app._handle_request(Request.blank('/cached'))
+    print(res2)
+    assert CachedResource.calls == 1
+    assert res1.body == res2.body == b'<response>1</response>'
+    assert res2._headers['Age'] == '5'
+    res3 = app._handle_request(Request.blank('/cached',
+        {'HTTP_ACCEPT': 'application/json'}))
+    assert res3.body == b'2'
+    res4 = app._handle_request(Request.blank('/cached', {'REQUEST_METHOD':
+        'HEAD'}))
+    assert res4.body == b''
+    assert CachedResource.calls == 2
+
+
+def test_response_cache_conditional_bypass():
+    """Conditional requests don't use the response cache."""
+    app = wsgiservice.get_app(globals())
+    app.RESPONSE_CACHE = ResponseCache()
+    CachedResource.calls = 0
+    app._handle_request(Request.blank('/cached'))
+    app._handle_request(Request.blank('/cached',
+        {'HTTP_IF_NONE_MATCH': '"foo"'}))
+    assert CachedResource.calls == 2
+
+
+def test_response_cache_stale_while_revalidate():
+    """Stale responses are served while one refresh runs."""
+    now = [1000.0]
+    app = wsgiservice.get_app(globals())
+    app.RESPONSE_CACHE = ResponseCache(currtime=lambda: now[0])
+    CachedResource.calls = 0
+    app._handle_request(Request.blank('/cached'))
+    now[0] += 15
+    CachedResource.event = threading.Event()
+    res = app._handle_request(Request.blank('/cached'))
+    res2 = app._handle_request(Request.blank('/cached'))
+    assert res.body == res2.body == b'<response>1</response>'
+    CachedResource.event.set()
+    for i in range(100):
+        if not app.RESPONSE_CACHE._refreshing:
+            break
+        time.sleep(0.01)
+    CachedResource.event = None
+    assert CachedResource.calls == 2
+    res = app._handle_request(Request.blank('/cached'))
+    assert res.body == b'<response>2</response>'
+    assert CachedResource.calls == 2
+
+
+def test_response_cache_refresh_deadline():
+    """The background refresh doesn't inherit the deadline or the timing of
+    the request which triggered it."""
+    now = [1000.0]
+    app = wsgiservice.get_app(globals())
+    app.RESPONSE_CACHE = ResponseCache(currtime=lambda: now[0])
+    app.TIMING = True
+    CachedResource.calls = 0
+    app._handle_request(Request.blank('/cached'))
+    now[0] += 15
+    CachedResource.event = threading.Event()
+    request = Request.blank('/cached', headers={'X-Request-Timeout': '0.05'})
+    res = app._handle_request(request)
+    assert res.body == b'<response>1</response>'
+    phases = list(request.environ['wsgiservice.timing'].phases)
+    time.sleep(0.1)
+    CachedResource.event.set()
+    for i in range(100):
+        if not app.RESPONSE_CACHE._refreshing:
+            break
+        time.sleep(0.01)
+    CachedResource.event = None
+    assert CachedResource.calls == 2
+    assert list(request.environ['wsgiservice.timing'].phases) == phases
+    res = app._handle_request(Request.blank('/cached'))
+    assert res.body == b'<response>2</response>'
+
+
+def test_response_cache_stale_if_error():
+    """Stale responses are served when the resource fails."""
+    now = [1000.0]
+    app = wsgiservice.get_app(globals())
+    app.RESPONSE_CACHE = ResponseCache(currtime=lambda: now[0])
+    CachedResource.calls = 0
+    app._handle_request(Request.blank('/cached'))
+    now[0] += 60
+    CachedResource.fail = True
+    try:
+        res = app._handle_request(Request.blank('/cached'))
+    finally:
+        CachedResource.fail = False
+    print(res)
+    assert res.status_int == 200
+    assert res.body == b'<response>1</response>'
+    assert res._headers['Age'] == '60'
+
+
+def test_memoize():
+    """memoize caches the return value by converted parameters."""
+    app = wsgiservice.get_app(globals())
+    MemoizedResource.calls = 0
+    res = app._handle_request(Request.blank('/memo/5'))
+    assert res.body == b'<response>10</response>'
+    res = app._handle_request(Request.blank('/memo/05.json'))
+    assert res.body == b'10'
+    assert MemoizedResource.calls == 1
+    app._handle_request(Request.blank('/memo/6'))
+    assert MemoizedResource.calls == 2
+
+
+def test_memoize_invalidate():
+    """Memoized values can be invalidated per parameters or resource."""
+    app = wsgiservice.get_app(globals())
+    MemoizedResource.calls = 0
+    app._handle_request(Request.blank('/memo/1'))
+    app._handle_request(Request.blank('/memo/2'))
+    MemoizedResource.GET.invalidate(MemoizedResource, 1)
+    app._handle_request(Request.blank('/memo/1'))
+    app._handle_request(Request.blank('/memo/2'))
+    assert MemoizedResource.calls == 3
+    MemoizedResource.invalidate_memoized()
+    app._handle_request(Request.blank('/memo/1'))
+    app._handle_request(Request.blank('/memo/2'))
+    assert MemoizedResource.calls == 5
+
+
+def test_memoize_single_flight():
+    """Concurrent misses only call the memoized method once."""
+    app = wsgiservice.get_app(globals())
+    MemoizedResource.calls = 0
+    MemoizedResource.event = threading.Event()
+    results = []
+
+    def request():
+        res = app._handle_request(Request.blank('/memo/21'))
+        results.append(res.body)
+
+    threads = [threading.Thread(target=request) for i in range(5)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    MemoizedResource.event.set()
+    for t in threads:
+        t.join()
+    MemoizedResource.event = None
+    assert results == [b'<response>42</response>'] * 5
+    assert MemoizedResource.calls == 1
+
+
+def test_negative_cache():
+    """NegativeCache entries expire and can be cleared by path."""
+    now = [1000.0]
+    cache = NegativeCache(currtime=lambda: now[0])
+    cache.add(None, '/foo', 'a=1', 10)
+    cache.add(None, '/bar', '', 10)
+    assert (None, '/foo', 'a=1') in cache
+    assert (None, '/foo', '') not in cache
+    cache.clear_path('/foo')
+    assert (None, '/foo', 'a=1') not in cache
+    now[0] += 10
+    assert (None, '/bar', '') not in cache
+
+
+def test_negative_cache_resource():
+    """Requests raising a NOT_FOUND exception are remembered."""
+    app = wsgiservice.get_app(globals())
+    NegativeResource.calls = 0
+    res = app._handle_request(Request.blank('/negative/foo'))
+    assert res.status_int == 404
+    res = app._handle_request(Request.blank('/negative/foo.json'))
+    assert res.status_int == 404
+    assert res.body == b'{"error": "Not Found"}'
+    assert NegativeResource.calls == 1
+    app._handle_request(Request.blank('/negative/foo?x=1'))
+    assert NegativeResource.calls == 2
+
+
+def test_negative_cache_cleared_by_write():
+    """Writes to a path clear the negative cache of that path."""
+    app = wsgiservice.get_app(globals())
+    NegativeResource.calls = 0
+    NegativeResource.items = {}
+    app._handle_request(Request.blank('/negative/bar'))
+    res = app._handle_request(Request.blank('/negative/bar',
+        {'REQUEST_METHOD': 'PUT'}))
+    assert res.status_int == 200
+    res = app._handle_request(Request.blank('/negative/bar'))
+    assert res.status_int == 200
+    assert res.body == b'<response>bar</response>'
+    assert NegativeResource.calls == 2
+
+
+def test_negative_cache_concurrent_read():
+    """A 404 stored by a GET request while a write of the same path was
+    running is forgotten once the write succeeded."""
+    app = wsgiservice.get_app(globals())
+    NegativeResource.calls = 0
+    NegativeResource.items = {}
+    res = app._handle_request(Request.blank('/negative/baz?race=1',
+        {'REQUEST_METHOD': 'PUT'}))
+    assert res.status_int == 200
+    assert NegativeResource.calls == 1
+    res = app._handle_request(Request.blank('/negative/baz'))
+    assert res.status_int == 200
+    assert NegativeResource.calls == 2
+
+
+def test_existence_key():
+    """The existence key has the path parameters ordered by name."""
+    instance = NegativeResource(request=Request.blank('/'), response=None,
+        path_params={'user': 'a', 'doc': 'b', '_extension': '.json'})
+    assert instance.get_existence_key() == 'b/a'
+
+
+def test_bloom_filter():
+    """BloomFilter contains all added keys and few others."""
+    bloom = BloomFilter(1000, error_rate=0.01,
+        keys=[str(i) for i in range(1000)])
+    for i in range(1000):
+        assert str(i) in bloom
+    false_positives = sum(1 for i in range(1000, 11000) if str(i) in bloom)
+    print(false_positives)
+    assert false_positives < 300
+
+
+def test_existence_filter():
+    """Keys missing in the EXISTENCE_FILTER return 404 right away."""
+    app = wsgiservice.get_app(globals())
+    NegativeResource.calls = 0
+    NegativeResource.items = {'known': 'yes'}
+    NegativeResource.EXISTENCE_FILTER = BloomFilter(100, keys=['known'])
+    try:
+        res = app._handle_request(Request.blank('/negative/unknown'))
+        assert res.status_int == 404
+        assert NegativeResource.calls == 0
+        res = app._handle_request(Request.blank('/negative/known'))
+        assert res.status_int == 200
+        assert NegativeResource.calls == 1
+    finally:
+        NegativeResource.EXISTENCE_FILTER = None
+
+
+@wsgiservice.mount('/policy/{id}')
+class PolicyResource(wsgiservice.Resource):
+    CACHE_POLICY = CachePolicy(max_age=60, s_maxage=300,
+        vary=['Accept-Language'], surrogate_keys=['policies', 'policy-{id}'],
+        currtime=lambda: 1240250007)
+    NOT_FOUND = (KeyError,)
+
+    def GET(self, id):
+        if id == 'fail':
+            raise Exception('Failure')
+        if id == 'missing':
+            raise KeyError(id)
+        return id
+
+    def POST(self, id):
+        return id
+
+
+@wsgiservice.mount('/negative-policy/{id}')
+class NegativePolicyResource(PolicyResource):
+    NEGATIVE_CACHE_TTL = 10
+
+
+@wsgiservice.mount('/decorated')
+class DecoratedResource(PolicyResource):
+    @wsgiservice.cache_policy(private=True, max_age=10)
+    def GET(self):
+        return 'private'
+
+
+@wsgiservice.mount('/cached')
+@wsgiservice.cache_policy(max_age=10, stale_while_revalidate=20,
+    stale_if_error=100)
+class CachedResource(wsgiservice.Resource):
+    calls = 0
+    event = None
+    fail = False
+
+    def GET(self):
+        if self.fail:
+            raise Exception('Failure')
+        if self.event:
+            self.event.wait(1)
+        CachedResource.calls += 1
+        return CachedResource.calls
+
+
+@wsgiservice.mount('/memo/{id}')
+@wsgiservice.validate('id', re='[0-9]+', convert=int)
+class MemoizedResource(wsgiservice.Resource):
+    calls = 0
+    event = None
+
+    @wsgiservice.memoize(ttl=60)
+    def GET(self, id):
+        if self.event:
+            self.event.wait(1)
+        MemoizedResource.calls += 1
+        return id * 2
+
+
+@wsgiservice.mount('/negative/{id}')
+class NegativeResource(wsgiservice.Resource):
+    NOT_FOUND = (KeyError,)
+    NEGATIVE_CACHE_TTL = 60
+    calls = 0
+    items = {}
+
+    def GET(self, id):
+        NegativeResource.calls += 1
+        return self.items[id]
+
+    def PUT(self, id):
+        if self.request.GET.get('race'):
+            # A GET request of the same path while the write is running
+            self.application._handle_request(
+                Request.blank('/negative/' + id))
+        self.items[id] = id
+
+
+class FakeMemcachedServer(object):
+    """Minimal stand-in for a memcached server. Implements the get, set and
+    delete commands of the text protocol. Every command name received is
+    recorded in the `commands` list, the expiration time of every key set
+    in the `exptimes` dictionary.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.data = {}
+        self.commands = []
+        self.exptimes = {}
+        self._sock = socket.socket()
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(16)
+        self.address = self._sock.getsockname()
+        self._running = True
+        t = threading.Thread(target=self._serve)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self._running = False
+        self._sock.close()
+
+    def _serve(self):
+        while self._running:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=self._handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _handle(self, conn):
+        f = conn.makefile('rb')
+        try:
+            while True:
+                line = f.readline()
+                if not line:
+                    return
+                parts = line.split()
+                self.commands.append(parts[0])
+                if self.delay:
+                    time.sleep(self.delay)
+                if parts[0] == b'get':
+                    out = []
+                    for key in parts[1:]:
+                        if key in self.data:
+                            flags, data = self.data[key]
+                            out.append(b'VALUE ' + key + b' ' + flags + b' ' +
+                                str(len(data)).encode('ascii') + b'\r\n' +
+                                data + b'\r\n')
+                    conn.sendall(b''.join(out) + b'END\r\n')
+                elif parts[0] == b'set':
+                    data = f.read(int(parts[4]) + 2)[:-2]
+                    self.data[parts[1]] = (parts[2], data)
+                    self.exptimes[parts[1]] = int(parts[3])
+                    conn.sendall(b'STORED\r\n')
+                elif parts[0] == b'delete':
+                    if self.data.pop(parts[1], None) is None:
+                        conn.sendall(b'NOT_FOUND\r\n')
+                    else:
+                        conn.sendall(b'DELETED\r\n')
+                else:
+                    conn.sendall(b'ERROR\r\n')
+        except socket.error:
+            pass
+        finally:
+            conn.close()
@@ -0,0 +1,510 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.concurrency import (BackgroundThread, ProcessPool,
+    SingleFlight, ThreadPool, gather, register_function, set_process_pool, set_thread_pool)
+from wsgiservice.exceptions import PoolFullException, TimeoutException
+
+
+def test_single_flight():
+    """SingleFlight shares the result of concurrent calls."""
+    flight = SingleFlight()
+    event = threading.Event()
+    calls = []
+    results = []
+
+    def func():
+        event.wait(1)
+        calls.append(1)
+        return 'value'
+
+    def call():
+        results.append(flight.do('key', func))
+
+    threads = [threading.Thread(target=call) for i in range(5)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    event.set()
+    for t in threads:
+        t.join()
+    print(results)
+    assert len(calls) == 1
+    assert sorted(results) == [('value', False)] + [('value', True)] * 4
+    assert len(flight) == 0
+
+
+def test_single_flight_error():
+    """Exceptions of the call are raised for all the callers."""
+    flight = SingleFlight()
+    event = threading.Event()
+    errors = []
+
+    def func():
+        event.wait(1)
+        raise KeyError('foo')
+
+    def call():
+        try:
+            flight.do('key', func)
+        except KeyError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for i in range(3)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    event.set()
+    for t in threads:
+        t.join()
+    assert len(errors) == 3
+
+
+def test_single_flight_timeout():
+    """Waiting callers give up after the timeout."""
+    flight = SingleFlight()
+    event = threading.Event()
+    t = threading.Thread(target=flight.do, args=('key', lambda: event.wait(1)))
+    t.start()
+    time.sleep(0.05)
+    try:
+        flight.do('key', lambda: None, timeout=0.01)
+    except TimeoutException:
+        pass
+    else:
+        assert False, "Expected an exception!"
+    finally:
+        event.set()
+        t.join()
+
+
+def test_background_thread():
+    """BackgroundThread calls the function until it's stopped. Errors are
+    passed to on_error and don't stop the thread."""
+    calls = []
+    errors = []
+
+    def func():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ValueError('first')
+
+    thread = BackgroundThread(func, 0.001, name='test-background',
+                              on_error=errors.append)
+    assert not thread.running
+    assert thread.start()
+    assert not thread.start()
+    assert thread.running
+    deadline = time.time() + 5
+    while len(calls) < 3 and time.time() < deadline:
+        time.sleep(0.001)
+    thread.stop()
+    assert not thread.running
+    assert not thread.is_alive()
+    assert len(calls) >= 3
+    assert [str(e) for e in errors] == ['first']
+
+
+def test_background_thread_fork():
+    """BackgroundThread starts a new thread if it was started in another
+    process."""
+    thread = BackgroundThread(lambda: None, 0.01)
+    thread.start()
+    old, stopped = thread._thread, thread._stopped
+    thread._pid = -1
+    assert not thread.running
+    assert thread.start()
+    assert thread._thread is not old
+    assert thread.is_alive()
+    thread.stop()
+    stopped.set()
+    old.join(1)
+    assert not old.is_alive()
+
+
+def test_background_thread_wake():
+    """BackgroundThread.stop wakes up a function which is waiting."""
+    event = threading.Event()
+    thread = BackgroundThread(lambda: event.wait(5))
+    thread.start()
+    started = time.time()
+    thread.stop(wake=event.set)
+    assert time.time() - started < 1
+    assert not thread.is_alive()
+
+
+def test_thread_pool():
+    """ThreadPool runs functions in named threads and tracks statistics."""
+    pool = ThreadPool('test', size=2)
+    future = pool.submit(lambda a, b: (threading.current_thread().name, a + b),
+                         1, b=2)
+    name, value = future.result(1)
+    assert name.startswith('wsgiservice-test')
+    assert value == 3
+    pool.shutdown()
+    stats = pool.get_stats()
+    print(stats)
+    assert stats['completed'] == 1
+    assert stats['queued'] == 0
+    assert stats['running'] == 0
+
+
+def test_thread_pool_full():
+    """ThreadPool rejects work once its queue is full."""
+    pool = ThreadPool('test', size=1, max_queue=1)
+    event = threading.Event()
+    futures = [pool.submit(event.wait, 1), pool.submit(event.wait, 1)]
+    time.sleep(0.05)
+    assert pool.get_stats()['running'] == 1
+    assert pool.get_stats()['queued'] == 1
+    try:
+        pool.submit(event.wait, 1)
+    except PoolFullException:
+        pass
+    else:
+        assert False, "Expected an exception!"
+    finally:
+        event.set()
+    for future in futures:
+        assert future.result(1)
+    stats = pool.get_stats()
+    assert stats['rejected'] == 1
+    assert stats['completed'] == 2
+    assert stats['queue_time'] > 0.04
+    pool.shutdown()
+
+
+def test_gather():
+    """gather calls the functions concurrently and keeps their order."""
+    pool = ThreadPool('test', size=4)
+    start = time.time()
+    results = gather([lambda i=i: time.sleep(0.1) or i for i in range(4)],
+                     pool=pool)
+    assert results == [0, 1, 2, 3]
+    assert time.time() - start < 0.3
+    pool.shutdown()
+
+
+def test_gather_pool_full():
+    """Functions which can't be queued are called in the current thread."""
+    pool = ThreadPool('test', size=1, max_queue=0)
+    names = gather([lambda: time.sleep(0.05) or
+                    threading.current_thread().name] * 3, pool=pool)
+    print(names)
+    assert names[0] == threading.current_thread().name
+    assert names.count(threading.current_thread().name) >= 2
+    assert pool.get_stats()['queued'] == 0
+    pool.shutdown()
+
+
+def test_gather_error():
+    """The exception of the first failing function is raised."""
+    def fail(e):
+        raise e
+    try:
+        gather([lambda: 1, lambda: fail(KeyError('a')),
+                lambda: fail(ValueError('b'))], pool=ThreadPool('test'))
+    except KeyError:
+        pass
+    else:
+        assert False, "Expected an exception!"
+
+
+def test_gather_timeout():
+    """Functions which take longer than their timeout raise an exception."""
+    try:
+        gather([lambda: 1, lambda: time.sleep(0.2)], timeouts=[None, 0.05],
+               pool=ThreadPool('test'))
+    except TimeoutException:
+        pass
+    else:
+        assert False, "Expected an exception!"
+
+
+def test_fan_out():
+    """fan_out calls the resources concurrently."""
+    app = wsgiservice.get_app(globals())
+    start = time.time()
+    res = app._handle_request(Request.blank('/fan-out?ids=1,2,3,4',
+        headers={'Accept': 'application/json'}))
+    print(res)
+    assert res.status_int == 200
+    assert res.body == b'["1", "2", "3", "4"]'
+    assert time.time() - start < 0.35
+
+
+def test_fan_out_not_found():
+    """NOT_FOUND exceptions of the calls are handled as usual."""
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/fan-out?ids=1,missing'))
+    print(res)
+    assert res.status_int == 404
+
+
+def test_fan_out_response_exception():
+    """Responses raised by the calls are returned."""
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/fan-out?ids=gone,1'))
+    print(res)
+    assert res.status_int == 410
+
+
+def test_fan_out_timeout():
+    """Calls which take longer than the timeout return a 504."""
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/fan-out?ids=1,2&timeout=0.05'))
+    print(res)
+    assert res.status_int == 504
+
+
+def test_fan_out_nested():
+    """Nested fan-outs don't dead-lock a small pool."""
+    set_thread_pool(ThreadPool('fan-out', size=1, max_queue=10))
+    app = wsgiservice.get_app(globals())
+    try:
+        res = app._handle_request(Request.blank('/fan-out?ids=1,2&nested=2'))
+        print(res)
+        assert res.status_int == 200
+    finally:
+        set_thread_pool(ThreadPool('fan-out'))
+
+
+def test_process_pool():
+    """ProcessPool calls registered functions in worker processes."""
+    pool = ProcessPool('test', size=2)
+    try:
+        pool.start()
+        pid, value = pool.call(add, (1,), {'b': 2})
+        assert pid != os.getpid()
+        assert value == 3
+        # Workers are reused
+        pids = set(pool.call(add, (0, 0))[0] for i in range(10))
+        assert pid in pids
+        assert len(pids) <= 2
+        stats = pool.get_stats()
+        print(stats)
+        assert stats['completed'] == 11
+        assert stats['running'] == 0
+    finally:
+        pool.shutdown()
+
+
+def test_process_pool_shared_memory():
+    """Large byte strings are returned through shared memory."""
+    pool = ProcessPool('test', size=1)
+    try:
+        assert pool.call(make_bytes, (10,)) == b'x' * 10
+        assert pool.call(make_bytes, (1000000,)) == b'x' * 1000000
+        assert pool.call(make_bytes, (0,)) == b''
+    finally:
+        pool.shutdown()
+
+
+def test_process_pool_timeout():
+    """Calls which take longer than the timeout raise an exception."""
+    pool = ProcessPool('test', size=1)
+    try:
+        pool.call(sleep, (0.5,), timeout=0.05)
+    except TimeoutException:
+        pass
+    else:
+        assert False, "Expected an exception!"
+    finally:
+        pool.shutdown()
+
+
+def test_process_pool_broken():
+    """The workers are replaced after a worker process died."""
+    pool = ProcessPool('test', size=1)
+    try:
+        try:
+            pool.call(crash)
+        except BrokenProcessPool:
+            pass
+        else:
+            assert False, "Expected an exception!"
+        assert pool.call(add, (1, 2))[1] == 3
+        assert pool.get_stats()['running'] == 0
+    finally:
+        pool.shutdown()
+
+
+def test_cpu_bound():
+    """Methods decorated with cpu_bound are called in a worker process."""
+    set_process_pool(ProcessPool('tests', size=1, max_queue=0))
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/digest?data=abc'))
+    print(res)
+    assert res.status_int == 200
+    assert res.body == '<response>{0}</response>'.format(
+        hashlib.sha256(b'abc').hexdigest()).encode()
+
+
+def test_cpu_bound_timeout():
+    """Methods which take longer than the timeout return a 504."""
+    set_process_pool(ProcessPool('tests', size=1, max_queue=0))
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/digest?data=abc&rounds=1000000'))
+    print(res)
+    assert res.status_int == 504
+
+
+def test_cpu_bound_pool_full():
+    """Requests are rejected with a 503 if the queue of the pool is full."""
+    set_process_pool(ProcessPool('tests', size=1, max_queue=0))
+    app = wsgiservice.get_app(globals())
+    t = threading.Thread(target=app._handle_request,
+        args=(Request.blank('/digest?data=abc&rounds=1000000'),))
+    t.start()
+    time.sleep(0.02)
+    res = app._handle_request(Request.blank('/digest?data=abc'))
+    t.join()
+    print(res)
+    assert res.status_int == 503
+    assert res.headers['Retry-After'] == '1'
+
+
+def test_coalesce_requests():
+    """Identical concurrent requests only call the resource once."""
+    app = wsgiservice.get_app(globals())
+    app.COALESCE_REQUESTS = True
+    results = run_concurrently(app, ['/slow?id=1'] * 4 + ['/slow.json?id=1'])
+    print(results)
+    assert SlowResource.calls == 2
+    assert sorted(results) == [b'"1"'] + [b'<response>1</response>'] * 4
+    assert app.coalesced_requests == 3
+
+
+def test_coalesce_requests_disabled():
+    """Requests are not coalesced by default."""
+    app = wsgiservice.get_app(globals())
+    run_concurrently(app, ['/slow?id=1'] * 3)
+    assert SlowResource.calls == 3
+    assert app.coalesced_requests == 0
+
+
+def test_coalesce_requests_timeout():
+    """Requests handle themselves after waiting for the timeout."""
+    app = wsgiservice.get_app(globals())
+    app.COALESCE_REQUESTS = True
+    app.COALESCE_TIMEOUT = 0.01
+    run_concurrently(app, ['/slow?id=1'] * 3)
+    assert SlowResource.calls == 3
+    assert app.coalesced_requests == 0
+
+
+def test_coalesce_requests_deadline():
+    """Coalesced requests only wait until their deadline and then fail
+    with a 504."""
+    app = wsgiservice.get_app(globals())
+    app.COALESCE_REQUESTS = True
+    SlowResource.calls = 0
+    SlowResource.event = threading.Event()
+    t = threading.Thread(target=app._handle_request,
+                         args=(Request.blank('/slow?id=1'),))
+    t.start()
+    time.sleep(0.02)
+    start = time.monotonic()
+    res = app._handle_request(Request.blank('/slow?id=1',
+        headers={'X-Request-Timeout': '0.05'}))
+    elapsed = time.monotonic() - start
+    SlowResource.event.set()
+    t.join()
+    print(res)
+    assert res.status_int == 504
+    assert elapsed < 0.5
+    assert SlowResource.calls == 1
+    assert app.coalesced_requests == 0
+
+
+def run_concurrently(app, paths):
+    """Sends requests to all the given paths concurrently while the
+    SlowResource is blocked. Returns the response bodies."""
+    SlowResource.calls = 0
+    SlowResource.event = threading.Event()
+    results = []
+
+    def request(path):
+        results.append(app._handle_request(Request.blank(path)).body)
+
+    threads = [threading.Thread(target=request, args=(path,))
+               for path in paths]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    SlowResource.event.set()
+    for t in threads:
+        t.join()
+    return results
+
+
+def add(a, b):
+    return os.getpid(), a + b
+
+
+def make_bytes(size):
+    return b'x' * size
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+
+
+def crash():
+    os._exit(1)
+
+
+for func in (add, make_bytes, sleep, crash):
+    register_function(func)
+
+
+@wsgiservice.mount('/slow')
+class SlowResource(wsgiservice.Resource):
+    calls = 0
+    event = None
+
+    def GET(self, id):
+        SlowResource.calls += 1
+        self.event.wait(1)
+        return id
+
+
+@wsgiservice.mount('/fan-out')
+class FanOutResource(wsgiservice.Resource):
+    NOT_FOUND = (KeyError,)
+
+    def GET(self, ids, timeout=None, nested=0):
+        if int(nested):
+            return self.fan_out([
+                (FanOutResource, 'GET', {'ids': ids,
+                                         'nested': int(nested) - 1})
+                for i in range(int(nested))])
+        if timeout:
+            timeout = float(timeout)
+        return self.fan_out([(ItemResource, 'GET', {'id': id})
+                             for id in ids.split(',')], timeout=timeout)
+
+
+@wsgiservice.mount('/item/{id}')
+class ItemResource(wsgiservice.Resource):
+    def GET(self, id):
+        time.sleep(0.1)
+        if id == 'gone':
+            wsgiservice.raise_410(self)
+        return {'1': '1', '2': '2', '3': '3', '4': '4'}[id]
+
+
+@wsgiservice.mount('/digest')
+class DigestResource(wsgiservice.Resource):
+    @wsgiservice.cpu_bound(pool='tests', timeout=0.1)
+    def GET(self, data, rounds=1):
+        value = data.encode()
+        for i in range(int(rounds)):
+            value = hashlib.sha256(value).digest()
+        return value.hex()
@@ -0,0 +1,129 @@
+import json
+import time
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.exceptions import DeadlineExceededException
+from wsgiservice.loader import Loader
+
+
+def test_no_deadline():
+    """Requests have no deadline by default."""
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/remaining',
+        headers={'Accept': 'application/json'}))
+    assert res.status_int == 200
+    assert json.loads(res.body) == {'remaining': None}
+
+
+def test_deadline_header():
+    """The deadline is taken from the request header."""
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/remaining',
+        headers={'Accept': 'application/json', 'X-Request-Timeout': '5'}))
+    assert res.status_int == 200
+    assert 4 < json.loads(res.body)['remaining'] <= 5
+
+
+def test_deadline_default():
+    """The header can only shorten the default deadline."""
+    app = wsgiservice.get_app(globals())
+    app.DEADLINE = 2
+    for header, expected in (('5', 2), ('1', 1), ('invalid', 2)):
+        res = app._handle_request(Request.blank('/remaining',
+            headers={'Accept': 'application/json',
+                     'X-Request-Timeout': header}))
+        remaining = json.loads(res.body)['remaining']
+        print(header, remaining)
+        assert expected - 1 < remaining <= expected
+
+
+def test_deadline_before_method():
+    """Requests whose deadline passed before the method is called return a
+    504 without calling the method."""
+    app = wsgiservice.get_app(globals())
+    SlowResource.calls = 0
+    res = app._handle_request(Request.blank('/slow',
+        headers={'X-Request-Timeout': '0'}))
+    print(res)
+    assert res.status_int == 504
+    assert SlowResource.calls == 0
+
+
+def test_deadline_before_serialization():
+    """Responses whose deadline passed while the method ran are not
+    serialized."""
+    app = wsgiservice.get_app(globals())
+    SlowResource.calls = 0
+    res = app._handle_request(Request.blank('/slow',
+        headers={'X-Request-Timeout': '0.05'}))
+    print(res)
+    assert res.status_int == 504
+    assert SlowResource.calls == 1
+    assert b'Deadline exceeded after GET' in res.body
+    assert b'item' not in res.body
+
+
+def test_deadline_after_write():
+    """Writes whose deadline passed while the method ran still return
+    their response, as they may already be committed."""
+    app = wsgiservice.get_app(globals())
+    SlowResource.calls = 0
+    res = app._handle_request(Request.blank('/slow', method='POST',
+        headers={'X-Request-Timeout': '0.05'}))
+    print(res)
+    assert res.status_int == 200
+    assert SlowResource.calls == 1
+
+
+def test_deadline_fan_out():
+    """fan_out waits at most until the deadline."""
+    app = wsgiservice.get_app(globals())
+    start = time.time()
+    res = app._handle_request(Request.blank('/fan-out',
+        headers={'X-Request-Timeout': '0.05'}))
+    print(res)
+    assert res.status_int == 504
+    assert time.time() - start < 0.15
+
+
+def test_deadline_loader():
+    """Loaders don't call the batch function after the deadline."""
+    loader = Loader(lambda keys: keys, deadline=time.monotonic() + 10)
+    assert loader.load(1) == 1
+    loader.deadline = time.monotonic() - 1
+    assert loader.load(1) == 1
+    try:
+        loader.load(2)
+    except DeadlineExceededException:
+        pass
+    else:
+        assert False, "Expected an exception!"
+
+
+@wsgiservice.mount('/remaining')
+class RemainingResource(wsgiservice.Resource):
+    def GET(self):
+        return {'remaining': self.get_remaining_time()}
+
+
+@wsgiservice.mount('/slow')
+class SlowResource(wsgiservice.Resource):
+    calls = 0
+
+    def GET(self):
+        SlowResource.calls += 1
+        time.sleep(0.1)
+        return ['item'] * 1000
+
+    def POST(self):
+        SlowResource.calls += 1
+        time.sleep(0.1)
+        return 'stored'
+
+
+@wsgiservice.mount('/fan-out')
+class FanOutResource(wsgiservice.Resource):
+    def GET(self):
+        return self.fan_out([(SlowResource, 'GET', {})] * 2)
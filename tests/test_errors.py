@@ -0,0 +1,150 @@
+import logging
+import shutil
+import tempfile
+import time
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.errors import (ErrorReporter, get_fingerprint, get_reporter,
+    set_reporter)
+from wsgiservice.metrics import Metrics
+from wsgiservice.shm import SharedTable
+
+
+def test_fingerprint():
+    """Exceptions are fingerprinted by type and raise site."""
+    errors = [raise_error(), raise_error(), raise_other_error()]
+    fingerprints = [get_fingerprint(e) for e in errors]
+    print(fingerprints)
+    assert fingerprints[0] == fingerprints[1]
+    assert fingerprints[0] != fingerprints[2]
+    assert fingerprints[0].startswith('builtins.ValueError@')
+    assert fingerprints[0].endswith('test_errors.py:{0}'.format(
+        raise_error.__code__.co_firstlineno + 3))
+    assert get_fingerprint(ValueError()) == 'builtins.ValueError'
+
+
+def test_report():
+    """The first occurrence is logged with the traceback, the others are
+    summarized once per interval."""
+    now = [1000]
+    reporter = ErrorReporter(interval=60, currtime=lambda: now[0])
+    log, records = create_logger()
+    for i in range(5):
+        reporter.report(raise_error(), "Failed: %s", log=log)
+    assert len(records) == 1
+    assert records[0].exc_info is not None
+    assert records[0].getMessage() == "Failed: error"
+    now[0] += 60
+    fingerprint = reporter.report(raise_error(), "Failed: %s", log=log)
+    assert len(records) == 2
+    print(records[1].getMessage())
+    assert records[1].exc_info is None
+    assert records[1].getMessage() == "Failed: error (5 times in the last " \
+        "60 seconds, {0})".format(fingerprint)
+    reporter.report(raise_error(), "Failed: %s", log=log)
+    reporter.flush(log=log)
+    assert len(records) == 3
+    assert records[2].getMessage() == "{0} occurred 1 more times: " \
+        "error".format(fingerprint)
+    stats = reporter.get_stats()
+    assert len(stats) == 1
+    assert stats[0]['count'] == 7
+    assert stats[0]['first_seen'] == 1000
+    assert stats[0]['last_seen'] == 1060
+
+
+def test_report_end_of_burst():
+    """The summary of a burst is logged by the background thread even if
+    the exception doesn't occur again."""
+    reporter = ErrorReporter(interval=0.05)
+    log, records = create_logger()
+    try:
+        for i in range(3):
+            fingerprint = reporter.report(raise_error(), "Failed: %s",
+                                          level=logging.WARNING, log=log)
+        assert len(records) == 1
+        for i in range(100):
+            if len(records) > 1:
+                break
+            time.sleep(0.01)
+        assert len(records) == 2
+        assert records[1].levelno == logging.WARNING
+        assert records[1].getMessage() == "{0} occurred 2 more times: " \
+            "error".format(fingerprint)
+    finally:
+        reporter.stop()
+
+
+def test_max_fingerprints():
+    """The least recently seen fingerprints are forgotten first."""
+    now = [0]
+    reporter = ErrorReporter(max_fingerprints=2, currtime=lambda: now[0])
+    log, records = create_logger()
+    for e in (raise_error(), raise_other_error(), raise_error(), KeyError()):
+        now[0] += 1
+        reporter.report(e, "Failed: %s", log=log)
+    fingerprints = [error['fingerprint'] for error in reporter.get_stats()]
+    assert fingerprints == [get_fingerprint(raise_error()),
+                            'builtins.KeyError']
+
+
+def test_resource():
+    """Exceptions of resources go through the reporter and are counted in
+    the metrics."""
+    previous = get_reporter()
+    reporter = ErrorReporter()
+    set_reporter(reporter)
+    path = tempfile.mkdtemp()
+    try:
+        app = wsgiservice.get_app(globals(), add_metrics=True)
+        app.METRICS = Metrics(table=SharedTable('metrics',
+            fields=Metrics(name='test').fields, slots=Metrics.SLOTS, key_size=128,
+            path=path))
+        for i in range(3):
+            res = app._handle_request(Request.blank('/failing?id=1'))
+            assert res.status_int == 500
+            res = app._handle_request(Request.blank('/failing?id=x'))
+            assert res.status_int == 400
+        stats = reporter.get_stats()
+        print(stats)
+        assert [error['count'] for error in stats] == [3, 3]
+        assert sorted(row['type'] for row in app.METRICS.collect()[
+            'exceptions']) == ['RuntimeError', 'ValidationException']
+    finally:
+        set_reporter(previous)
+        shutil.rmtree(path)
+
+
+def raise_error():
+    """Returns a raised ValueError."""
+    try:
+        raise ValueError('error')
+    except ValueError as e:
+        return e
+
+
+def raise_other_error():
+    """Returns a ValueError raised somewhere else."""
+    try:
+        int('error')
+    except ValueError as e:
+        return e
+
+
+def create_logger():
+    """Returns a new logger and the list of records it logs."""
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    log = logging.Logger('test_errors')
+    log.addHandler(handler)
+    return log, records
+
+
+@wsgiservice.mount('/failing')
+class FailingResource(wsgiservice.Resource):
+    @wsgiservice.validate('id', re='^[0-9]+$')
+    def GET(self, id):
+        raise RuntimeError('backend down')
@@ -0,0 +1,284 @@
+import json
+import shutil
+import tempfile
+import threading
+import time
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.limits import AdmissionController, RateLimiter
+from wsgiservice.shm import SharedTable
+
+
+def test_admission():
+    """Requests beyond the limit are rejected."""
+    controller = AdmissionController(max_in_flight=2, max_queue=0)
+    assert controller.acquire()
+    assert controller.acquire()
+    assert not controller.acquire()
+    controller.release()
+    assert controller.acquire()
+    stats = controller.get_stats()
+    print(stats)
+    assert stats['in_flight'] == 2
+    assert stats['admitted'] == 3
+    assert stats['rejected'] == 1
+
+
+def test_admission_queue():
+    """Requests wait in the queue until a request is released."""
+    controller = AdmissionController(max_in_flight=1, max_queue=1,
+                                     queue_timeout=1)
+    assert controller.acquire()
+    results = []
+    t = threading.Thread(target=lambda: results.append(controller.acquire()))
+    t.start()
+    time.sleep(0.05)
+    assert controller.get_stats()['waiting'] == 1
+    # The queue is full
+    assert not controller.acquire()
+    controller.release()
+    t.join()
+    assert results == [True]
+
+
+def test_admission_queue_timeout():
+    """Requests are rejected after waiting for the timeout."""
+    controller = AdmissionController(max_in_flight=1, queue_timeout=0.01)
+    assert controller.acquire()
+    assert not controller.acquire()
+    assert controller.get_stats()['waiting'] == 0
+
+
+def test_retry_after():
+    """Retry-After is the estimated time to handle the pending requests."""
+    controller = AdmissionController(max_in_flight=2)
+    assert controller.get_retry_after() == 1
+    for i in range(2):
+        controller.acquire()
+    controller.release(3)
+    controller.acquire()
+    assert controller.get_retry_after() == 3
+    controller.MAX_RETRY_AFTER = 2
+    assert controller.get_retry_after() == 2
+
+
+def test_adaptive_limit():
+    """The limit decreases multiplicatively with slow requests and increases
+    additively with fast ones."""
+    now = [100]
+    controller = AdmissionController(max_in_flight=10, target_latency=0.5,
+                                     min_in_flight=5,
+                                     currtime=lambda: now[0])
+    controller.acquire()
+    controller.release(1)
+    assert controller.limit == 9
+    # Only one decrease per target latency
+    controller.acquire()
+    controller.release(1)
+    assert controller.limit == 9
+    for i in range(20):
+        now[0] += 1
+        controller.acquire()
+        controller.release(1)
+    assert controller.limit == 5
+    # Fast requests only increase the limit while it's used
+    controller.acquire()
+    controller.release(0.1)
+    assert controller.limit == 5
+    for i in range(5):
+        controller.acquire()
+    for i in range(20):
+        controller.release(0.1)
+        controller.acquire()
+    assert controller.limit == 6
+
+
+def test_application_reject():
+    """Rejected requests get a 503 with a Retry-After header."""
+    app = wsgiservice.get_app(globals())
+    app.ADMISSION_CONTROLLER = AdmissionController(max_in_flight=1,
+                                                   max_queue=0)
+    app.ADMISSION_CONTROLLER.acquire()
+    res = app._handle_request(Request.blank('/limited',
+            remote_addr='10.0.0.1'))
+    print(res)
+    assert res.status_int == 503
+    assert res.headers['Retry-After'] == '1'
+    app.ADMISSION_CONTROLLER.release()
+    res = app._handle_request(Request.blank('/limited',
+            remote_addr='10.0.0.1'))
+    assert res.status_int == 200
+    assert app.ADMISSION_CONTROLLER.get_stats()['in_flight'] == 0
+
+
+def test_application_exempt():
+    """Internal paths are not subject to admission control."""
+    app = wsgiservice.get_app(globals())
+    app.ADMISSION_CONTROLLER = AdmissionController(max_in_flight=0)
+    res = app._handle_request(Request.blank('/_internal/health'))
+    assert res.status_int == 200
+    res = app._handle_request(Request.blank('/limited',
+            remote_addr='10.0.0.1'))
+    assert res.status_int == 503
+
+
+def test_bulkhead():
+    """Requests beyond the bulkhead of a resource are rejected without
+    affecting other resources."""
+    app = wsgiservice.get_app(globals())
+    ReportResource.event = threading.Event()
+    t = threading.Thread(target=app._handle_request,
+                         args=(Request.blank('/report'),))
+    t.start()
+    time.sleep(0.05)
+    try:
+        res = app._handle_request(Request.blank('/report'))
+        print(res)
+        assert res.status_int == 503
+        assert res.headers['Retry-After'] == '1'
+        res = app._handle_request(Request.blank('/limited',
+            remote_addr='10.0.0.1'))
+        assert res.status_int == 200
+    finally:
+        ReportResource.event.set()
+        t.join()
+    res = app._handle_request(Request.blank('/report'))
+    assert res.status_int == 200
+    stats = app.get_bulkheads()
+    print(stats)
+    assert list(stats.keys()) == ['ReportResource']
+    assert stats['ReportResource']['limit'] == 1
+    assert stats['ReportResource']['admitted'] == 2
+    assert stats['ReportResource']['rejected'] == 1
+
+
+def test_bulkhead_help():
+    """The bulkhead is shown in the help."""
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/_internal/help',
+        headers={'Accept': 'application/json'}))
+    assert res.status_int == 200
+    help = dict((r['name'], r) for r in json.loads(res.body))
+    assert help['ReportResource']['properties']['BULKHEAD'] == 1
+    assert help['LimitedResource']['properties']['BULKHEAD'] is None
+    res = app._handle_request(Request.blank('/_internal/help.html'))
+    assert res.status_int == 200
+    assert b'<tr><th>Concurrency limit</th><td>1</td>' in res.body
+
+
+def test_rate_limit():
+    """Clients get requests tokens which are refilled over the period."""
+    now = [1000.0]
+    limiter, path = create_rate_limiter(requests=2, period=10,
+                                        currtime=lambda: now[0])
+    try:
+        request = Request.blank('/limited', remote_addr='10.0.0.1')
+        other = Request.blank('/limited', remote_addr='10.0.0.2')
+        results = [limiter.check(request, LimitedResource) for i in range(3)]
+        assert [r.allowed for r in results] == [True, True, False]
+        assert [r.remaining for r in results] == [1, 0, 0]
+        assert results[2].retry_after == 5
+        assert results[2].reset == 10
+        assert limiter.check(other, LimitedResource).allowed
+        now[0] += 5
+        assert limiter.check(request, LimitedResource).allowed
+        assert not limiter.check(request, LimitedResource).allowed
+    finally:
+        shutil.rmtree(path)
+
+
+def test_rate_limit_resource():
+    """Resources can have their own limits and keys."""
+    limiter, path = create_rate_limiter(requests=100)
+    try:
+        request = Request.blank('/api', headers={'X-Api-Key': 'abc'},
+                                remote_addr='10.0.0.1')
+        assert limiter.check(request, ApiResource).allowed
+        assert not limiter.check(request, ApiResource).allowed
+        assert limiter.check(request, LimitedResource).allowed
+        # Requests without key are not limited
+        assert limiter.check(Request.blank('/api', remote_addr='10.0.0.1'),
+                             ApiResource) is None
+        assert limiter.check(request, HealthResource) is None
+    finally:
+        shutil.rmtree(path)
+
+
+def test_application_rate_limit():
+    """Requests beyond the rate limit get a 429, all of them get the
+    RateLimit headers."""
+    app = wsgiservice.get_app(globals())
+    app.RATE_LIMITER, path = create_rate_limiter(requests=1, period=60)
+    try:
+        res = app._handle_request(Request.blank('/limited',
+            remote_addr='10.0.0.1'))
+        print(res)
+        assert res.status_int == 200
+        assert res.headers['RateLimit-Limit'] == '1'
+        assert res.headers['RateLimit-Remaining'] == '0'
+        assert res.headers['RateLimit-Policy'] == '1;w=60'
+        res = app._handle_request(Request.blank('/limited',
+            remote_addr='10.0.0.1'))
+        print(res)
+        assert res.status_int == 429
+        assert res.headers['Retry-After'] == '60'
+        res = app._handle_request(Request.blank('/_internal/health',
+            remote_addr='10.0.0.1'))
+        assert res.status_int == 200
+        assert 'RateLimit-Limit' not in res.headers
+    finally:
+        shutil.rmtree(path)
+
+
+def test_rate_limit_name():
+    """Rate limiters without a table need the name of their table."""
+    try:
+        RateLimiter()
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected an exception!"
+    assert RateLimiter(name='test-ratelimit').name == 'test-ratelimit'
+
+
+def create_rate_limiter(**kwargs):
+    """Returns a rate limiter using a table in a new temporary directory and
+    the directory."""
+    path = tempfile.mkdtemp()
+    kwargs['table'] = SharedTable('ratelimit', path=path)
+    return RateLimiter(**kwargs), path
+
+
+@wsgiservice.mount('/limited')
+class LimitedResource(wsgiservice.Resource):
+    def GET(self):
+        return 'ok'
+
+
+@wsgiservice.mount('/_internal/health')
+class HealthResource(wsgiservice.Resource):
+    RATE_LIMIT = False
+    def GET(self):
+        return 'ok'
+
+
+@wsgiservice.mount('/report')
+class ReportResource(wsgiservice.Resource):
+    BULKHEAD = 1
+    BULKHEAD_TIMEOUT = 0.01
+    event = None
+
+    def GET(self):
+        self.event.wait(1)
+        return 'report'
+
+
+@wsgiservice.mount('/api')
+class ApiResource(wsgiservice.Resource):
+    RATE_LIMIT = (1, 60)
+    RATE_LIMIT_KEY = 'header:X-Api-Key'
+
+    def GET(self):
+        return 'ok'
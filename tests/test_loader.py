@@ -0,0 +1,161 @@
+import asyncio
+import json
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.loader import Loader
+
+
+def test_load():
+    """Loaded values are memoized."""
+    calls = []
+    loader = Loader(lambda keys: calls.append(keys) or [k * 2 for k in keys])
+    assert loader.load(1) == 2
+    assert loader.load(1) == 2
+    assert loader.load(2) == 4
+    assert calls == [[1], [2]]
+    assert loader.batches == 2
+
+
+def test_load_many():
+    """Only unknown keys are passed to the batch function."""
+    calls = []
+    loader = Loader(lambda keys: calls.append(keys) or [k * 2 for k in keys])
+    loader.load(1)
+    assert loader.load_many([1, 2, 3, 2]) == [2, 4, 6, 4]
+    assert calls == [[1], [2, 3]]
+
+
+def test_load_many_large():
+    """Queueing many keys takes linear time."""
+    calls = []
+    loader = Loader(lambda keys: calls.append(keys) or keys)
+    keys = list(range(100000))
+    assert loader.load_many(keys + keys) == keys + keys
+    assert calls == [keys]
+
+
+def test_defer():
+    """Deferred keys are looked up in one batch."""
+    calls = []
+    loader = Loader(lambda keys: calls.append(keys) or [k * 2 for k in keys])
+    values = [loader.defer(k) for k in (1, 2, 3)]
+    assert [value() for value in values] == [2, 4, 6]
+    assert calls == [[1, 2, 3]]
+
+
+def test_max_batch_size():
+    """Batches are split according to max_batch_size."""
+    calls = []
+    loader = Loader(lambda keys: calls.append(keys) or [k * 2 for k in keys],
+                    max_batch_size=2)
+    assert loader.load_many([1, 2, 3]) == [2, 4, 6]
+    assert calls == [[1, 2], [3]]
+
+
+def test_missing():
+    """Keys missing in the returned dictionary raise a KeyError, which is
+    memoized as well."""
+    calls = []
+    loader = Loader(lambda keys: calls.append(keys) or {1: 'a'})
+    assert loader.load(1) == 'a'
+    for i in range(2):
+        try:
+            loader.load(2)
+        except KeyError:
+            pass
+        else:
+            assert False, "Expected an exception!"
+    assert calls == [[1], [2]]
+
+
+def test_prime_clear():
+    """Values can be set and forgotten."""
+    loader = Loader(lambda keys: ['loaded'] * len(keys))
+    loader.prime(1, 'primed')
+    assert loader.load(1) == 'primed'
+    loader.clear(1)
+    assert loader.load(1) == 'loaded'
+    loader.clear()
+    assert len(loader) == 0
+
+
+def test_error():
+    """Exceptions of the batch function are raised and not memoized."""
+    calls = []
+
+    def batch(keys):
+        calls.append(keys)
+        if len(calls) == 1:
+            raise ValueError('down')
+        return keys
+    loader = Loader(batch)
+    try:
+        loader.load(1)
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected an exception!"
+    assert loader.load(1) == 1
+    assert calls == [[1], [1]]
+
+
+def test_load_async():
+    """Keys requested in the same loop iteration are batched."""
+    calls = []
+
+    async def batch(keys):
+        calls.append(keys)
+        return [k * 2 for k in keys]
+
+    async def run():
+        loader = Loader(batch)
+        first = await asyncio.gather(*[loader.load_async(k)
+                                       for k in (1, 2, 1)])
+        second = await loader.load_async(2)
+        return first, second
+    assert asyncio.run(run()) == ([2, 4, 2], 4)
+    assert calls == [[1, 2]]
+
+
+def test_get_loader():
+    """Resources of the same request share the loaders."""
+    app = wsgiservice.get_app(globals())
+    ItemResource.calls = []
+    res = app._handle_request(Request.blank('/items?ids=a,b,c',
+        headers={'Accept': 'application/json'}))
+    print(res)
+    assert res.status_int == 200
+    assert json.loads(res.body) == ['A', 'B', 'C']
+    assert ItemResource.calls == [['a', 'b', 'c']]
+    app._handle_request(Request.blank('/items?ids=a'))
+    assert ItemResource.calls == [['a', 'b', 'c'], ['a']]
+
+
+def test_get_loader_not_found():
+    """Missing keys return a 404."""
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/items/missing'))
+    assert res.status_int == 404
+
+
+@wsgiservice.mount('/items')
+class ItemsResource(wsgiservice.Resource):
+    def GET(self, ids):
+        ids = ids.split(',')
+        self.get_loader(ItemResource).load_many(ids)
+        return [self.get_resource(ItemResource).GET(id) for id in ids]
+
+
+@wsgiservice.mount('/items/{id}')
+class ItemResource(wsgiservice.Resource):
+    NOT_FOUND = (KeyError,)
+    calls = []
+
+    def GET(self, id):
+        return self.get_loader(ItemResource).load(id)
+
+    def load_many(self, ids):
+        ItemResource.calls.append(ids)
+        return dict((id, id.upper()) for id in ids if id != 'missing')
@@ -0,0 +1,287 @@
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.cache import CachePolicy, ResponseCache
+from wsgiservice.limits import AdmissionController
+from wsgiservice.metrics import Metrics
+from wsgiservice.shm import SharedTable
+
+
+def test_collect():
+    """Requests are counted by resource, method and status, the histograms
+    are cumulative."""
+    metrics, path = create_metrics()
+    try:
+        for latency, size in ((0.001, 50), (0.2, 5000), (20, 20000000)):
+            metrics.start('Res')
+            metrics.finish('Res', 'GET', 200, latency, size)
+        metrics.start('Res')
+        metrics.finish('Res', 'POST', 400, 0.001, 10, cache='miss')
+        data = metrics.collect()
+        print(data)
+        assert data['requests'] == [
+            {'resource': 'Res', 'method': 'GET', 'status': 200, 'count': 3},
+            {'resource': 'Res', 'method': 'POST', 'status': 400, 'count': 1}]
+        assert data['in_flight'] == [{'resource': 'Res', 'value': 0}]
+        latency = data['latency'][0]
+        assert latency['method'] == 'GET'
+        assert latency['count'] == 3
+        assert abs(latency['sum'] - 20.201) < 1e-9
+        buckets = dict(latency['buckets'])
+        assert buckets['0.005'] == 1
+        assert buckets['0.25'] == 2
+        assert buckets['10'] == 2
+        assert buckets['+Inf'] == 3
+        size = dict(data['size'][0]['buckets'])
+        assert size['100'] == 1
+        assert size['10000'] == 2
+        assert size['+Inf'] == 3
+        assert data['cache'] == [{'resource': 'Res', 'hit': 0, 'stale': 0,
+                                  'miss': 1, 'hit_ratio': 0.0}]
+    finally:
+        shutil.rmtree(path)
+
+
+def test_shared():
+    """Metrics instances using the same table share the values, like the
+    worker processes of a host."""
+    metrics, path = create_metrics()
+    try:
+        other = Metrics(table=SharedTable('metrics', fields=metrics.fields,
+            slots=Metrics.SLOTS, key_size=128, path=path))
+        metrics.start('Res')
+        metrics.finish('Res', 'GET', 200, 0.1, 100)
+        other.start('Res')
+        other.finish('Res', 'GET', 200, 0.1, 100)
+        other.start('Res')
+        assert metrics.collect()['requests'][0]['count'] == 2
+        assert metrics.collect()['in_flight'][0]['value'] == 1
+    finally:
+        shutil.rmtree(path)
+
+
+def test_in_flight_dead_process():
+    """The requests in flight of processes which died are dropped."""
+    metrics, path = create_metrics()
+    try:
+        process = multiprocessing.Process(target=os.getpid)
+        process.start()
+        process.join()
+        table = metrics.get_table()
+        table.add('in_flight|Res|{0}'.format(process.pid),
+                  [3] + [0] * (metrics.fields - 1))
+        metrics.start('Res')
+        assert metrics.collect()['in_flight'] == [{'resource': 'Res',
+                                                   'value': 1}]
+        assert [key for key, values in table.items()
+                if key.startswith('in_flight')] == [
+            'in_flight|Res|{0}'.format(os.getpid())]
+    finally:
+        shutil.rmtree(path)
+
+
+def test_name():
+    """Metrics need the name of their table, get_app uses the name of the
+    module."""
+    try:
+        Metrics()
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected an exception!"
+    app = wsgiservice.get_app(globals(), add_metrics=True)
+    assert app.METRICS.name == 'test_metrics-metrics'
+    app = wsgiservice.get_app(globals(), add_metrics=True, name='store')
+    assert app.METRICS.name == 'store-metrics'
+
+
+def test_prometheus():
+    """The metrics resource returns the Prometheus text format by
+    default."""
+    app, path = create_app()
+    try:
+        app._handle_request(Request.blank('/measured'))
+        app._handle_request(Request.blank('/measured', method='POST'))
+        res = app._handle_request(Request.blank('/_internal/metrics'))
+        print(res.body.decode())
+        assert res.status_int == 200
+        assert res.headers['Content-Type'].startswith('text/plain')
+        lines = res.body.decode().splitlines()
+        assert '# TYPE wsgiservice_requests_total counter' in lines
+        assert 'wsgiservice_requests_total{resource="MeasuredResource",' \
+            'method="GET",status="200"} 1' in lines
+        assert 'wsgiservice_requests_total{resource="MeasuredResource",' \
+            'method="POST",status="405"} 1' in lines
+        assert 'wsgiservice_request_duration_seconds_bucket{resource=' \
+            '"MeasuredResource",method="GET",le="+Inf"} 1' in lines
+        assert 'wsgiservice_request_duration_seconds_count{resource=' \
+            '"MeasuredResource",method="GET"} 1' in lines
+        assert '# TYPE wsgiservice_response_size_bytes histogram' in lines
+        # The request for the metrics is still in flight
+        assert 'wsgiservice_requests_in_flight{resource="MetricsResource"}' \
+            ' 1' in lines
+    finally:
+        shutil.rmtree(path)
+
+
+def test_json():
+    """The metrics are available as JSON, including the cache hit ratio."""
+    app, path = create_app()
+    app.RESPONSE_CACHE = ResponseCache()
+    try:
+        for i in range(4):
+            app._handle_request(Request.blank('/cached'))
+        res = app._handle_request(Request.blank('/_internal/metrics.json'))
+        assert res.status_int == 200
+        data = json.loads(res.body)
+        print(data)
+        assert data['cache'] == [{'resource': 'CachedResource', 'hit': 3,
+                                  'stale': 0, 'miss': 1, 'hit_ratio': 0.75}]
+    finally:
+        shutil.rmtree(path)
+
+
+def test_limiters():
+    """The state of the admission controller and the bulkheads and their
+    rejected requests are exported."""
+    app, path = create_app()
+    app.ADMISSION_CONTROLLER = AdmissionController(max_in_flight=2,
+                                                   max_queue=0)
+    try:
+        app.ADMISSION_CONTROLLER.acquire()
+        app.get_bulkhead(BulkheadResource).acquire()
+        res = app._handle_request(Request.blank('/bulkhead'))
+        assert res.status_int == 503
+        app.ADMISSION_CONTROLLER.acquire()
+        res = app._handle_request(Request.blank('/measured'))
+        assert res.status_int == 503
+        res = app._handle_request(Request.blank('/_internal/metrics.json'))
+        data = json.loads(res.body)
+        print(data)
+        assert data['admission'] == [{'limit': 2, 'in_flight': 2,
+                                      'waiting': 0, 'rejected': 1}]
+        assert data['bulkheads'] == [{'resource': 'BulkheadResource',
+            'limit': 1, 'in_flight': 1, 'waiting': 0, 'rejected': 1}]
+        res = app._handle_request(Request.blank('/_internal/metrics'))
+        lines = res.body.decode().splitlines()
+        print(lines)
+        assert '# TYPE wsgiservice_admission_limit gauge' in lines
+        assert 'wsgiservice_admission_in_flight{} 2' in lines
+        assert 'wsgiservice_admission_rejected_total{} 1' in lines
+        assert 'wsgiservice_bulkhead_limit{resource="BulkheadResource"} 1' \
+            in lines
+        assert 'wsgiservice_bulkhead_rejected_total{resource=' \
+            '"BulkheadResource"} 1' in lines
+    finally:
+        shutil.rmtree(path)
+
+
+def test_limiters_interval():
+    """The state of the limiters is written at most once per interval,
+    unless it's forced."""
+    metrics, path = create_metrics()
+    try:
+        stats = {'limit': 10, 'in_flight': 1, 'waiting': 0}
+        metrics.update_limiters(stats, {})
+        stats['in_flight'] = 5
+        metrics.update_limiters(stats, {})
+        assert metrics.collect()['admission'][0]['in_flight'] == 1
+        metrics.update_limiters(stats, {}, force=True)
+        assert metrics.collect()['admission'][0]['in_flight'] == 5
+    finally:
+        shutil.rmtree(path)
+
+
+def test_coalesced():
+    """Coalesced requests are counted by resource."""
+    app, path = create_app()
+    app.COALESCE_REQUESTS = True
+    BlockingResource.event = threading.Event()
+    try:
+        threads = [threading.Thread(target=app._handle_request,
+                                    args=(Request.blank('/blocking'),))
+                   for i in range(3)]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        BlockingResource.event.set()
+        for t in threads:
+            t.join()
+        assert app.coalesced_requests == 2
+        res = app._handle_request(Request.blank('/_internal/metrics.json'))
+        data = json.loads(res.body)
+        print(data)
+        assert data['coalesced'] == [{'resource': 'BlockingResource',
+                                      'count': 2}]
+        res = app._handle_request(Request.blank('/_internal/metrics'))
+        assert 'wsgiservice_coalesced_requests_total{resource=' \
+            '"BlockingResource"} 2' in res.body.decode().splitlines()
+    finally:
+        BlockingResource.event = None
+        shutil.rmtree(path)
+
+
+def test_disabled():
+    """Without metrics the resource returns a 404."""
+    app = wsgiservice.get_app(globals(), add_metrics=True)
+    app.METRICS = None
+    res = app._handle_request(Request.blank('/_internal/metrics'))
+    assert res.status_int == 404
+
+
+def create_metrics():
+    """Returns metrics using a table in a new temporary directory and the
+    directory."""
+    path = tempfile.mkdtemp()
+    fields = Metrics(name='test').fields
+    table = SharedTable('metrics', fields=fields, slots=Metrics.SLOTS,
+                        key_size=128, path=path)
+    return Metrics(table=table), path
+
+
+def create_app():
+    """Returns an application with metrics and the directory of their
+    table."""
+    app = wsgiservice.get_app(globals(), add_metrics=True)
+    app.METRICS, path = create_metrics()
+    return app, path
+
+
+@wsgiservice.mount('/measured')
+class MeasuredResource(wsgiservice.Resource):
+    def GET(self):
+        return {'measured': True}
+
+
+@wsgiservice.mount('/cached')
+class CachedResource(wsgiservice.Resource):
+    CACHE_POLICY = CachePolicy(max_age=60, s_maxage=60)
+
+    def GET(self):
+        return {'cached': True}
+
+
+@wsgiservice.mount('/bulkhead')
+class BulkheadResource(wsgiservice.Resource):
+    BULKHEAD = 1
+    BULKHEAD_QUEUE = 0
+
+    def GET(self):
+        return 'bulkhead'
+
+
+@wsgiservice.mount('/blocking')
+class BlockingResource(wsgiservice.Resource):
+    event = None
+
+    def GET(self):
+        self.event.wait(1)
+        return 'blocking'
@@ -0,0 +1,88 @@
+import io
+import os
+import shutil
+import tempfile
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.profiling import RequestProfiler, get_hot_spots, load, main
+
+
+def test_header():
+    """Requests with the internal token in the header are profiled."""
+    path = tempfile.mkdtemp()
+    try:
+        app = wsgiservice.get_app(globals())
+        app.INTERNAL_TOKEN = 'secret'
+        app.REQUEST_PROFILER = RequestProfiler(path)
+        for token in ('wrong', 'secret'):
+            res = app._handle_request(Request.blank('/profiled', headers={
+                'X-Profile': token, 'X-Request-Id': 'abc/1'}))
+            assert res.status_int == 200
+        print(os.listdir(path))
+        assert os.listdir(path) == ['ProfiledResource.abc1.prof']
+        count, stats = load([path])['ProfiledResource']
+        assert count == 1
+        functions = [row['function'] for row in get_hot_spots(stats, 1000)]
+        assert [f for f in functions if f.endswith('(compute)')]
+    finally:
+        shutil.rmtree(path)
+
+
+def test_sample_rate():
+    """Requests are profiled at random with the sample rate, requests
+    without ID get a random one."""
+    path = os.path.join(tempfile.mkdtemp(), 'profiles')
+    try:
+        values = iter([0.5, 0.05])
+        app = wsgiservice.get_app(globals())
+        app.REQUEST_PROFILER = RequestProfiler(path, sample_rate=0.1,
+                                               random=lambda: next(values))
+        for i in range(2):
+            app._handle_request(Request.blank('/profiled', headers={
+                'X-Profile': 'secret'}))
+        names = os.listdir(path)
+        print(names)
+        assert len(names) == 1
+        assert names[0].startswith('ProfiledResource.')
+        assert len(names[0]) == len('ProfiledResource..prof') + 32
+    finally:
+        shutil.rmtree(os.path.dirname(path))
+
+
+def test_main():
+    """The command line interface aggregates the profiles by resource."""
+    path = tempfile.mkdtemp()
+    try:
+        app = wsgiservice.get_app(globals())
+        app.REQUEST_PROFILER = RequestProfiler(path, sample_rate=1)
+        for i in range(3):
+            app._handle_request(Request.blank('/profiled'))
+        app._handle_request(Request.blank('/_internal/help'))
+        output = io.StringIO()
+        assert main([path, '--top', '5', '--sort', 'cumtime'], output) == 0
+        print(output.getvalue())
+        lines = output.getvalue().splitlines()
+        assert lines[0].startswith('ProfiledResource: 3 requests, ')
+        assert lines[1].split() == ['calls', 'tottime', 'cumtime',
+                                    'function']
+        assert len(lines) == 2 * 8
+        assert lines[8].startswith('Help: 1 requests, ')
+        output = io.StringIO()
+        assert main([path, '--resource', 'Help'], output) == 0
+        assert output.getvalue().startswith('Help: ')
+        assert main([path, '--resource', 'Missing'], io.StringIO()) == 1
+    finally:
+        shutil.rmtree(path)
+
+
+def compute(rounds):
+    """Some work to find in the profile."""
+    return sum(i * i for i in range(rounds))
+
+
+@wsgiservice.mount('/profiled')
+class ProfiledResource(wsgiservice.Resource):
+    def GET(self):
+        return {'value': compute(200000)}
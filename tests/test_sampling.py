@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.sampling import SamplingProfiler
+
+
+def test_sample():
+    """Only the threads handling a request are sampled, tagged with the
+    resource and the method."""
+    profiler = SamplingProfiler()
+    profiler.sample()
+    assert profiler.get_samples() == []
+    profiler.enter('Res', 'GET')
+    try:
+        profiler.sample()
+        profiler.sample()
+    finally:
+        profiler.exit()
+        profiler.stop()
+    profiler.sample()
+    samples = profiler.get_samples()
+    assert len(samples) == 2
+    timestamp, resource, method, stack = samples[0]
+    assert (resource, method) == ('Res', 'GET')
+    assert stack[-1] == 'wsgiservice.sampling.SamplingProfiler.sample'
+    assert stack[-2] == 'test_sampling.test_sample'
+
+
+def test_collapsed():
+    """The samples are aggregated into collapsed stacks and the functions
+    with the most samples."""
+    now = [1000]
+    profiler = SamplingProfiler(currtime=lambda: now[0])
+    profiler._samples.extend([
+        (900, 'Res', 'GET', ('main', 'old')),
+        (1000, 'Res', 'GET', ('main', 'load', 'query')),
+        (1000, 'Res', 'GET', ('main', 'load', 'query')),
+        (1000, 'Res', 'GET', ('main', 'render')),
+        (1000, 'Other', 'POST', ('main', 'load')),
+    ])
+    collapsed = profiler.get_collapsed(seconds=60)
+    print(collapsed)
+    assert collapsed.splitlines() == [
+        'Res;GET;main;load;query 2',
+        'Other;POST;main;load 1',
+        'Res;GET;main;render 1',
+    ]
+    assert len(profiler.get_collapsed().splitlines()) == 4
+    top = profiler.get_top(3, seconds=60)
+    print(top)
+    assert top == [{'function': 'query', 'self': 2, 'total': 2},
+                   {'function': 'load', 'self': 1, 'total': 3},
+                   {'function': 'render', 'self': 1, 'total': 1}]
+
+
+def test_background():
+    """Requests start the sampling thread, which samples them while they
+    are running."""
+    app = wsgiservice.get_app(globals(), add_profiler=True)
+    app.PROFILER = SamplingProfiler(interval=0.001)
+    try:
+        for i in range(3):
+            res = app._handle_request(Request.blank('/sampled'))
+            assert res.status_int == 200
+    finally:
+        app.PROFILER.stop()
+    samples = app.PROFILER.get_samples()
+    print(len(samples))
+    assert samples
+    assert all(sample[1:3] == ('SampledResource', 'GET')
+               for sample in samples)
+    assert not app.PROFILER._active
+    assert not [thread for thread in threading.enumerate()
+                if thread.name == 'wsgiservice-profiler']
+
+
+def test_background_error():
+    """Errors of the sampling thread are reported and it keeps running."""
+    profiler = FailingProfiler(interval=0.001)
+    profiler.start()
+    try:
+        for i in range(100):
+            if profiler.calls > 2:
+                break
+            time.sleep(0.01)
+        assert profiler.calls > 2
+        assert profiler._thread.is_alive()
+    finally:
+        profiler.stop()
+
+
+def test_resource():
+    """The profile resource returns collapsed stacks and JSON."""
+    app = wsgiservice.get_app(globals(), add_profiler=True)
+    app.INTERNAL_TOKEN = 'secret'
+    app.PROFILER._samples.append((time.time(), 'Res', 'GET', ('main',)))
+    headers = {'X-Internal-Token': 'secret'}
+    res = app._handle_request(Request.blank('/_internal/profile',
+                                            headers=headers))
+    print(res)
+    assert res.status_int == 200
+    assert res.headers['Content-Type'].startswith('text/plain')
+    assert res.body == b'Res;GET;main 1\n'
+    res = app._handle_request(Request.blank(
+        '/_internal/profile.json?seconds=10&top=5', headers=headers))
+    assert res.status_int == 200
+    data = json.loads(res.body)
+    print(data)
+    assert data['samples'] == 1
+    assert data['seconds'] == 10
+    assert data['stacks'] == [{'stack': 'Res;GET;main', 'count': 1}]
+    assert data['top'] == [{'function': 'main', 'self': 1, 'total': 1}]
+    res = app._handle_request(Request.blank(
+        '/_internal/profile?seconds=x', headers=headers))
+    assert res.status_int == 400
+    app.PROFILER.stop()
+
+
+def test_internal_token():
+    """The profile resource requires the internal token."""
+    app = wsgiservice.get_app(globals(), add_profiler=True)
+    res = app._handle_request(Request.blank('/_internal/profile.json',
+        headers={'X-Internal-Token': ''}))
+    assert res.status_int == 403
+    app.INTERNAL_TOKEN = 'secret'
+    for token in (None, 'wrong'):
+        headers = {'X-Internal-Token': token} if token else {}
+        res = app._handle_request(Request.blank('/_internal/profile.json',
+                                                headers=headers))
+        print(res)
+        assert res.status_int == 403
+        assert json.loads(res.body) == {'error': 'Invalid internal token.'}
+    app.PROFILER.stop()
+    app.PROFILER = None
+    res = app._handle_request(Request.blank('/_internal/profile',
+        headers={'X-Internal-Token': 'secret'}))
+    assert res.status_int == 404
+
+
+@wsgiservice.mount('/sampled')
+class SampledResource(wsgiservice.Resource):
+    def GET(self):
+        time.sleep(0.02)
+        return {'sampled': True}
+
+
+class FailingProfiler(SamplingProfiler):
+    """Profiler whose first sample fails."""
+    calls = 0
+
+    def sample(self):
+        self.calls += 1
+        if self.calls == 1:
+            raise ValueError('sample failed')
@@ -0,0 +1,133 @@
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
+
+from wsgiservice.shm import SharedTable
+
+
+def test_update():
+    """Values are stored per key."""
+    table, path = create_table()
+    try:
+        assert table.get('a') is None
+        assert table.update('a', lambda values: ((1, 2), 'done')) == 'done'
+        assert table.get('a') == (1.0, 2.0)
+        assert table.add('a', (1, 1)) == (2.0, 3.0)
+        assert table.add('b', (1, 0)) == (1.0, 0.0)
+        assert sorted(table.items()) == [('a', (2.0, 3.0)), ('b', (1.0, 0.0))]
+        table.delete('b')
+        table.delete('c')
+        assert table.items() == [('a', (2.0, 3.0))]
+        table.clear()
+        assert table.items() == []
+    finally:
+        table.close()
+        shutil.rmtree(path)
+
+
+def test_long_keys():
+    """Long keys are hashed."""
+    table, path = create_table(key_size=32)
+    try:
+        table.add('x' * 100, (1, 1))
+        assert table.get('x' * 100) == (1.0, 1.0)
+        assert table.get('x' * 99) is None
+    finally:
+        table.close()
+        shutil.rmtree(path)
+
+
+def test_eviction():
+    """The least recently written key is evicted from full buckets."""
+    table, path = create_table(slots=1)
+    try:
+        assert table.buckets == 1
+        for i in range(table.BUCKET_SIZE + 1):
+            table.add(str(i), (i, 0))
+        assert table.get('0') is None
+        assert table.get('1') == (1.0, 0.0)
+        assert len(table.items()) == table.BUCKET_SIZE
+    finally:
+        table.close()
+        shutil.rmtree(path)
+
+
+def test_shared():
+    """Tables with the same name share their data, also across processes."""
+    table, path = create_table()
+    try:
+        other = SharedTable('test', path=path)
+        other.add('a', (1, 0))
+        assert table.get('a') == (1.0, 0.0)
+        other.close()
+        process = multiprocessing.get_context('fork').Process(
+            target=add_many, args=(path, 100))
+        process.start()
+        add_many(path, 100)
+        process.join()
+        assert table.get('a') == (201.0, 0.0)
+    finally:
+        table.close()
+        shutil.rmtree(path)
+
+
+def test_layout_mismatch():
+    """Opening a table with a different layout fails."""
+    table, path = create_table()
+    try:
+        SharedTable('test', fields=3, path=path)
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected an exception!"
+    finally:
+        table.close()
+        shutil.rmtree(path)
+
+
+def test_threads():
+    """Updates are atomic across threads, also with several instances of
+    the same table in the process."""
+    table, path = create_table()
+    try:
+        tables = [SharedTable('test', path=path) for i in range(4)]
+        threads = [threading.Thread(target=increment_slowly, args=(t, 20))
+                   for t in tables + [table]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert table.get('a') == (100.0, 0.0)
+        for other in tables:
+            other.close()
+        # Closing the other instances keeps the file open for this one
+        assert table.add('a', (1, 0)) == (101.0, 0.0)
+    finally:
+        table.close()
+        shutil.rmtree(path)
+
+
+def create_table(**kwargs):
+    """Returns a new table in a temporary directory and the directory."""
+    path = tempfile.mkdtemp()
+    return SharedTable('test', path=path, **kwargs), path
+
+
+def increment_slowly(table, count):
+    """Increments the first value of the key in a way which loses updates
+    if the table isn't locked."""
+    def increment(values):
+        values = values or (0.0, 0.0)
+        time.sleep(0.001)
+        return (values[0] + 1, values[1]), None
+    for i in range(count):
+        table.update('a', increment)
+
+
+def add_many(path, count):
+    table = SharedTable('test', path=path)
+    for i in range(count):
+        table.add('a', (1, 0))
+    table.close()
@@ -0,0 +1,141 @@
+import json
+import sys
+import threading
+
+from webob import Request
+
+import wsgiservice
+
+
+def test_validate_subclass():
+    """Validations of a subclass don't change the ones of the base class."""
+    base = BaseResource._validations
+    assert list(base) == ['id']
+    assert sorted(ChildResource._validations) == ['id', 'name']
+    assert base['id'] is ChildResource._validations['id']
+
+
+def test_validate_wrapped_method():
+    """Validations of a wrapped method don't change the ones of the original
+    method."""
+    def GET(self, id):
+        pass
+    inner = wsgiservice.validate('id')(GET)
+    outer = wsgiservice.validate('name')(wsgiservice.memoize()(inner))
+    assert list(inner._validations) == ['id']
+    assert sorted(outer._validations) == ['id', 'name']
+
+
+def test_stress():
+    """One application serves many threads at once, every request gets its
+    own response."""
+    app = wsgiservice.get_app(globals())
+    MemoizedResource.calls = {}
+    errors = []
+
+    def client(n):
+        for i in range(50):
+            id = (n * 50 + i) % 20
+            try:
+                for path, expected in (
+                        ('/echo/{0}?name=t{1}'.format(id, n),
+                         {'id': id, 'name': 't{0}'.format(n)}),
+                        ('/memoized/{0}'.format(id), {'id': id}),
+                        ('/fan-out/{0}'.format(id),
+                         [{'id': id}, {'id': id + 1}])):
+                    res = app._handle_request(Request.blank(path,
+                        headers={'Accept': 'application/json'}))
+                    assert res.status_int == 200, res
+                    assert json.loads(res.body) == expected, (path, res.body)
+                res = app._handle_request(Request.blank('/echo/x'))
+                assert res.status_int == 400, res
+            except Exception as e:
+                errors.append(e)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=client, args=(n,))
+                   for n in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+    print(errors[:5])
+    assert not errors
+    # Nearly all of the 2400 calls are served from the memoize cache
+    print(MemoizedResource.calls)
+    assert sorted(MemoizedResource.calls) == list(range(21))
+    assert sum(MemoizedResource.calls.values()) < 100
+    stats = app.get_bulkheads()['EchoResource']
+    assert stats['admitted'] == 16 * 50 * 2
+    assert stats['in_flight'] == 0
+
+
+def test_stress_invalidate():
+    """Memoized values can be invalidated while requests are served."""
+    app = wsgiservice.get_app(globals())
+    errors = []
+
+    def client():
+        try:
+            for i in range(200):
+                res = app._handle_request(Request.blank('/memoized/1',
+                    headers={'Accept': 'application/json'}))
+                assert json.loads(res.body) == {'id': 1}
+        except Exception as e:
+            errors.append(e)
+
+    def invalidate():
+        for i in range(200):
+            MemoizedResource.invalidate_memoized()
+
+    threads = [threading.Thread(target=client) for i in range(8)]
+    threads.append(threading.Thread(target=invalidate))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+
+
+@wsgiservice.validate('id')
+class BaseResource(wsgiservice.Resource):
+    pass
+
+
+@wsgiservice.validate('name')
+class ChildResource(BaseResource):
+    pass
+
+
+@wsgiservice.mount('/echo/{id}')
+@wsgiservice.validate('id', re='^[0-9]+$', convert=int)
+class EchoResource(wsgiservice.Resource):
+    BULKHEAD = 100
+
+    def GET(self, id, name):
+        return {'id': id, 'name': name}
+
+
+@wsgiservice.mount('/memoized/{id}')
+class MemoizedResource(wsgiservice.Resource):
+    calls = {}
+    lock = threading.Lock()
+
+    @wsgiservice.validate('id', convert=int)
+    @wsgiservice.memoize()
+    def GET(self, id):
+        with MemoizedResource.lock:
+            MemoizedResource.calls[id] = MemoizedResource.calls.get(id, 0) + 1
+        return {'id': id}
+
+
+@wsgiservice.mount('/fan-out/{id}')
+class FanOutResource(wsgiservice.Resource):
+    @wsgiservice.validate('id', convert=int)
+    def GET(self, id):
+        return self.fan_out([(MemoizedResource, 'GET', {'id': id}),
+                             (MemoizedResource, 'GET', {'id': id + 1})])
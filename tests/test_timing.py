@@ -0,0 +1,117 @@
+import re
+import time
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.timing import RequestTiming, TimingStats
+
+
+def test_request_timing():
+    """Each mark ends a phase which started with the previous one."""
+    timing = RequestTiming()
+    time.sleep(0.01)
+    timing.mark('first')
+    timing.mark('second')
+    timing.finish()
+    timing.mark('ignored')
+    print(timing.phases)
+    assert [name for name, duration in timing.phases] == ['first', 'second']
+    assert timing.get('first') >= 0.01
+    assert timing.get('second') < 0.01
+    assert timing.get('ignored') is None
+    assert timing.total >= timing.get('first') + timing.get('second')
+    assert re.match(r'^first;dur=\d+\.\d{3}, second;dur=\d+\.\d{3}, '
+                    r'total;dur=\d+\.\d{3}$', timing.get_header())
+
+
+def test_current_phase():
+    """The current phase is the one after the last recorded phase."""
+    timing = RequestTiming()
+    assert timing.get_current_phase() == 'routing'
+    timing.mark('routing')
+    timing.mark('admission')
+    assert timing.get_current_phase() == 'conditions'
+    timing.mark('headers')
+    assert timing.get_current_phase() is None
+    timing = RequestTiming()
+    timing.finish()
+    assert timing.get_current_phase() is None
+
+
+def test_timing_stats():
+    """The phases are aggregated per resource."""
+    stats = TimingStats()
+    for duration in (0.1, 0.3):
+        timing = RequestTiming(start=0)
+        timing.phases = [('method', duration)]
+        timing.total = duration * 2
+        stats.add('Resource', timing)
+    result = stats.get_stats()['Resource']
+    assert result['method']['count'] == 2
+    assert abs(result['method']['mean'] - 0.2) < 1e-9
+    assert result['method']['max'] == 0.3
+    assert result['total']['max'] == 0.6
+    stats.clear()
+    assert stats.get_stats() == {}
+
+
+def test_timing_disabled():
+    """Without TIMING no timing is recorded."""
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/timed'))
+    assert res.status_int == 200
+    assert 'Server-Timing' not in res.headers
+    assert TimedResource.timing is None
+    assert app.timing_stats.get_stats() == {}
+
+
+def test_timing():
+    """With TIMING the phases are recorded and aggregated, the method can
+    read the timing of the phases before it."""
+    app = wsgiservice.get_app(globals())
+    app.TIMING = True
+    res = app._handle_request(Request.blank('/timed'))
+    assert res.status_int == 200
+    assert 'Server-Timing' not in res.headers
+    timing = TimedResource.timing
+    assert [name for name, duration in timing.phases] == ['routing',
+        'admission', 'conditions', 'method', 'serialization', 'headers']
+    assert TimedResource.seen == ['routing', 'admission', 'conditions']
+    assert timing.get('method') >= 0.01
+    stats = app.timing_stats.get_stats()
+    print(stats)
+    assert stats['TimedResource']['method']['count'] == 1
+    assert stats['TimedResource']['total']['count'] == 1
+
+
+def test_server_timing():
+    """SERVER_TIMING adds the header, skipped phases are missing."""
+    app = wsgiservice.get_app(globals())
+    app.SERVER_TIMING = True
+    res = app._handle_request(Request.blank('/timed'))
+    print(res.headers['Server-Timing'])
+    assert res.headers['Server-Timing'].startswith('routing;dur=')
+    assert 'method;dur=' in res.headers['Server-Timing']
+    res = app._handle_request(Request.blank('/timed',
+        headers={'If-None-Match': '"timed_xml"'}))
+    print(res)
+    assert res.status_int == 304
+    assert 'method;dur=' not in res.headers['Server-Timing']
+    assert 'total;dur=' in res.headers['Server-Timing']
+
+
+@wsgiservice.mount('/timed')
+class TimedResource(wsgiservice.Resource):
+    timing = None
+    seen = None
+
+    def get_etag(self):
+        return 'timed'
+
+    def GET(self):
+        TimedResource.timing = timing = self.get_timing()
+        if timing is not None:
+            TimedResource.seen = [name for name, duration in timing.phases]
+        time.sleep(0.01)
+        return {'timed': True}
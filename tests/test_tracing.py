@@ -0,0 +1,123 @@
+import json
+import os
+import shutil
+import tempfile
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.tracing import Tracer
+
+
+def test_trace():
+    """Traced requests have spans for the request, its phases, calls of
+    other resources and custom spans."""
+    path = tempfile.mkdtemp()
+    try:
+        app = wsgiservice.get_app(globals())
+        app.TRACER = Tracer(path)
+        res = app._handle_request(Request.blank('/traced.json?id=5',
+            headers={'X-Request-Id': 'abc'}))
+        print(res)
+        assert res.status_int == 200
+        assert res.headers['X-Request-Id'] == 'abc'
+        assert 'Server-Timing' not in res.headers
+        assert json.loads(res.body) == {'direct': '1', 'called': '5',
+                                        'fanned': ['2', '3']}
+        app.TRACER.close()
+        events = read_events(path)
+        print(events)
+        names = [event['name'] for event in events]
+        assert names.count('Sub.GET') == 4
+        assert names[-7:] == ['routing', 'admission', 'conditions', 'method',
+                              'serialization', 'headers',
+                              'GET /traced.json']
+        assert 'work' in names
+        request = events[-1]
+        assert request['cat'] == 'request'
+        assert request['args'] == {'request_id': 'abc',
+                                   'resource': 'TracedResource',
+                                   'status': 200}
+        method = events[-4]
+        for event in events[:-7]:
+            assert event['ts'] >= method['ts']
+            assert event['ts'] + event['dur'] <= \
+                method['ts'] + method['dur'] + 1
+        assert all(event['ph'] == 'X' for event in events)
+        assert all(event['pid'] == os.getpid() for event in events)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_sample_rate():
+    """Only the sampled requests are traced, they get a request ID."""
+    path = tempfile.mkdtemp()
+    try:
+        values = iter([0.5, 0.05])
+        app = wsgiservice.get_app(globals())
+        app.TRACER = Tracer(path, sample_rate=0.1,
+                            random=lambda: next(values))
+        res = app._handle_request(Request.blank('/traced?id=5'))
+        assert 'X-Request-Id' not in res.headers
+        res = app._handle_request(Request.blank('/traced?id=5'))
+        request_id = res.headers['X-Request-Id']
+        assert len(request_id) == 32
+        app.TRACER.close()
+        events = read_events(path)
+        assert events[-1]['args']['request_id'] == request_id
+        assert len([e for e in events if e['cat'] == 'request']) == 1
+    finally:
+        shutil.rmtree(path)
+
+
+def test_rotate():
+    """Full files are rotated, keeping the configured number of backups."""
+    path = tempfile.mkdtemp()
+    try:
+        tracer = Tracer(path, max_bytes=1000, backup_count=2)
+        event = {'name': 'x' * 300}
+        for i in range(10):
+            tracer.write([event])
+        tracer.close()
+        filename = 'trace.{0}.json'.format(os.getpid())
+        assert sorted(os.listdir(path)) == [filename, filename + '.1',
+                                            filename + '.2']
+        for name in os.listdir(path):
+            events = read_events(path, name)
+            assert 1 <= len(events) <= 3
+    finally:
+        shutil.rmtree(path)
+
+
+def test_untraced():
+    """Without a tracer custom spans do nothing."""
+    app = wsgiservice.get_app(globals())
+    res = app._handle_request(Request.blank('/traced?id=5'))
+    assert res.status_int == 200
+    assert 'X-Request-Id' not in res.headers
+
+
+def read_events(path, name=None):
+    """Returns the events of a trace file."""
+    name = name or 'trace.{0}.json'.format(os.getpid())
+    with open(os.path.join(path, name)) as f:
+        data = f.read()
+    assert data.startswith('[\n')
+    return json.loads(data.rstrip().rstrip(',') + ']')
+
+
+@wsgiservice.mount('/traced')
+class TracedResource(wsgiservice.Resource):
+    def GET(self):
+        with self.trace('work'):
+            direct = self.get_resource(Sub).GET('1')
+        called = self.get_resource(Sub).call_method('GET')
+        fanned = self.fan_out([(Sub, 'GET', {'id': '2'}),
+                               (Sub, 'GET', {'id': '3'})])
+        return {'direct': direct, 'called': called, 'fanned': fanned}
+
+
+class Sub(wsgiservice.Resource):
+    @wsgiservice.validate('id', re='[0-9]+')
+    def GET(self, id):
+        return id
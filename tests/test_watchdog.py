@@ -0,0 +1,139 @@
+import json
+import logging
+import threading
+import time
+
+from webob import Request
+
+import wsgiservice
+from wsgiservice.watchdog import Watchdog
+
+
+def test_check():
+    """Requests exceeding the threshold are reported once, with the stack
+    of their thread and the current phase."""
+    now = [1000]
+    watchdog = Watchdog(threshold=1, max_reports=2,
+                        currtime=lambda: now[0])
+    app = wsgiservice.get_app(globals())
+    app.TIMING = True
+    request = Request.blank('/slow?a=1', headers={'X-Request-Id': 'abc'})
+    timing = app.start_timing(request)
+    instance = app._get_instance(request)
+    timing.mark('routing')
+    timing.mark('admission')
+    timing.mark('conditions')
+    watchdog.enter(instance)
+    try:
+        watchdog.check()
+        assert watchdog.get_reports() == []
+        now[0] += 1
+        watchdog.check()
+        watchdog.check()
+    finally:
+        watchdog.exit()
+        watchdog.stop()
+    reports = watchdog.get_reports()
+    print(reports)
+    assert len(reports) == 1
+    report = reports[0]
+    assert report['resource'] == 'SlowResource'
+    assert report['method'] == 'GET'
+    assert report['path'] == '/slow'
+    assert report['query'] == 'a=1'
+    assert report['request_id'] == 'abc'
+    assert report['elapsed'] == 1
+    assert report['phase'] == 'method'
+    assert report['stack'][-1].endswith(' in check')
+    assert report['stack'][-2].endswith(' in test_check')
+
+
+def test_threshold():
+    """Resources can have their own threshold or disable the reports."""
+    watchdog = Watchdog(threshold=2)
+    assert watchdog.get_threshold(wsgiservice.Resource) == 2
+    assert watchdog.get_threshold(SlowResource) == 0.05
+    assert watchdog.get_threshold(FastResource) is None
+
+
+def test_application():
+    """The watchdog thread reports slow requests while they are running."""
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    log = logging.getLogger('wsgiservice.watchdog')
+    log.addHandler(handler)
+    app = wsgiservice.get_app(globals(), add_watchdog=True)
+    app.WATCHDOG = Watchdog(interval=0.01)
+    app.INTERNAL_TOKEN = 'secret'
+    try:
+        res = app._handle_request(Request.blank('/slow'))
+        assert res.status_int == 200
+        app._handle_request(Request.blank('/fast'))
+    finally:
+        app.WATCHDOG.stop()
+        log.removeHandler(handler)
+    assert not app.WATCHDOG._active
+    assert not [thread for thread in threading.enumerate()
+                if thread.name == 'wsgiservice-watchdog']
+    print([record.getMessage() for record in records])
+    assert len(records) == 1
+    assert records[0].levelno == logging.WARNING
+    assert records[0].getMessage().startswith(
+        'Slow request to SlowResource: GET /slow running for ')
+    res = app._handle_request(Request.blank('/_internal/slow.json',
+        headers={'X-Internal-Token': 'secret'}))
+    assert res.status_int == 200
+    data = json.loads(res.body)
+    print(data)
+    assert data['threshold'] == 1.0
+    assert len(data['reports']) == 1
+    report = data['reports'][0]
+    assert report['resource'] == 'SlowResource'
+    assert report['phase'] is None
+    assert [frame for frame in report['stack'] if frame.endswith(' in GET')]
+    res = app._handle_request(Request.blank('/_internal/slow'))
+    assert res.status_int == 403
+
+
+def test_background_error():
+    """Errors of the watchdog thread are reported and it keeps running."""
+    watchdog = FailingWatchdog(interval=0.001)
+    watchdog.start()
+    try:
+        for i in range(100):
+            if watchdog.calls > 2:
+                break
+            time.sleep(0.01)
+        assert watchdog.calls > 2
+        assert watchdog._thread.is_alive()
+    finally:
+        watchdog.stop()
+
+
+class FailingWatchdog(Watchdog):
+    """Watchdog whose first check fails."""
+    calls = 0
+
+    def check(self):
+        self.calls += 1
+        if self.calls == 1:
+            raise ValueError('check failed')
+
+
+@wsgiservice.mount('/slow')
+class SlowResource(wsgiservice.Resource):
+    SLOW_REQUEST_THRESHOLD = 0.05
+
+    def GET(self):
+        time.sleep(0.2)
+        return {'slow': True}
+
+
+@wsgiservice.mount('/fast')
+class FastResource(wsgiservice.Resource):
+    SLOW_REQUEST_THRESHOLD = False
+
+    def GET(self):
+        time.sleep(0.1)
+        return {'fast': True}
@@ -5,7 +5,8 @@ applications.
 __version__ = "1.0.0"
 
 from .application import get_app
-from .decorators import mount, validate, expires
+from .decorators import (mount, validate, expires, cache_policy, memoize,
+    offload, cpu_bound)
 from . import exceptions
 from .resource import Resource
 from . import routing
@@ -0,0 +1,227 @@
+"""Structured access log written in the background.
+
+An :class:`AccessLog` set as
+:attr:`wsgiservice.application.Application.ACCESS_LOG` logs every request
+after its response is ready, so the record contains the status code, the
+response size and the latency. Records are written as JSON lines by a
+background thread. The thread serving the request only decides whether the
+request is sampled and puts a tuple on a queue, all the fields are computed
+by the writer thread. When the queue is full records are dropped instead of
+slowing down the requests.
+
+Sampling is configured per status class, for example to log 1% of the
+successful requests but all the errors::
+
+    app.ACCESS_LOG = AccessLog('/var/log/service/access.log',
+                               sample_rates={2: 0.01, 3: 0.01})
+
+Example record (on one line)::
+
+    {"time": "2020-01-20T10:15:00.123Z", "method": "GET",
+     "path": "/documents/1", "query": "", "status": 200, "size": 31,
+     "latency_ms": 1.234, "resource": "Document", "remote_addr": "10.0.0.1",
+     "request_id": "f3a9...", "sample_rate": 0.01}
+"""
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+
+from wsgiservice.concurrency import BackgroundThread
+from wsgiservice.errors import get_reporter
+
+logger = logging.getLogger(__name__)
+
+#: Put on the queue to stop the writer thread.
+_STOP = object()
+
+
+class AccessLog(object):
+    """Writes access log records as JSON lines in a background thread.
+
+    :param output: File name or file-like object to write the records to.
+                   Files are opened in append mode. Defaults to
+                   :data:`sys.stderr`.
+    :type output: str or file
+    :param sample_rates: Dictionary mapping status classes (2 for 2xx and so
+                         on) to the fraction of requests to log. Classes
+                         which are missing are logged completely.
+    :type sample_rates: dict
+    :param headers: Request headers to include in the records.
+    :type headers: list
+    :param max_queue: Maximum number of records waiting to be written.
+    :type max_queue: int
+    :param random: Function returning a random float between 0 and 1. Used
+                   for testing.
+    """
+
+    #: Request header with the ID of the request. Included as
+    #: ``request_id``. (Default: 'X-Request-Id')
+    REQUEST_ID_HEADER = 'X-Request-Id'
+
+    def __init__(self, output=None, sample_rates=None, headers=None,
+                 max_queue=10000, random=random.random):
+        self.output = output
+        self.sample_rates = dict(sample_rates or {})
+        self.headers = list(headers or [])
+        self.max_queue = max_queue
+        self.random = random
+        self._queue = None
+        self._thread = BackgroundThread(self._write,
+            name='wsgiservice-access-log', on_error=self._on_write_error)
+        self._file = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._written = 0
+        self._dropped = 0
+        self._sampled_out = 0
+
+    def log(self, instance, response, latency):
+        """Queues the record for a request unless it's sampled out.
+
+        :param instance: The resource instance which handled the request.
+        :type instance: :class:`wsgiservice.Resource`
+        :param response: The response sent to the client.
+        :type response: :class:`webob.Response`
+        :param latency: Time in seconds it took to handle the request.
+        :type latency: float
+        """
+        status = response.status_int
+        rate = self.sample_rates.get(status // 100, 1.0)
+        if rate < 1.0 and self.random() >= rate:
+            with self._stats_lock:
+                self._sampled_out += 1
+            return
+        entry = (time.time(), instance.request.environ,
+                 type(instance).__name__, status, response.content_length,
+                 latency, rate)
+        try:
+            self._get_queue().put_nowait(entry)
+        except queue.Full:
+            with self._stats_lock:
+                self._dropped += 1
+
+    def flush(self):
+        """Waits until all the queued records are written."""
+        entries = self._queue
+        if entries is not None and self._thread.running:
+            entries.join()
+
+    def close(self):
+        """Writes the queued records and stops the writer thread. Closes the
+        output if it was opened by this instance."""
+        with self._lock:
+            entries = self._queue
+            if entries is not None and self._thread.running:
+                entries.join()
+                self._thread.stop(wake=lambda: entries.put(_STOP))
+            self._queue = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def get_stats(self):
+        """Returns a dictionary with the number of records ``written``,
+        ``dropped`` because the queue was full and ``sampled_out``."""
+        with self._stats_lock:
+            return {'written': self._written, 'dropped': self._dropped,
+                    'sampled_out': self._sampled_out}
+
+    def get_record(self, timestamp, environ, resource, status, size, latency,
+                   rate):
+        """Returns the dictionary written for a request. Called in the
+        writer thread. Override this to change the fields.
+
+        :param timestamp: Time when the response was ready.
+        :type timestamp: float
+        :param environ: The WSGI environment of the request.
+        :type environ: dict
+        :param resource: Name of the resource which handled the request.
+        :type resource: str
+        :param status: Status code of the response.
+        :type status: int
+        :param size: Size of the response body in bytes.
+        :type size: int
+        :param latency: Time in seconds it took to handle the request.
+        :type latency: float
+        :param rate: Sample rate of the status class of the response.
+        :type rate: float
+        """
+        record = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(
+                timestamp)) + '.{0:03d}Z'.format(int(timestamp % 1 * 1000)),
+            'method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('SCRIPT_NAME', '') +
+                environ.get('PATH_INFO', ''),
+            'query': environ.get('QUERY_STRING', ''),
+            'status': status,
+            'size': size,
+            'latency_ms': round(latency * 1000, 3),
+            'resource': resource,
+            'remote_addr': environ.get('REMOTE_ADDR'),
+        }
+        for key, name in (('REMOTE_USER', 'remote_user'),
+                          ('wsgiservice.cache', 'cache')):
+            if environ.get(key):
+                record[name] = environ[key]
+        request_id = environ.get(_get_environ_key(self.REQUEST_ID_HEADER))
+        if request_id:
+            record['request_id'] = request_id
+        for header in self.headers:
+            value = environ.get(_get_environ_key(header))
+            if value is not None:
+                record.setdefault('headers', {})[header] = value
+        if rate < 1.0:
+            record['sample_rate'] = rate
+        return record
+
+    def _get_queue(self):
+        """Returns the queue, starting the writer thread on first use and
+        again after a fork."""
+        if not self._thread.running:
+            with self._lock:
+                if not self._thread.running:
+                    self._queue = queue.Queue(self.max_queue)
+                    self._thread.start()
+        return self._queue
+
+    def _get_output(self):
+        """Returns the file object to write to."""
+        if self.output is None:
+            return sys.stderr
+        if isinstance(self.output, str):
+            if self._file is None:
+                self._file = open(self.output, 'a')
+            return self._file
+        return self.output
+
+    def _write(self):
+        """Called by the writer thread. Waits for the next queued record
+        and writes it, flushing the output whenever the queue is empty."""
+        entries = self._queue
+        entry = entries.get()
+        try:
+            if entry is _STOP:
+                return
+            output = self._get_output()
+            output.write(json.dumps(self.get_record(*entry),
+                                    sort_keys=True) + '\n')
+            with self._stats_lock:
+                self._written += 1
+            if entries.empty():
+                output.flush()
+        finally:
+            entries.task_done()
+
+    def _on_write_error(self, e):
+        """Reports an exception of the writer thread."""
+        get_reporter().report(e, "Writing the access log failed: %s",
+                              log=logger)
+
+
+def _get_environ_key(header):
+    """Returns the key of the WSGI environment for a request header."""
+    return 'HTTP_' + header.upper().replace('-', '_')
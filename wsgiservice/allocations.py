@@ -0,0 +1,284 @@
+"""Memory allocations of requests, measured with :mod:`tracemalloc`.
+
+An :class:`AllocationTracker` set as
+:attr:`wsgiservice.application.Application.ALLOCATION_TRACKER` takes a
+snapshot of the traced memory before and after the call of selected
+requests. For each resource and method it records the peak of the memory
+allocated during the request and the memory the request retained. The lines
+which retained the most memory are aggregated over all the requests.
+Tracing memory makes every allocation slower, so the tracker only traces
+while it measures a request and only measures one request at a time. It
+starts :mod:`tracemalloc` before the request and stops it after, unless
+tracing was already started by someone else, in which case it's left
+running. Allocations of other threads during that time are
+attributed to the measured request, so the numbers are exact only if the
+process handles one request at a time. Requires Python 3.9 or later.
+
+The easiest way to enable the tracker is ``get_app(globals(),
+add_allocations=True)``, which mounts :class:`AllocationsResource` at
+``/_internal/allocations``. The resource is only available to requests with
+the :attr:`wsgiservice.application.Application.INTERNAL_TOKEN`.
+
+:func:`measure` and :func:`assert_budget` measure single requests to an
+application. Use them in the test suite of a service to catch changes which
+make requests allocate more::
+
+    def test_budget():
+        assert_budget(app, '/documents/1', peak=20000, retained=0)
+"""
+import gc
+import random
+import threading
+import tracemalloc
+
+import webob
+
+from wsgiservice.decorators import mount, validate
+from wsgiservice.resource import Resource
+
+
+class AllocationTracker(object):
+    """Records the memory allocated by requests. Thread-safe.
+
+    :param frames: Number of frames stored for each allocation when
+                   :mod:`tracemalloc` is started by the tracker.
+    :type frames: int
+    :param sample_rate: Fraction of the requests to measure. While a
+                        request is measured every allocation of the process
+                        is traced, which slows it down, and the snapshots
+                        taken before and after the call are compared. If
+                        :mod:`tracemalloc` was already running, the
+                        snapshots contain all the live allocations of the
+                        process. So keep it small in production.
+    :type sample_rate: float
+    :param max_locations: Maximum number of source lines for which the
+                          retained memory is kept. Half of them, those with
+                          the least memory, are dropped when there are more.
+    :type max_locations: int
+    :param random: Function returning a random float between 0 and 1. Used
+                   for testing.
+    """
+
+    def __init__(self, frames=1, sample_rate=0.01, max_locations=1000,
+                 random=random.random):
+        self.frames = frames
+        self.sample_rate = sample_rate
+        self.max_locations = max_locations
+        self.random = random
+        self._resources = {}
+        self._locations = {}
+        self._measuring = threading.Lock()
+        self._lock = threading.Lock()
+
+    def call(self, instance, func):
+        """Calls the function and returns its return value. Measures the
+        allocations of the call if the request is sampled and no other
+        request is being measured.
+
+        :param instance: The resource instance handling the request.
+        :type instance: :class:`wsgiservice.Resource`
+        :param func: Function to call without parameters, usually the
+                     resource instance itself.
+        :type func: callable
+        """
+        if self.sample_rate < 1.0 and self.random() >= self.sample_rate:
+            return func()
+        if not self._measuring.acquire(False):
+            return func()
+        started = not tracemalloc.is_tracing()
+        try:
+            if started:
+                tracemalloc.start(self.frames)
+            before = tracemalloc.take_snapshot()
+            start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            try:
+                return func()
+            finally:
+                current, peak = tracemalloc.get_traced_memory()
+                after = tracemalloc.take_snapshot()
+                if started:
+                    tracemalloc.stop()
+                    started = False
+                self.add(type(instance).__name__, instance.request.method,
+                         peak - start, current - start,
+                         after.compare_to(before, 'lineno'))
+        finally:
+            if started:
+                tracemalloc.stop()
+            self._measuring.release()
+
+    def add(self, resource, method, peak, retained, differences=()):
+        """Adds the measurement of a request.
+
+        :param resource: Name of the resource which handled the request.
+        :type resource: str
+        :param method: HTTP method of the request.
+        :type method: str
+        :param peak: Peak of the memory allocated during the request in
+                     bytes.
+        :type peak: int
+        :param retained: Memory still allocated after the request in bytes.
+        :type retained: int
+        :param differences: The :class:`tracemalloc.StatisticDiff` instances
+                            of the source lines.
+        :type differences: list
+        """
+        own = tracemalloc.__file__, __file__
+        with self._lock:
+            stats = self._resources.get((resource, method))
+            if stats is None:
+                stats = self._resources[(resource, method)] = [0, 0, 0, 0]
+            stats[0] += 1
+            stats[1] += peak
+            stats[2] = max(stats[2], peak)
+            stats[3] += retained
+            for difference in differences:
+                if difference.size_diff <= 0:
+                    continue
+                frame = difference.traceback[0]
+                if frame.filename in own:
+                    continue
+                key = '{0}:{1}'.format(frame.filename, frame.lineno)
+                location = self._locations.setdefault(key, [0, 0])
+                location[0] += difference.size_diff
+                location[1] += max(difference.count_diff, 0)
+            if len(self._locations) > self.max_locations:
+                keep = sorted(self._locations.items(),
+                              key=lambda item: -item[1][0])
+                self._locations = dict(keep[:self.max_locations // 2])
+
+    def get_stats(self):
+        """Returns a list of dictionaries with the ``resource``, the
+        ``method``, the number of measured requests (``count``), the mean
+        and maximum of their peak allocations (``peak_mean``, ``peak_max``)
+        and the mean and total of the retained memory (``retained_mean``,
+        ``retained_total``) in bytes. Sorted by the maximum peak."""
+        with self._lock:
+            stats = [{'resource': resource, 'method': method,
+                      'count': count, 'peak_mean': peak / count,
+                      'peak_max': peak_max,
+                      'retained_mean': retained / count,
+                      'retained_total': retained}
+                     for (resource, method), (count, peak, peak_max,
+                                              retained)
+                     in self._resources.items()]
+        stats.sort(key=lambda row: (-row['peak_max'], row['resource'],
+                                    row['method']))
+        return stats
+
+    def get_top(self, count=20):
+        """Returns the source lines which retained the most memory over all
+        the measured requests as a list of dictionaries with the
+        ``location``, the ``size`` in bytes and the ``count`` of memory
+        blocks.
+
+        :param count: Maximum number of lines to return.
+        :type count: int
+        """
+        with self._lock:
+            locations = sorted(self._locations.items(),
+                               key=lambda item: (-item[1][0], item[0]))
+        return [{'location': location, 'size': size, 'count': blocks}
+                for location, (size, blocks) in locations[:count]]
+
+    def clear(self):
+        """Removes all the measurements."""
+        with self._lock:
+            self._resources.clear()
+            self._locations.clear()
+
+
+def measure(app, path, repeat=5, **kwargs):
+    """Returns a dictionary with the ``peak`` and the ``retained`` memory
+    in bytes of a request to the application, the minimum of several
+    requests. A first request which is not measured warms up caches.
+
+    :param app: The application.
+    :type app: :class:`wsgiservice.application.Application`
+    :param path: Path and query string of the request.
+    :type path: str
+    :param repeat: Number of measured requests.
+    :type repeat: int
+    :param kwargs: Additional arguments for :func:`webob.Request.blank`, for
+                   example the ``method`` or ``headers``.
+    """
+    app._handle_request(webob.Request.blank(path, **kwargs))
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    peaks = []
+    retained = []
+    try:
+        for i in range(repeat):
+            request = webob.Request.blank(path, **kwargs)
+            gc.collect()
+            start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            response = app._handle_request(request)
+            peak = tracemalloc.get_traced_memory()[1]
+            del request, response
+            gc.collect()
+            peaks.append(peak - start)
+            retained.append(tracemalloc.get_traced_memory()[0] - start)
+    finally:
+        if started:
+            tracemalloc.stop()
+    return {'peak': min(peaks), 'retained': max(min(retained), 0)}
+
+
+def assert_budget(app, path, peak=None, retained=None, repeat=5, **kwargs):
+    """Measures a request with :func:`measure` and raises an
+    :class:`AssertionError` if it allocated more memory than the budget.
+
+    :param app: The application.
+    :type app: :class:`wsgiservice.application.Application`
+    :param path: Path and query string of the request.
+    :type path: str
+    :param peak: Maximum peak of the allocated memory in bytes. None to not
+                 check it.
+    :type peak: int
+    :param retained: Maximum retained memory in bytes. None to not check it.
+    :type retained: int
+    :param repeat: Number of measured requests.
+    :type repeat: int
+    :param kwargs: Additional arguments for :func:`webob.Request.blank`.
+    """
+    result = measure(app, path, repeat=repeat, **kwargs)
+    if peak is not None and result['peak'] > peak:
+        raise AssertionError("Request to {0} allocated a peak of {1} bytes, "
+                             "the budget is {2} bytes.".format(
+                                 path, result['peak'], peak))
+    if retained is not None and result['retained'] > retained:
+        raise AssertionError("Request to {0} retained {1} bytes, the budget "
+                             "is {2} bytes.".format(
+                                 path, result['retained'], retained))
+    return result
+
+
+@mount('/_internal/allocations')
+class AllocationsResource(Resource):
+    """Exposes the measurements of the
+    :attr:`wsgiservice.application.Application.ALLOCATION_TRACKER`. Requires
+    the :attr:`wsgiservice.application.Application.INTERNAL_TOKEN`."""
+    XML_ROOT_TAG = 'allocations'
+    NOT_FOUND = (KeyError,)
+
+    @validate('top', re='[0-9]+', convert=int,
+              doc='Number of source lines with the most retained memory to '
+                  'include.')
+    def GET(self, top='20'):
+        """Returns the allocations by resource and the top allocators."""
+        self.assert_internal_token()
+        tracker = self.get_tracker()
+        if tracker is None:
+            raise KeyError('allocations')
+        return {'resources': tracker.get_stats(),
+                'top': tracker.get_top(top)}
+
+    def get_tracker(self):
+        """Returns the :class:`AllocationTracker` of the application or
+        None."""
+        if self.application is None:
+            return None
+        return self.application.ALLOCATION_TRACKER
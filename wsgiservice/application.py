@@ -1,9 +1,25 @@
 """Components responsible for building the WSGI application."""
+import functools
 import logging
+import os
+import threading
+import time
 
 import webob
 import wsgiservice
 import wsgiservice.resource
+from wsgiservice.allocations import AllocationsResource, AllocationTracker
+from wsgiservice.cache import NegativeCache
+from wsgiservice.concurrency import SingleFlight
+from wsgiservice.errors import get_reporter
+from wsgiservice.exceptions import (DeadlineExceededException,
+    ResponseException, TimeoutException)
+from wsgiservice.limits import AdmissionController
+from wsgiservice.metrics import Metrics, MetricsResource
+from wsgiservice.sampling import ProfileResource, SamplingProfiler
+from wsgiservice.status import raise_429, raise_503
+from wsgiservice.timing import RequestTiming, TimingStats
+from wsgiservice.watchdog import SlowRequestsResource, Watchdog
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +48,115 @@ class Application(object):
     #: resource when the routing does not return any match.
     NOT_FOUND_RESOURCE = wsgiservice.resource.NotFoundResource
 
+    #: :class:`wsgiservice.cache.ResponseCache` used to cache the responses
+    #: of resources with a shared cache policy in-process. (Default: None)
+    RESPONSE_CACHE = None
+
+    #: Whether identical concurrent GET and HEAD requests should be
+    #: coalesced. Only one of them calls the resource, the others wait for it
+    #: and get a copy of its response. (Default: False)
+    COALESCE_REQUESTS = False
+
+    #: Maximum number of seconds a coalesced request waits for the response
+    #: of the request it's coalesced with. After that it calls the resource
+    #: itself. Requests with a deadline wait at most until their deadline
+    #: and then fail with a 504 status code. (Default: 10)
+    COALESCE_TIMEOUT = 10
+
+    #: Request headers which must be identical for requests to be coalesced.
+    #: The path, query string, the negotiated content type and the
+    #: conditional request headers always have to be identical. (Default:
+    #: ['Authorization', 'Cookie', 'Accept-Language', 'Accept-Encoding'])
+    COALESCE_VARY = ['Authorization', 'Cookie', 'Accept-Language',
+                     'Accept-Encoding']
+
+    #: :class:`wsgiservice.limits.AdmissionController` limiting the number of
+    #: requests in flight. Rejected requests get a 503 status code with a
+    #: ``Retry-After`` header. (Default: None)
+    ADMISSION_CONTROLLER = None
+
+    #: Path prefixes of requests which are not subject to the
+    #: :attr:`ADMISSION_CONTROLLER` and the :attr:`RATE_LIMITER`, so health
+    #: checks and internal resources keep working under overload. (Default:
+    #: ['/_internal/'])
+    ADMISSION_EXEMPT = ['/_internal/']
+
+    #: :class:`wsgiservice.limits.RateLimiter` limiting the request rate of
+    #: the clients. Requests beyond the limit get a 429 status code. All
+    #: responses get ``RateLimit-*`` headers. (Default: None)
+    RATE_LIMITER = None
+
+    #: Default number of seconds a request may take. Resources abort requests
+    #: past their deadline with a 504 status code, see
+    #: :func:`wsgiservice.Resource.assert_deadline`. None means no deadline.
+    #: (Default: None)
+    DEADLINE = None
+
+    #: Request header with which clients can set the number of seconds they
+    #: are willing to wait for the response. Can only shorten the
+    #: :attr:`DEADLINE`. None to ignore the header. (Default:
+    #: 'X-Request-Timeout')
+    DEADLINE_HEADER = 'X-Request-Timeout'
+
+    #: :class:`wsgiservice.accesslog.AccessLog` to which every request is
+    #: logged once its response is ready. (Default: None)
+    ACCESS_LOG = None
+
+    #: :class:`wsgiservice.metrics.Metrics` recording the number, latency
+    #: and size of the requests, shared by all the workers of the host. Set
+    #: by :func:`get_app` with `add_metrics`. (Default: None)
+    METRICS = None
+
+    #: :class:`wsgiservice.sampling.SamplingProfiler` sampling the stacks of
+    #: the threads handling requests. Set by :func:`get_app` with
+    #: `add_profiler`. (Default: None)
+    PROFILER = None
+
+    #: :class:`wsgiservice.profiling.RequestProfiler` running selected
+    #: requests under :mod:`cProfile`. (Default: None)
+    REQUEST_PROFILER = None
+
+    #: :class:`wsgiservice.watchdog.Watchdog` reporting requests which run
+    #: for longer than the threshold of their resource. Set by
+    #: :func:`get_app` with `add_watchdog`. (Default: None)
+    WATCHDOG = None
+
+    #: :class:`wsgiservice.allocations.AllocationTracker` measuring the
+    #: memory allocated by the requests with :mod:`tracemalloc`. Set by
+    #: :func:`get_app` with `add_allocations`. (Default: None)
+    ALLOCATION_TRACKER = None
+
+    #: :class:`wsgiservice.tracing.Tracer` writing traces of the requests in
+    #: the Chrome trace event format. (Default: None)
+    TRACER = None
+
+    #: Secret which requests to protected internal resources like
+    #: :class:`wsgiservice.sampling.ProfileResource` have to send in the
+    #: :attr:`INTERNAL_TOKEN_HEADER`, see
+    #: :func:`wsgiservice.Resource.assert_internal_token`. Also authorizes
+    #: the profiling of requests with the
+    #: :attr:`wsgiservice.profiling.RequestProfiler.HEADER`. None denies all
+    #: the requests to these resources. (Default: None)
+    INTERNAL_TOKEN = None
+
+    #: Request header containing the :attr:`INTERNAL_TOKEN`. (Default:
+    #: 'X-Internal-Token')
+    INTERNAL_TOKEN_HEADER = 'X-Internal-Token'
+
+    #: Whether to record the duration of the phases of each request, see
+    #: :mod:`wsgiservice.timing`. The durations are aggregated per resource
+    #: in :attr:`timing_stats`. (Default: False)
+    TIMING = False
+
+    #: Whether to send the durations of the phases to the client in a
+    #: ``Server-Timing`` response header. Implies :attr:`TIMING`. (Default:
+    #: False)
+    SERVER_TIMING = False
+
+    #: Number of requests which got the response of another request because
+    #: of :attr:`COALESCE_REQUESTS`.
+    coalesced_requests = 0
+
     #: Resource classes served by this application. Set by the constructor.
     _resources = None
 
@@ -46,6 +171,15 @@ class Application(object):
         """
         self._resources = resources
         self._urlmap = wsgiservice.routing.Router(resources)
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+        self._bulkheads = {}
+        #: :class:`wsgiservice.cache.NegativeCache` used by resources with a
+        #: :attr:`wsgiservice.Resource.NEGATIVE_CACHE_TTL`.
+        self.negative_cache = NegativeCache()
+        #: :class:`wsgiservice.timing.TimingStats` with the durations of the
+        #: phases per resource if :attr:`TIMING` is enabled.
+        self.timing_stats = TimingStats()
 
     def __call__(self, environ, start_response):
         """WSGI entry point. Serve the best matching resource for the current
@@ -61,7 +195,8 @@ class Application(object):
             response = self._handle_request(request)
             return response(environ, start_response)
         except Exception as e:
-            logger.exception('Uncaught exception in service: %s', e)
+            get_reporter().report(e, 'Uncaught exception in service: %s',
+                                  log=logger)
             raise
 
     def _log_request(self, request):
@@ -70,6 +205,8 @@ class Application(object):
         :param request: Object representing the current request.
         :type request: :class:`webob.Request`
         """
+        if not logger.isEnabledFor(logging.INFO):
+            return
         msg = []
         for d in self.LOG_DATA:
             val = getattr(request, d)
@@ -86,6 +223,317 @@ class Application(object):
         no resource matches the request, a 404 status is set on the response
         object.
 
+        :param request: Object representing the current request.
+        :type request: :class:`webob.Request`
+        """
+        started = time.perf_counter()
+        trace = self.start_trace(request)
+        timing = self.start_timing(request)
+        self.set_deadline(request)
+        instance = self._get_instance(request)
+        if timing is not None:
+            timing.mark('routing')
+        measured = self.start_metrics(instance)
+        rate_limit = self.check_rate_limit(instance)
+        if rate_limit is not None and not rate_limit.allowed:
+            response = self._reject_rate_limited(instance, rate_limit)
+        else:
+            response = self._call_admitted(instance)
+        if rate_limit is not None:
+            rate_limit.set_headers(response)
+        if request.method == 'HEAD':
+            response.body = b''
+        if measured:
+            self.finish_metrics(instance, started, response)
+        if timing is not None:
+            self.finish_timing(instance, timing, response)
+        if trace is not None:
+            self.TRACER.finish(instance, trace, timing, response)
+        if self.ACCESS_LOG is not None:
+            self.ACCESS_LOG.log(instance, response,
+                                time.perf_counter() - started)
+        return response
+
+    def _call_admitted(self, instance):
+        """Calls the resource instance if the :attr:`ADMISSION_CONTROLLER`
+        admits the request and returns the response.
+
+        :param instance: The resource instance to call.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        """
+        controller = self.get_admission_controller(instance.request)
+        if controller is None:
+            return self._call_resource(instance)
+        if not controller.acquire():
+            return self._reject(instance, controller)
+        start = time.time()
+        try:
+            return self._call_resource(instance)
+        finally:
+            controller.release(time.time() - start)
+
+    def start_metrics(self, instance):
+        """Counts the request as in flight in the :attr:`METRICS`. Returns
+        True if :func:`finish_metrics` must be called for the request, False
+        if metrics are disabled. Fails open like :func:`check_rate_limit`.
+
+        :param instance: The resource instance of the request.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        """
+        metrics = self.METRICS
+        if metrics is None:
+            return False
+        try:
+            metrics.start(type(instance).__name__)
+        except (OSError, ValueError) as e:
+            get_reporter().report(e, "Recording metrics failed: %s",
+                                  log=logger)
+            return False
+        return True
+
+    def finish_metrics(self, instance, started, response):
+        """Records the finished request in the :attr:`METRICS`.
+
+        :param instance: The resource instance of the request.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        :param started: Value of :func:`time.perf_counter` when the request
+                        started.
+        :type started: float
+        :param response: The response to send.
+        :type response: :class:`webob.Response`
+        """
+        request = instance.request
+        try:
+            self.METRICS.finish(type(instance).__name__, request.method,
+                response.status_int, time.perf_counter() - started,
+                len(response.body),
+                cache=request.environ.get('wsgiservice.cache'))
+        except (OSError, ValueError) as e:
+            get_reporter().report(e, "Recording metrics failed: %s",
+                                  log=logger)
+        self.update_limiter_metrics()
+
+    def update_limiter_metrics(self, force=False):
+        """Stores the state of the :attr:`ADMISSION_CONTROLLER` and the
+        bulkheads of this process in the :attr:`METRICS`, see
+        :func:`wsgiservice.metrics.Metrics.update_limiters`.
+
+        :param force: Whether to store them even if they were stored
+                      recently.
+        :type force: bool
+        """
+        metrics = self.METRICS
+        if metrics is None:
+            return
+        controller = self.ADMISSION_CONTROLLER
+        try:
+            metrics.update_limiters(
+                controller.get_stats() if controller is not None else None,
+                self.get_bulkheads(), force=force)
+        except (OSError, ValueError) as e:
+            get_reporter().report(e, "Recording metrics failed: %s",
+                                  log=logger)
+
+    def _count_metric(self, method, *args):
+        """Calls the given counting method of the :attr:`METRICS` with the
+        arguments, if metrics are enabled. Fails open like
+        :func:`start_metrics`.
+
+        :param method: Name of the method, for example ``'count_rejected'``.
+        :type method: str
+        """
+        metrics = self.METRICS
+        if metrics is None:
+            return
+        try:
+            getattr(metrics, method)(*args)
+        except (OSError, ValueError) as e:
+            get_reporter().report(e, "Recording metrics failed: %s",
+                                  log=logger)
+
+    def start_trace(self, request):
+        """Returns a new :class:`wsgiservice.tracing.RequestTrace` if the
+        :attr:`TRACER` selects the request and stores it in the
+        ``wsgiservice.trace`` key of the WSGI environment. Returns None
+        otherwise.
+
+        :param request: Object representing the current request.
+        :type request: :class:`webob.Request`
+        """
+        if self.TRACER is None:
+            return None
+        trace = self.TRACER.start(request)
+        if trace is not None:
+            request.environ['wsgiservice.trace'] = trace
+        return trace
+
+    def start_timing(self, request):
+        """Returns a new :class:`wsgiservice.timing.RequestTiming` for the
+        request and stores it in the ``wsgiservice.timing`` key of the WSGI
+        environment. Returns None if neither :attr:`TIMING` nor
+        :attr:`SERVER_TIMING` is enabled and the request is not traced, see
+        :func:`start_trace`.
+
+        :param request: Object representing the current request.
+        :type request: :class:`webob.Request`
+        """
+        if not (self.TIMING or self.SERVER_TIMING or
+                'wsgiservice.trace' in request.environ):
+            return None
+        timing = request.environ['wsgiservice.timing'] = RequestTiming()
+        return timing
+
+    def finish_timing(self, instance, timing, response):
+        """Ends the timing of the request, adds it to :attr:`timing_stats`
+        and sets the ``Server-Timing`` header if :attr:`SERVER_TIMING` is
+        enabled.
+
+        :param instance: The resource instance which handled the request.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        :param timing: The timing returned by :func:`start_timing`.
+        :type timing: :class:`wsgiservice.timing.RequestTiming`
+        :param response: The response to send.
+        :type response: :class:`webob.Response`
+        """
+        timing.finish()
+        self.timing_stats.add(type(instance).__name__, timing)
+        if self.SERVER_TIMING:
+            response.headers['Server-Timing'] = timing.get_header()
+
+    def set_deadline(self, request):
+        """Sets the deadline of the request from the :attr:`DEADLINE` and
+        the :attr:`DEADLINE_HEADER`. The deadline is stored as a value of
+        :func:`time.monotonic` in the ``wsgiservice.deadline`` key of the
+        WSGI environment, so changes of the system clock don't affect it.
+
+        :param request: Object representing the current request.
+        :type request: :class:`webob.Request`
+        """
+        timeout = self.DEADLINE
+        header = self.DEADLINE_HEADER and request.headers.get(
+            self.DEADLINE_HEADER)
+        if header:
+            try:
+                value = max(float(header), 0)
+            except ValueError:
+                logger.debug("Ignoring invalid %s header: %r",
+                             self.DEADLINE_HEADER, header)
+            else:
+                timeout = value if timeout is None else min(timeout, value)
+        if timeout is not None:
+            request.environ['wsgiservice.deadline'] = \
+                time.monotonic() + timeout
+
+    def get_admission_controller(self, request):
+        """Returns the :attr:`ADMISSION_CONTROLLER` unless the request is
+        exempt from admission control.
+
+        :param request: Object representing the current request.
+        :type request: :class:`webob.Request`
+        """
+        controller = self.ADMISSION_CONTROLLER
+        if controller is None or self.is_exempt(request):
+            return None
+        return controller
+
+    def is_exempt(self, request):
+        """Returns True if the path of the request starts with one of the
+        :attr:`ADMISSION_EXEMPT` prefixes.
+
+        :param request: Object representing the current request.
+        :type request: :class:`webob.Request`
+        """
+        for prefix in self.ADMISSION_EXEMPT:
+            if request.path_info.startswith(prefix):
+                return True
+        return False
+
+    def check_rate_limit(self, instance):
+        """Checks the request against the :attr:`RATE_LIMITER`. Returns a
+        :class:`wsgiservice.limits.RateLimit`, or None if the request is not
+        limited. Fails open: requests are allowed if the state of the rate
+        limiter can't be accessed.
+
+        :param instance: The resource instance of the request.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        """
+        limiter = self.RATE_LIMITER
+        if limiter is None or self.is_exempt(instance.request):
+            return None
+        try:
+            return limiter.check(instance.request, type(instance))
+        except (OSError, ValueError) as e:
+            get_reporter().report(e, "Rate limiter failed: %s", log=logger)
+            return None
+
+    def get_bulkhead(self, resource):
+        """Returns the :class:`wsgiservice.limits.AdmissionController`
+        enforcing the :attr:`wsgiservice.Resource.BULKHEAD` of the resource
+        class, or None if the resource has no bulkhead.
+
+        :param resource: The resource class.
+        :type resource: :class:`wsgiservice.resource.Resource`
+        """
+        if resource.BULKHEAD is None:
+            return None
+        bulkhead = self._bulkheads.get(resource)
+        if bulkhead is None:
+            with self._lock:
+                bulkhead = self._bulkheads.get(resource)
+                if bulkhead is None:
+                    bulkhead = self._bulkheads[resource] = AdmissionController(
+                        max_in_flight=resource.BULKHEAD,
+                        max_queue=resource.BULKHEAD_QUEUE,
+                        queue_timeout=resource.BULKHEAD_TIMEOUT)
+        return bulkhead
+
+    def get_bulkheads(self):
+        """Returns a dictionary mapping the names of the resources with a
+        :attr:`wsgiservice.Resource.BULKHEAD` to the statistics of their
+        bulkhead. See
+        :func:`wsgiservice.limits.AdmissionController.get_stats`."""
+        return dict((resource.__name__, bulkhead.get_stats())
+                    for resource, bulkhead in list(self._bulkheads.items()))
+
+    def _reject_rate_limited(self, instance, rate_limit):
+        """Returns a 429 response for a request beyond the rate limit.
+
+        :param instance: The resource instance of the rejected request.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        :param rate_limit: The outcome of the rate limit check.
+        :type rate_limit: :class:`wsgiservice.limits.RateLimit`
+        """
+        logger.info("Rejecting request to %s, rate limit exceeded.",
+                    type(instance).__name__)
+        try:
+            raise_429(instance, retry_after=rate_limit.retry_after)
+        except ResponseException as e:
+            return instance.get_exception_response(e)
+
+    def _reject(self, instance, controller):
+        """Returns a 503 response for a request which was not admitted.
+
+        :param instance: The resource instance of the rejected request.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        :param controller: The controller or bulkhead which rejected the
+                           request.
+        :type controller: :class:`wsgiservice.limits.AdmissionController`
+        """
+        logger.warning("Rejecting request to %s, too many requests in "
+                       "flight.", type(instance).__name__)
+        if controller is self.ADMISSION_CONTROLLER:
+            self._count_metric('count_rejected')
+        else:
+            self._count_metric('count_rejected', type(instance).__name__)
+        try:
+            raise_503(instance, retry_after=controller.get_retry_after())
+        except ResponseException as e:
+            return instance.get_exception_response(e)
+
+    def _get_instance(self, request):
+        """Returns an instance of the resource to which the request maps.
+        Falls back to the :attr:`NOT_FOUND_RESOURCE` if no resource matches.
+
         :param request: Object representing the current request.
         :type request: :class:`webob.Request`
         """
@@ -96,15 +544,162 @@ class Application(object):
             path_params, resource = parsed
         else:
             path_params, resource = {}, self.NOT_FOUND_RESOURCE
-        instance = resource(request=request, response=response,
+        return resource(request=request, response=response,
             path_params=path_params, application=self)
-        response = instance()
-        if request.method == 'HEAD':
-            response.body = b''
-        return response
+
+    def _call_resource(self, instance):
+        """Calls the resource instance and returns its response, see
+        :func:`_call_coalescing`. The current thread is sampled by the
+        :attr:`PROFILER` and watched by the :attr:`WATCHDOG` during the call.
+        Its allocations are measured by the :attr:`ALLOCATION_TRACKER` and it
+        is profiled if the :attr:`REQUEST_PROFILER` selects the request.
+
+        :param instance: The resource instance to call.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        """
+        profiler = self.PROFILER
+        if profiler is not None:
+            profiler.enter(type(instance).__name__, instance.request.method)
+        watchdog = self.WATCHDOG
+        if watchdog is not None:
+            watchdog.enter(instance)
+        try:
+            call = functools.partial(self._call_coalescing, instance)
+            tracker = self.ALLOCATION_TRACKER
+            if tracker is not None:
+                call = functools.partial(tracker.call, instance, call)
+            request_profiler = self.REQUEST_PROFILER
+            if request_profiler is not None:
+                return request_profiler.call(instance, call)
+            return call()
+        finally:
+            if watchdog is not None:
+                watchdog.exit()
+            if profiler is not None:
+                profiler.exit()
+
+    def _call_coalescing(self, instance):
+        """Calls the resource instance and returns its response. Coalesces
+        the request with identical ones if :attr:`COALESCE_REQUESTS` is set.
+
+        :param instance: The resource instance to call.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        """
+        if self.COALESCE_REQUESTS and \
+                instance.request.method in ('GET', 'HEAD'):
+            return self._call_coalesced(instance)
+        return self._call_limited(instance)
+
+    def _call_coalesced(self, instance):
+        """Calls the resource instance unless an identical request is
+        already being handled. In that case waits for that request and
+        returns a copy of its response.
+
+        :param instance: The resource instance to call.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        """
+        def call():
+            response = self._call_limited(instance)
+            return response, response.copy()
+
+        key = self._get_coalesce_key(instance)
+        try:
+            (response, shared), is_shared = self._flight.do(key, call,
+                timeout=self.get_coalesce_timeout(instance))
+        except TimeoutException:
+            shared = None
+        else:
+            if not is_shared:
+                return response
+        try:
+            instance.assert_deadline('waiting for a coalesced request')
+        except DeadlineExceededException as e:
+            return instance.get_exception_response(e)
+        if shared is None:
+            logger.warning("Timeout waiting for coalesced request, handling "
+                           "it separately.")
+            return self._call_limited(instance)
+        with self._lock:
+            self.coalesced_requests += 1
+        self._count_metric('count_coalesced', type(instance).__name__)
+        return shared.copy()
+
+    def get_coalesce_timeout(self, instance):
+        """Returns the number of seconds a coalesced request waits for the
+        request it's coalesced with: the :attr:`COALESCE_TIMEOUT` or the
+        remaining time until the deadline of the request, whichever is
+        shorter.
+
+        :param instance: The resource instance of the waiting request.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        """
+        remaining = instance.get_remaining_time()
+        if remaining is None:
+            return self.COALESCE_TIMEOUT
+        if self.COALESCE_TIMEOUT is None:
+            return remaining
+        return min(self.COALESCE_TIMEOUT, remaining)
+
+    def _get_coalesce_key(self, instance):
+        """Returns the key under which requests are coalesced. Consists of
+        the resource, path, query string, negotiated content type and request
+        headers.
+
+        :param instance: The resource instance to call.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        """
+        request = instance.request
+        resource = type(instance)
+        # Negotiate on a separate instance, get_content_type modifies the
+        # response
+        content_type = resource(request=request, response=webob.Response(),
+            path_params=instance.path_params).get_content_type()
+        key = [resource, request.path_qs, content_type]
+        headers = list(self.COALESCE_VARY) + ['If-Match', 'If-None-Match',
+            'If-Modified-Since', 'If-Unmodified-Since']
+        policy = instance.get_cache_policy()
+        if policy is not None:
+            headers.extend(policy.vary)
+        for header in headers:
+            key.append(request.headers.get(header))
+        return tuple(key)
+
+    def _call_limited(self, instance):
+        """Calls the resource instance within its bulkhead, see
+        :func:`get_bulkhead`, and returns its response. Rejects the request
+        if the bulkhead is full.
+
+        :param instance: The resource instance to call.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        """
+        bulkhead = self.get_bulkhead(type(instance))
+        if bulkhead is None:
+            return self._call_cached(instance)
+        if not bulkhead.acquire():
+            return self._reject(instance, bulkhead)
+        start = time.time()
+        try:
+            return self._call_cached(instance)
+        finally:
+            bulkhead.release(time.time() - start)
+
+    def _call_cached(self, instance):
+        """Calls the resource instance and returns its response. Uses the
+        :attr:`RESPONSE_CACHE` if the resource's cache policy allows it.
+
+        :param instance: The resource instance to call.
+        :type instance: :class:`wsgiservice.resource.Resource`
+        """
+        cache = self.RESPONSE_CACHE
+        if cache is not None and cache.is_cacheable_request(instance.request):
+            policy = instance.get_cache_policy()
+            if policy is not None and policy.shared:
+                return cache(instance, policy)
+        return instance()
 
 
-def get_app(defs, add_help=True):
+def get_app(defs, add_help=True, add_metrics=False, add_profiler=False,
+            add_watchdog=False, add_allocations=False, name=None):
     """Small wrapper function to returns an instance of :class:`Application`
     which serves the objects in the defs. Usually this is called with return
     value globals() from the module where the resources are defined. The
@@ -118,6 +713,34 @@ def get_app(defs, add_help=True):
     :param add_help: Whether to add the Help resource which will expose the
                      documentation of this service at /_internal/help
     :type add_help: boolean
+    :param add_metrics: Whether to record metrics in
+                        :attr:`Application.METRICS` and expose them at
+                        /_internal/metrics, see :mod:`wsgiservice.metrics`.
+    :type add_metrics: boolean
+    :param add_profiler: Whether to sample the request threads with
+                         :attr:`Application.PROFILER` and expose the samples
+                         at /_internal/profile, see
+                         :mod:`wsgiservice.sampling`. The resource requires
+                         the :attr:`Application.INTERNAL_TOKEN`.
+    :type add_profiler: boolean
+    :param add_watchdog: Whether to report slow requests with
+                         :attr:`Application.WATCHDOG` and expose the reports
+                         at /_internal/slow, see :mod:`wsgiservice.watchdog`.
+                         The resource requires the
+                         :attr:`Application.INTERNAL_TOKEN`.
+    :type add_watchdog: boolean
+    :param add_allocations: Whether to measure the allocations of the
+                            requests with
+                            :attr:`Application.ALLOCATION_TRACKER` and
+                            expose them at /_internal/allocations, see
+                            :mod:`wsgiservice.allocations`. Measures 1% of
+                            the requests by default. The resource
+                            requires the :attr:`Application.INTERNAL_TOKEN`.
+    :type add_allocations: boolean
+    :param name: Name of the service, used to name the shared tables of the
+                 metrics. Defaults to the name of the module of the defs, or
+                 of its file for scripts.
+    :type name: str
     :rtype: :class:`Application`
     """
     def is_resource(d):
@@ -132,4 +755,35 @@ def get_app(defs, add_help=True):
     resources = [d for d in list(defs.values()) if is_resource(d)]
     if add_help:
         resources.append(wsgiservice.resource.Help)
-    return Application(resources)
+    if add_metrics:
+        resources.append(MetricsResource)
+    if add_profiler:
+        resources.append(ProfileResource)
+    if add_watchdog:
+        resources.append(SlowRequestsResource)
+    if add_allocations:
+        resources.append(AllocationsResource)
+    app = Application(resources)
+    if add_metrics and app.METRICS is None:
+        app.METRICS = Metrics(
+            name='{0}-metrics'.format(name or _get_service_name(defs)))
+    if add_profiler and app.PROFILER is None:
+        app.PROFILER = SamplingProfiler()
+    if add_watchdog and app.WATCHDOG is None:
+        app.WATCHDOG = Watchdog()
+    if add_allocations and app.ALLOCATION_TRACKER is None:
+        app.ALLOCATION_TRACKER = AllocationTracker()
+    return app
+
+
+def _get_service_name(defs):
+    """Returns the name of the service defined in the defs: the name of
+    their module, or the name of its file without the extension for
+    scripts."""
+    name = defs.get('__name__')
+    if name in (None, '__main__'):
+        filename = defs.get('__file__')
+        if not filename:
+            return 'wsgiservice'
+        name = os.path.splitext(os.path.basename(filename))[0]
+    return name
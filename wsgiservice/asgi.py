@@ -0,0 +1,568 @@
+"""ASGI entry point for WsgiService applications.
+
+:class:`ASGIApplication` serves a :class:`wsgiservice.application.Application`
+to ASGI servers. Requests go through the same routing and resource pipeline
+as with WSGI. Resource methods as well as ``get_etag`` and
+``get_last_modified`` may be coroutine functions (``async def``). They are
+awaited on the event loop. Resources without any coroutine functions are
+called in a thread, so they can block without stalling the event loop.
+
+The threads come from bounded :class:`wsgiservice.concurrency.ThreadPool`
+instances. By default all resources share the pool ``default``. Resources
+can be assigned to another pool with the
+:attr:`wsgiservice.Resource.OFFLOAD_POOL` attribute or the
+:func:`wsgiservice.decorators.offload` decorator on individual methods. The
+latter also runs blocking methods of otherwise asynchronous resources in a
+thread. Requests are rejected with a 503 status code when the queue of their
+pool is full.
+
+The :attr:`wsgiservice.application.Application.ADMISSION_CONTROLLER` and the
+bulkheads of the resources (see :attr:`wsgiservice.Resource.BULKHEAD`) apply
+as well, but requests beyond their limits are rejected right away instead of
+waiting in their queues. Requests of coroutine resources are coalesced
+(:attr:`wsgiservice.application.Application.COALESCE_REQUESTS`) and cached
+(:attr:`wsgiservice.application.Application.RESPONSE_CACHE`) like with WSGI.
+The cache backend is called on the event loop, and stale responses are
+refreshed by a thread which waits for the resource on the event loop.
+
+The :attr:`wsgiservice.application.Application.PROFILER`, ``WATCHDOG``,
+``ALLOCATION_TRACKER`` and ``REQUEST_PROFILER`` observe the thread handling
+a request. They only apply to resources without coroutine functions, which
+are called in a thread. The event loop interleaves the requests of
+coroutine resources, so they are not covered. A warning is logged the first
+time such a request is served while one of them is set.
+
+Coroutine methods can call other resources concurrently with
+:func:`fan_out`, the async equivalent of
+:func:`wsgiservice.Resource.fan_out`.
+
+Example::
+
+    app = get_app(globals())
+    asgi_app = ASGIApplication(app)
+
+Requires Python 3.7 or later.
+"""
+import asyncio
+import functools
+import inspect
+import io
+import logging
+import sys
+import time
+
+import webob
+from wsgiservice.concurrency import ThreadPool, get_thread_pool
+from wsgiservice.errors import get_reporter
+from wsgiservice.exceptions import (DeadlineExceededException,
+    PoolFullException, TimeoutException)
+
+logger = logging.getLogger(__name__)
+
+
+class ASGIApplication(object):
+    """ASGI application serving a WsgiService application. Implements the
+    ``http`` and ``lifespan`` scopes of the ASGI 3 specification.
+
+    :param application: The application to serve.
+    :type application: :class:`wsgiservice.application.Application`
+    :param pools: Dictionary mapping pool names to
+                  :class:`wsgiservice.concurrency.ThreadPool` instances.
+                  Pools which are not configured are created on first use
+                  with :attr:`POOL_SIZE` and :attr:`POOL_MAX_QUEUE`.
+    :type pools: dict
+    """
+
+    #: Number of threads of pools which are not configured explicitly.
+    #: (Default: 10)
+    POOL_SIZE = 10
+
+    #: Queue size of pools which are not configured explicitly. (Default:
+    #: 100)
+    POOL_MAX_QUEUE = 100
+
+    #: Options of the application which don't apply to coroutine
+    #: resources.
+    THREAD_OPTIONS = ('PROFILER', 'WATCHDOG', 'ALLOCATION_TRACKER',
+                      'REQUEST_PROFILER')
+
+    def __init__(self, application, pools=None):
+        self.application = application
+        self.pools = dict(pools or {})
+        # Maps the event loops and coalesce keys of the running requests to
+        # the futures of their responses
+        self._flights = {}
+        self._warned = set()
+
+    async def __call__(self, scope, receive, send):
+        """ASGI entry point.
+
+        :param scope: Connection scope.
+        :type scope: dict
+        :param receive: Awaitable callable returning the next event.
+        :param send: Awaitable callable to send an event.
+        """
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError("Unsupported scope type: " + scope['type'])
+        body = await self._read_body(receive)
+        request = webob.Request(self._get_environ(scope, body))
+        response = await self.handle_request(request)
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_int,
+            'headers': [(key.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for key, value in response.headerlist],
+        })
+        await send({'type': 'http.response.body', 'body': response.body})
+
+    async def handle_request(self, request):
+        """Returns the response for the given request. The async equivalent
+        of :func:`wsgiservice.application.Application._handle_request`.
+
+        :param request: Object representing the current request.
+        :type request: :class:`webob.Request`
+        """
+        app = self.application
+        try:
+            app._log_request(request)
+            started = time.perf_counter()
+            trace = app.start_trace(request)
+            timing = app.start_timing(request)
+            app.set_deadline(request)
+            instance = app._get_instance(request)
+            if timing is not None:
+                timing.mark('routing')
+            measured = app.start_metrics(instance)
+            rate_limit = app.check_rate_limit(instance)
+            controller = app.get_admission_controller(request)
+            if rate_limit is not None and not rate_limit.allowed:
+                response = app._reject_rate_limited(instance, rate_limit)
+            elif controller is not None and \
+                    not controller.acquire(timeout=0):
+                response = app._reject(instance, controller)
+            else:
+                start = time.time()
+                try:
+                    if is_async(instance):
+                        self._warn_thread_options()
+                        response = await self.call_resource_coalescing(
+                            instance)
+                    else:
+                        response = await self.call_resource_sync(instance)
+                finally:
+                    if controller is not None:
+                        controller.release(time.time() - start)
+            if rate_limit is not None:
+                rate_limit.set_headers(response)
+            if request.method == 'HEAD':
+                response.body = b''
+            if measured:
+                app.finish_metrics(instance, started, response)
+            if timing is not None:
+                app.finish_timing(instance, timing, response)
+            if trace is not None:
+                app.TRACER.finish(instance, trace, timing, response)
+            if app.ACCESS_LOG is not None:
+                app.ACCESS_LOG.log(instance, response,
+                                   time.perf_counter() - started)
+            return response
+        except Exception as e:
+            get_reporter().report(e, 'Uncaught exception in service: %s',
+                                  log=logger)
+            raise
+
+    async def call_resource(self, instance):
+        """Calls the given resource instance, awaiting all the coroutines
+        returned by its methods. The async equivalent of
+        :func:`wsgiservice.Resource.__call__`. Returns the response.
+
+        :param instance: The resource instance.
+        :type instance: :class:`wsgiservice.Resource`
+        """
+        timing = instance.get_timing()
+        if timing is not None:
+            timing.mark('admission')
+        instance.type = instance.get_content_type()
+        try:
+            instance.method = instance.get_method()
+            instance.handle_ignored_resources()
+            instance.assert_exists()
+            instance.assert_deadline('routing')
+            await self.assert_conditions(instance)
+            if timing is not None:
+                timing.mark('conditions')
+            instance.assert_deadline('conditions')
+            instance.response.body_raw = await self.call_method(instance,
+                instance.method)
+            instance.forget_not_found()
+            if timing is not None:
+                timing.mark('method')
+            if instance.method in instance.DEADLINE_CHECKED_METHODS:
+                instance.assert_deadline(instance.method)
+        except Exception as e:
+            instance.handle_call_exception(e)
+        instance.convert_response()
+        if timing is not None:
+            timing.mark('serialization')
+        instance.set_response_headers()
+        if timing is not None:
+            timing.mark('headers')
+        return instance.response
+
+    async def call_resource_coalescing(self, instance):
+        """Calls :func:`call_resource_limited` and returns the response.
+        Coalesces the request with identical ones of the same event loop if
+        :attr:`wsgiservice.application.Application.COALESCE_REQUESTS` is
+        set. The async equivalent of
+        :func:`wsgiservice.application.Application._call_coalescing`.
+
+        :param instance: The resource instance.
+        :type instance: :class:`wsgiservice.Resource`
+        """
+        app = self.application
+        if not app.COALESCE_REQUESTS or \
+                instance.request.method not in ('GET', 'HEAD'):
+            return await self.call_resource_limited(instance)
+        loop = asyncio.get_running_loop()
+        key = (loop, app._get_coalesce_key(instance))
+        future = self._flights.get(key)
+        if future is None:
+            future = self._flights[key] = loop.create_future()
+            try:
+                response = await self.call_resource_limited(instance)
+            except BaseException as e:
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+                    # Avoids the warning if nobody else was waiting
+                    future.exception()
+                raise
+            else:
+                future.set_result(response.copy())
+                return response
+            finally:
+                del self._flights[key]
+        try:
+            # Shielded so a timeout doesn't cancel the other requests
+            shared = await asyncio.wait_for(asyncio.shield(future),
+                                            app.get_coalesce_timeout(instance))
+        except asyncio.TimeoutError:
+            shared = None
+        try:
+            instance.assert_deadline('waiting for a coalesced request')
+        except DeadlineExceededException as e:
+            return instance.get_exception_response(e)
+        if shared is None:
+            logger.warning("Timeout waiting for coalesced request, handling "
+                           "it separately.")
+            return await self.call_resource_limited(instance)
+        with app._lock:
+            app.coalesced_requests += 1
+        app._count_metric('count_coalesced', type(instance).__name__)
+        return shared.copy()
+
+    async def call_resource_limited(self, instance):
+        """Calls :func:`call_resource_cached` within the bulkhead of the
+        resource, see
+        :func:`wsgiservice.application.Application.get_bulkhead`. Requests
+        beyond the limit of the bulkhead are rejected right away.
+
+        :param instance: The resource instance.
+        :type instance: :class:`wsgiservice.Resource`
+        """
+        app = self.application
+        bulkhead = app.get_bulkhead(type(instance))
+        if bulkhead is None:
+            return await self.call_resource_cached(instance)
+        if not bulkhead.acquire(timeout=0):
+            return app._reject(instance, bulkhead)
+        start = time.time()
+        try:
+            return await self.call_resource_cached(instance)
+        finally:
+            bulkhead.release(time.time() - start)
+
+    async def call_resource_cached(self, instance):
+        """Calls :func:`call_resource` and returns the response. Uses the
+        :attr:`wsgiservice.application.Application.RESPONSE_CACHE` if the
+        resource's cache policy allows it. The async equivalent of
+        :func:`wsgiservice.application.Application._call_cached`.
+
+        :param instance: The resource instance.
+        :type instance: :class:`wsgiservice.Resource`
+        """
+        cache = self.application.RESPONSE_CACHE
+        if cache is None or not cache.is_cacheable_request(instance.request):
+            return await self.call_resource(instance)
+        policy = instance.get_cache_policy()
+        if policy is None or not policy.shared:
+            return await self.call_resource(instance)
+        loop = asyncio.get_running_loop()
+
+        def call(instance):
+            # Called by the refreshing thread
+            return asyncio.run_coroutine_threadsafe(
+                self.call_resource(instance), loop).result()
+
+        response, state = cache.lookup(instance, policy, call=call)
+        if response is not None:
+            return response
+        return cache.store(state, await self.call_resource(instance))
+
+    async def call_resource_sync(self, instance):
+        """Calls the given resource instance, which has no coroutine
+        functions, in its thread pool. Returns the response.
+
+        :param instance: The resource instance.
+        :type instance: :class:`wsgiservice.Resource`
+        """
+        pool = self.get_pool(get_pool_name(instance, instance.request.method))
+        try:
+            return await run_in_pool(pool, self.application._call_resource,
+                                     instance)
+        except PoolFullException as e:
+            return instance.get_exception_response(e)
+
+    async def assert_conditions(self, instance):
+        """The async equivalent of
+        :func:`wsgiservice.Resource.assert_conditions`.
+
+        :param instance: The resource instance.
+        :type instance: :class:`wsgiservice.Resource`
+        """
+        instance.assert_condition_md5()
+        instance.clean_etag(await self.call_method(instance, 'get_etag'))
+        instance.response.last_modified = await self.call_method(instance,
+            'get_last_modified')
+        instance.assert_condition_etag()
+        instance.assert_condition_last_modified()
+
+    async def call_method(self, instance, method_name):
+        """Calls the method using
+        :func:`wsgiservice.Resource.call_method` and returns its return
+        value. Coroutines are awaited. Methods marked with the
+        :func:`wsgiservice.decorators.offload` decorator are called in their
+        thread pool.
+
+        :param instance: The resource instance.
+        :type instance: :class:`wsgiservice.Resource`
+        :param method_name: Name of the method to call.
+        :type method_name: str
+        """
+        pool_name = getattr(getattr(instance, method_name), '_offload_pool',
+                            None)
+        if pool_name is not None:
+            return await resolve(await run_in_pool(self.get_pool(pool_name),
+                instance.call_method, method_name))
+        return await resolve(instance.call_method(method_name))
+
+    def get_pool(self, name):
+        """Returns the :class:`wsgiservice.concurrency.ThreadPool` of the
+        given name, creating it if necessary.
+
+        :param name: Name of the pool.
+        :type name: str
+        """
+        pool = self.pools.get(name)
+        if pool is None:
+            pool = self.pools.setdefault(name, ThreadPool(name,
+                size=self.POOL_SIZE, max_queue=self.POOL_MAX_QUEUE))
+        return pool
+
+    def _warn_thread_options(self):
+        """Logs a warning for each of the :attr:`THREAD_OPTIONS` set on the
+        application, once per option."""
+        for name in self.THREAD_OPTIONS:
+            if name not in self._warned and \
+                    getattr(self.application, name) is not None:
+                self._warned.add(name)
+                logger.warning("%s doesn't apply to coroutine resources "
+                               "served through ASGI.", name)
+
+    async def _read_body(self, receive):
+        """Reads the complete request body."""
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    async def _lifespan(self, receive, send):
+        """Acknowledges the startup and shutdown events."""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _get_environ(self, scope, body):
+        """Returns a WSGI environment dictionary for the given scope. See
+        :pep:`3333` for the format."""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': _to_wsgi_str(scope.get('root_path', '')),
+            'PATH_INFO': _to_wsgi_str(scope['path']),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'asgi.scope': scope,
+        }
+        for key, value in scope.get('headers', []):
+            key = key.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if key == 'CONTENT_TYPE' or key == 'CONTENT_LENGTH':
+                environ[key] = value
+                continue
+            key = 'HTTP_' + key
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+        if 'CONTENT_LENGTH' not in environ and body:
+            environ['CONTENT_LENGTH'] = str(len(body))
+        return environ
+
+
+def is_async(instance):
+    """Returns True if the method of the current request, ``get_etag`` or
+    ``get_last_modified`` of the given resource instance is a coroutine
+    function.
+
+    :param instance: The resource instance.
+    :type instance: :class:`wsgiservice.Resource`
+    """
+    method = instance.request.method
+    if method == 'HEAD' and not hasattr(instance, 'HEAD'):
+        method = 'GET'
+    for name in (method, 'get_etag', 'get_last_modified'):
+        func = getattr(instance, name, None)
+        if func is not None and inspect.iscoroutinefunction(
+                inspect.unwrap(func)):
+            return True
+    return False
+
+
+def get_pool_name(instance, method_name):
+    """Returns the name of the thread pool for the given method of the
+    resource instance. That's the pool set with the
+    :func:`wsgiservice.decorators.offload` decorator on the method, the
+    :attr:`wsgiservice.Resource.OFFLOAD_POOL` of the resource or
+    ``default``.
+
+    :param instance: The resource instance.
+    :type instance: :class:`wsgiservice.Resource`
+    :param method_name: Name of the method.
+    :type method_name: str
+    """
+    if method_name == 'HEAD' and not hasattr(instance, 'HEAD'):
+        method_name = 'GET'
+    return getattr(getattr(instance, method_name, None), '_offload_pool',
+                   None) or instance.OFFLOAD_POOL or 'default'
+
+
+async def run_in_pool(pool, func, *args):
+    """Calls `func` with the given arguments in the thread pool and returns
+    its return value.
+
+    :param pool: The pool to use.
+    :type pool: :class:`wsgiservice.concurrency.ThreadPool`
+    :param func: The function to call.
+    :type func: callable
+
+    :raises: :class:`wsgiservice.exceptions.PoolFullException` if the queue
+             of the pool is full.
+    """
+    return await asyncio.wrap_future(pool.submit(func, *args))
+
+
+async def fan_out(instance, calls, timeout=None):
+    """Calls methods of other resources concurrently and returns a list of
+    their return values in the same order. The async equivalent of
+    :func:`wsgiservice.Resource.fan_out`, which describes the parameters.
+    Coroutine methods are awaited on the event loop and cancelled when they
+    time out. All other methods are called in the thread pool
+    :attr:`wsgiservice.Resource.FAN_OUT_POOL`.
+
+    Example::
+
+        async def GET(self, id):
+            user, orders = await fan_out(self, [
+                (User, 'GET', {'id': id}),
+                (Orders, 'GET', {'user': id}),
+            ], timeout=2)
+
+    :param instance: The calling resource instance.
+    :type instance: :class:`wsgiservice.Resource`
+    :param calls: List of tuples of the resource class, the name of the
+                  method, the named arguments and optionally the timeout.
+    :type calls: list
+    :param timeout: Maximum time in seconds to wait for each call. Defaults
+                    to the remaining time of the request. None waits
+                    forever.
+    :type timeout: float
+    """
+    if timeout is None:
+        timeout = instance.get_remaining_time()
+    pool = get_thread_pool(instance.FAN_OUT_POOL)
+    awaitables = []
+    for call in calls:
+        resource, method, kwargs = call[:3]
+        sub_instance = instance.get_resource(resource,
+                                             response=webob.Response())
+        func = getattr(sub_instance, method)
+        if inspect.iscoroutinefunction(inspect.unwrap(func)):
+            awaitable = func(**kwargs)
+        else:
+            awaitable = run_in_pool(pool, functools.partial(func, **kwargs))
+        awaitables.append(_wait_for(awaitable,
+            call[3] if len(call) > 3 else timeout, func))
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def _wait_for(awaitable, timeout, func):
+    """Awaits the awaitable, raising a
+    :class:`wsgiservice.exceptions.TimeoutException` after the timeout."""
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutException(
+            "Call of {0!r} timed out after {1} seconds.".format(
+                func, timeout))
+
+
+async def resolve(value):
+    """Returns the value, awaiting it first if it's awaitable."""
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+def _to_wsgi_str(value):
+    """Converts a unicode path to the latin-1 "bytes as str" representation
+    required by WSGI."""
+    return value.encode('utf-8').decode('latin-1')
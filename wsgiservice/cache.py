@@ -0,0 +1,928 @@
+"""Caching support for WsgiService: cache backends, cache policies and the
+in-process response cache.
+
+All backends implement the small interface defined by :class:`CacheBackend`.
+:class:`MemoryCache` keeps the values inside the current process while
+:class:`MemcachedCache` talks to one or more memcached servers using the
+memcached text protocol and can be shared across hosts.
+
+A :class:`CachePolicy` describes how clients and intermediate caches may
+cache a resource. Policies are attached to resources using the
+:attr:`wsgiservice.Resource.CACHE_POLICY` attribute or the
+:func:`wsgiservice.decorators.cache_policy` decorator. If the application has
+a :class:`ResponseCache` configured, responses of resources with a shared
+policy are additionally cached in-process.
+"""
+import collections
+import hashlib
+import logging
+import math
+import pickle
+import re
+import socket
+import struct
+import threading
+import time
+import zlib
+from datetime import timedelta
+from email.utils import formatdate
+
+import webob
+from webob import timedelta_to_seconds
+
+from wsgiservice.errors import get_reporter
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend(object):
+    """Interface of all the cache backends. A backend maps string keys to
+    arbitrary Python values, each of them with an optional time to live.
+
+    Backends must never raise exceptions for operational problems (a server
+    which can't be reached, a timeout, etc.). Instead they behave as if the
+    value was not in the cache. Callers can always fall back to computing the
+    value.
+    """
+
+    def get(self, key):
+        """Returns the value stored for the given key or None if the key is
+        not in the cache (or has expired).
+
+        :param key: Key to look up.
+        :type key: str
+        """
+        raise NotImplementedError()
+
+    def get_many(self, keys):
+        """Returns a dictionary with the values of all the given keys which
+        were found in the cache. Missing keys are not included in the
+        dictionary. Backends should overwrite this to fetch all the keys in
+        one go.
+
+        :param keys: Keys to look up.
+        :type keys: list of str
+        """
+        retval = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                retval[key] = value
+        return retval
+
+    def set(self, key, value, ttl=None):
+        """Stores the value under the given key.
+
+        :param key: Key to store the value under.
+        :type key: str
+        :param value: Value to store. Must be picklable for remote backends.
+        :type value: Any valid Python value
+        :param ttl: Number of seconds after which the value expires. None
+                    means the value doesn't expire (but may still be evicted).
+        :type ttl: int
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """Removes the given key from the cache.
+
+        :param key: Key to remove.
+        :type key: str
+        """
+        raise NotImplementedError()
+
+
+class MemoryCache(CacheBackend):
+    """Thread-safe in-process cache. The least recently used entries are
+    evicted when the cache holds more than `max_entries` values.
+
+    :param max_entries: Maximum number of entries to hold.
+    :type max_entries: int
+    :param currtime: Function used to find out the current time. This is used
+                     for testing and not required in production code.
+    :type currtime: Function returning a float
+    """
+
+    def __init__(self, max_entries=1000, currtime=time.time):
+        self.max_entries = max_entries
+        self.currtime = currtime
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= self.currtime():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = None
+        if ttl is not None:
+            expires = self.currtime() + ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Removes all the entries from the cache."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemcachedCache(CacheBackend):
+    """Client for memcached servers. Uses the text protocol of memcached and
+    keeps a pool of connections per server, so the same instance can be used
+    from multiple threads.
+
+    Keys are distributed over the servers by their CRC32 hash. Keys which
+    are not valid memcached keys (too long or containing whitespace) are
+    replaced by their MD5 hash.
+
+    Servers which can't be reached are skipped for `retry_interval` seconds.
+    During that time all reads from that server are misses and writes are
+    dropped.
+
+    :param servers: List of servers, either as ``host:port`` strings or as
+                    ``(host, port)`` tuples.
+    :type servers: list
+    :param timeout: Socket timeout in seconds for connecting and for each
+                    individual socket operation.
+    :type timeout: float
+    :param pool_size: Maximum number of idle connections to keep per server.
+    :type pool_size: int
+    :param retry_interval: Seconds to wait before connecting to a failed
+                           server again.
+    :type retry_interval: float
+    :param prefix: String prepended to all keys.
+    :type prefix: str
+    """
+
+    #: Flag stored with values that are bytes. Those are stored unmodified.
+    FLAG_BYTES = 0
+
+    #: Flag stored with values that have been pickled.
+    FLAG_PICKLE = 1
+
+    #: Maximum time to live which memcached interprets as relative value.
+    #: Bigger values have to be sent as absolute unix timestamp.
+    MAX_RELATIVE_TTL = 60 * 60 * 24 * 30
+
+    def __init__(self, servers, timeout=0.5, pool_size=10, retry_interval=30,
+                 prefix=''):
+        self.timeout = timeout
+        self.prefix = prefix
+        self._pools = []
+        for server in servers:
+            if isinstance(server, str):
+                host, port = server.rsplit(':', 1)
+                server = (host, int(port))
+            self._pools.append(ConnectionPool(server, timeout=timeout,
+                max_size=pool_size, retry_interval=retry_interval))
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Returns a dictionary with all the given keys which were found in
+        the cache. The request to each server is pipelined: one ``get``
+        command for all the keys on a server is sent to all servers before
+        any of the responses are read.
+        """
+        by_pool = collections.defaultdict(dict)
+        for key in keys:
+            cache_key = self._get_cache_key(key)
+            by_pool[self._get_pool(cache_key)][cache_key] = key
+
+        # Send all the requests
+        pending = []
+        for pool, cache_keys in by_pool.items():
+            conn = pool.acquire()
+            if conn is None:
+                continue
+            cmd = b'get ' + b' '.join(cache_keys) + b'\r\n'
+            try:
+                conn.send(cmd)
+            except (socket.error, MemcachedError) as e:
+                pool.fail(conn, e)
+                continue
+            pending.append((pool, conn, cache_keys))
+
+        # Read the responses
+        retval = {}
+        for pool, conn, cache_keys in pending:
+            try:
+                for cache_key, flags, data in self._read_values(conn):
+                    if cache_key in cache_keys:
+                        retval[cache_keys[cache_key]] = self._decode(
+                            flags, data)
+            except (socket.error, MemcachedError, ValueError,
+                    IndexError) as e:
+                # A truncated or garbled response leaves the connection in
+                # an unknown state, so it's dropped as well
+                pool.fail(conn, e)
+                continue
+            pool.release(conn)
+        return retval
+
+    def set(self, key, value, ttl=None):
+        cache_key = self._get_cache_key(key)
+        flags, data = self._encode(value)
+        exptime = 0
+        if ttl:
+            # Zero never expires, so sub-second TTLs are rounded up
+            exptime = max(1, int(math.ceil(ttl)))
+            if exptime > self.MAX_RELATIVE_TTL:
+                exptime = int(time.time()) + exptime
+        cmd = b'set ' + cache_key + b' ' + str(flags).encode('ascii') + \
+            b' ' + str(exptime).encode('ascii') + b' ' + \
+            str(len(data)).encode('ascii') + b'\r\n' + data + b'\r\n'
+        self._command(cache_key, cmd, (b'STORED',))
+
+    def delete(self, key):
+        cache_key = self._get_cache_key(key)
+        self._command(cache_key, b'delete ' + cache_key + b'\r\n',
+            (b'DELETED', b'NOT_FOUND'))
+
+    def _command(self, cache_key, cmd, expected):
+        """Sends a storage command to the server responsible for the key and
+        verifies the response line. Returns True if the command succeeded.
+        """
+        pool = self._get_pool(cache_key)
+        conn = pool.acquire()
+        if conn is None:
+            return False
+        try:
+            conn.send(cmd)
+            line = conn.readline()
+        except (socket.error, MemcachedError) as e:
+            pool.fail(conn, e)
+            return False
+        pool.release(conn)
+        if line not in expected:
+            logger.warning("Unexpected memcached response: %r", line)
+            return False
+        return True
+
+    def _read_values(self, conn):
+        """Reads the response to a ``get`` command. Yields three-item tuples
+        of key, flags and data.
+        """
+        while True:
+            line = conn.readline()
+            if line == b'END':
+                return
+            parts = line.split()
+            if len(parts) < 4 or parts[0] != b'VALUE':
+                raise MemcachedError("Invalid response line: %r" % line)
+            data = conn.read(int(parts[3]) + 2)[:-2]
+            yield parts[1], int(parts[2]), data
+
+    def _get_cache_key(self, key):
+        """Returns the key to send to memcached as bytes."""
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        key = self.prefix.encode('utf-8') + key
+        if len(key) > 250 or re.search(b'[\x00-\x20\x7f]', key):
+            key = hashlib.md5(key).hexdigest().encode('ascii')
+        return key
+
+    def _get_pool(self, cache_key):
+        """Returns the connection pool of the server responsible for the given
+        key."""
+        return self._pools[zlib.crc32(cache_key) % len(self._pools)]
+
+    def _encode(self, value):
+        """Returns a two-item tuple of flags and the data to store."""
+        if isinstance(value, bytes):
+            return self.FLAG_BYTES, value
+        return self.FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, flags, data):
+        """Inverse of :func:`_encode`."""
+        if flags == self.FLAG_PICKLE:
+            try:
+                return pickle.loads(data)
+            except Exception as e:
+                logger.warning("Could not unpickle cached value: %s", e)
+                return None
+        return data
+
+
+class MemcachedError(Exception):
+    """Raised by :class:`Connection` when the server sends an invalid
+    response or closes the connection. Never leaves the
+    :class:`MemcachedCache`, which treats it as a cache miss.
+    """
+
+
+class Connection(object):
+    """A buffered socket connection to one memcached server.
+
+    :param address: Two-item tuple of host and port.
+    :type address: tuple
+    :param timeout: Timeout in seconds for all socket operations.
+    :type timeout: float
+    """
+
+    def __init__(self, address, timeout):
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buffer = b''
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self):
+        """Returns the next line from the server without the trailing
+        ``\\r\\n``."""
+        while True:
+            pos = self._buffer.find(b'\r\n')
+            if pos >= 0:
+                line = self._buffer[:pos]
+                self._buffer = self._buffer[pos + 2:]
+                return line
+            self._fill()
+
+    def read(self, length):
+        """Returns exactly `length` bytes from the server."""
+        while len(self._buffer) < length:
+            self._fill()
+        data = self._buffer[:length]
+        self._buffer = self._buffer[length:]
+        return data
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise MemcachedError("Connection closed by server.")
+        self._buffer += data
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of :class:`Connection` objects to one server.
+
+    Connections are created on demand. At most `max_size` idle connections
+    are kept around, additional ones are closed when they are released.
+
+    :param address: Two-item tuple of host and port.
+    :type address: tuple
+    :param timeout: Timeout in seconds for all socket operations.
+    :type timeout: float
+    :param max_size: Maximum number of idle connections to keep.
+    :type max_size: int
+    :param retry_interval: Seconds to wait before connecting to the server
+                           again after a failure.
+    :type retry_interval: float
+    """
+
+    def __init__(self, address, timeout=0.5, max_size=10, retry_interval=30):
+        self.address = address
+        self.timeout = timeout
+        self.max_size = max_size
+        self.retry_interval = retry_interval
+        self._idle = []
+        self._lock = threading.Lock()
+        self._dead_until = 0
+
+    def acquire(self):
+        """Returns a connection or None if the server is not available."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            if self._dead_until > time.time():
+                return None
+        try:
+            return Connection(self.address, self.timeout)
+        except socket.error as e:
+            self.fail(None, e)
+            return None
+
+    def release(self, conn):
+        """Returns a healthy connection to the pool."""
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def fail(self, conn, error):
+        """Discards a connection after an error and marks the server as
+        unavailable for `retry_interval` seconds."""
+        get_reporter().report(error, "Memcached server {0}:{1} failed: %s"
+                              .format(self.address[0], self.address[1]),
+                              level=logging.WARNING, log=logger,
+                              exc_info=False)
+        if conn is not None:
+            conn.close()
+        with self._lock:
+            self._dead_until = time.time() + self.retry_interval
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class CachePolicy(object):
+    """Caching rules for the representations of a resource. All the header
+    values are computed once when the policy is created, so applying the
+    policy to a response is cheap.
+
+    Durations can be given as number of seconds or as
+    :class:`datetime.timedelta`.
+
+    :param max_age: Age which the resource may have before becoming stale.
+    :param s_maxage: Same as `max_age` but only for shared caches. Overrides
+                     `max_age` for them.
+    :param stale_while_revalidate: Time during which a stale response may be
+                                   served while it's being refreshed in the
+                                   background.
+    :param stale_if_error: Time during which a stale response may be served
+                           if generating a new one fails.
+    :param private: Whether the response is intended for a single user and
+                    must not be stored by shared caches.
+    :type private: bool
+    :param no_store: Whether the response must not be stored at all.
+    :type no_store: bool
+    :param vary: List of headers that should be added to the Vary response
+                 header.
+    :type vary: list of strings
+    :param surrogate_keys: List of keys sent in the ``Surrogate-Key``
+                           response header, used by CDNs to purge groups of
+                           responses. Keys may reference path parameters in
+                           the same ``{keyword}`` syntax as used for routing.
+    :type surrogate_keys: list of strings
+    :param currtime: Function used to find out the current UTC time. This is
+                     used for testing and not required in production code.
+    :type currtime: Function returning a float
+    """
+
+    def __init__(self, max_age=None, s_maxage=None,
+                 stale_while_revalidate=None, stale_if_error=None,
+                 private=False, no_store=False, vary=None,
+                 surrogate_keys=None, currtime=time.time):
+        self.max_age = _to_seconds(max_age)
+        self.s_maxage = _to_seconds(s_maxage)
+        self.stale_while_revalidate = _to_seconds(stale_while_revalidate)
+        self.stale_if_error = _to_seconds(stale_if_error)
+        self.private = private
+        self.no_store = no_store
+        self.currtime = currtime
+
+        directives = []
+        if no_store:
+            directives.append('no-store')
+        if private:
+            directives.append('private')
+        for name, value in (('max-age', self.max_age),
+                            ('s-maxage', self.s_maxage),
+                            ('stale-while-revalidate',
+                             self.stale_while_revalidate),
+                            ('stale-if-error', self.stale_if_error)):
+            if value is not None:
+                directives.append('{0}={1}'.format(name, value))
+        #: Value of the ``Cache-Control`` response header.
+        self.cache_control = ', '.join(directives)
+
+        #: Headers to add to the ``Vary`` response header.
+        self.vary = tuple(vary or ())
+
+        keys = list(surrogate_keys or ())
+        self._surrogate_keys = tuple(keys)
+        #: Value of the ``Surrogate-Key`` response header for all the keys
+        #: which don't depend on path parameters.
+        self.surrogate_key = ' '.join(k for k in keys if '{' not in k)
+        self._surrogate_templates = tuple(k for k in keys if '{' in k)
+
+        # Tuple of the second for which the Expires header was formatted and
+        # the formatted header.
+        self._expires = (None, None)
+        # Maps TTLs to the policies returned by get_error_policy
+        self._error_policies = {}
+
+    @property
+    def shared_max_age(self):
+        """Age in seconds which the resource may have in a shared cache
+        before becoming stale."""
+        if self.s_maxage is not None:
+            return self.s_maxage
+        return self.max_age
+
+    @property
+    def shared(self):
+        """Whether responses with this policy may be stored by shared
+        caches."""
+        return (not self.private and not self.no_store and
+                bool(self.shared_max_age))
+
+    def get_error_policy(self, ttl):
+        """Returns the policy for error responses which may be cached for
+        at most `ttl` seconds, such as a not found. It has the same `private`,
+        `no_store`, `vary` and `surrogate_keys` as this policy, the ages
+        limited to `ttl` and no ``stale-*`` directives.
+
+        :param ttl: Maximum age of the error responses in seconds.
+        :type ttl: int
+        """
+        policy = self._error_policies.get(ttl)
+        if policy is None:
+            policy = self._error_policies[ttl] = CachePolicy(
+                max_age=_limit(self.max_age, ttl),
+                s_maxage=_limit(self.s_maxage, ttl), private=self.private,
+                no_store=self.no_store, vary=self.vary,
+                surrogate_keys=self._surrogate_keys, currtime=self.currtime)
+        return policy
+
+    def apply(self, response, path_params=None):
+        """Sets the caching response headers on the given response.
+
+        :param response: The response to modify.
+        :type response: :class:`webob.Response`
+        :param path_params: Path parameters of the request. Used to fill in
+                            the surrogate keys.
+        :type path_params: dict
+        """
+        headers = response.headers
+        if self.cache_control:
+            headers['Cache-Control'] = self.cache_control
+        if self.max_age is not None:
+            headers['Expires'] = self.get_expires()
+        if self.vary:
+            current = response.vary
+            if not current:
+                response.vary = self.vary
+            else:
+                response.vary = tuple(current) + tuple(
+                    v for v in self.vary if v not in current)
+        surrogate_key = self.surrogate_key
+        if self._surrogate_templates:
+            keys = [t.format(**(path_params or {}))
+                    for t in self._surrogate_templates]
+            surrogate_key = ' '.join([surrogate_key] + keys).strip()
+        if surrogate_key:
+            headers['Surrogate-Key'] = surrogate_key
+
+    def get_expires(self):
+        """Returns the value of the ``Expires`` response header. The value is
+        only formatted once per second."""
+        now = int(self.currtime())
+        second, value = self._expires
+        if second != now:
+            value = formatdate(now + self.max_age, usegmt=True)
+            self._expires = (now, value)
+        return value
+
+
+class ResponseCache(object):
+    """In-process cache of serialized responses. Used by the application for
+    GET and HEAD requests of resources which have a shared
+    :class:`CachePolicy`. Assign an instance to
+    :attr:`wsgiservice.application.Application.RESPONSE_CACHE` to enable it.
+
+    Fresh responses are served from the cache without calling the resource.
+    Stale responses are served while they are within the
+    ``stale-while-revalidate`` window of the policy. In that case one
+    background thread per response recomputes the response. It gets a copy
+    of the request without the deadline, timing or trace of the client's
+    request and with the deadline of
+    :attr:`wsgiservice.application.Application.DEADLINE` instead. If
+    computing a response fails with a server error, the stale response is
+    served while it's within the ``stale-if-error`` window.
+
+    Conditional requests always bypass the cache. The cache key consists of
+    the resource, the path and query string, the ``Accept`` header and all
+    the request headers listed in the policy's `vary` attribute.
+
+    Whether a request was served from the cache is stored in the
+    ``wsgiservice.cache`` key of the WSGI environment: ``'hit'``,
+    ``'stale'`` or ``'miss'``.
+
+    :param backend: Cache backend to store the responses in. Defaults to a
+                    :class:`MemoryCache`.
+    :type backend: :class:`CacheBackend`
+    :param currtime: Function used to find out the current time. This is
+                     used for testing and not required in production code.
+    :type currtime: Function returning a float
+    """
+
+    #: Status codes of the responses which get stored.
+    CACHEABLE_STATUS = (200, 203, 300, 301, 308)
+
+    #: Request headers which make a request conditional.
+    CONDITIONAL_HEADERS = ('If-Match', 'If-None-Match', 'If-Modified-Since',
+                           'If-Unmodified-Since')
+
+    def __init__(self, backend=None, currtime=time.time):
+        if backend is None:
+            backend = MemoryCache()
+        self.backend = backend
+        self.currtime = currtime
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def is_cacheable_request(self, request):
+        """Returns True if the given request may be answered from the cache.
+
+        :param request: Object representing the current request.
+        :type request: :class:`webob.Request`
+        """
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        headers = request.headers
+        for header in self.CONDITIONAL_HEADERS:
+            if header in headers:
+                return False
+        return True
+
+    def get_key(self, instance, policy):
+        """Returns the cache key for the request of the given resource
+        instance."""
+        request = instance.request
+        parts = [type(instance).__module__, type(instance).__name__,
+                 request.path_qs, request.headers.get('Accept', '')]
+        for header in policy.vary:
+            parts.append(request.headers.get(header, ''))
+        digest = hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+        return 'wsgiservice.response:' + digest
+
+    def __call__(self, instance, policy):
+        """Returns the response for the given resource instance, either from
+        the cache or by calling the instance.
+
+        :param instance: The resource instance to serve.
+        :type instance: :class:`wsgiservice.Resource`
+        :param policy: The cache policy of the resource.
+        :type policy: :class:`CachePolicy`
+        """
+        response, state = self.lookup(instance, policy)
+        if response is not None:
+            return response
+        return self.store(state, instance())
+
+    def lookup(self, instance, policy, call=None):
+        """Looks up the response for the given resource instance. Returns a
+        two-item tuple of the cached response, or None if the resource has
+        to be called, and the state to pass to :func:`store` together with
+        the response of the resource.
+
+        :param instance: The resource instance to serve.
+        :type instance: :class:`wsgiservice.Resource`
+        :param policy: The cache policy of the resource.
+        :type policy: :class:`CachePolicy`
+        :param call: Function computing the response of a resource instance,
+                     called by the background thread refreshing a stale
+                     response. Defaults to calling the instance.
+        :type call: callable
+        """
+        environ = instance.request.environ
+        key = self.get_key(instance, policy)
+        entry = self.backend.get(key)
+        now = self.currtime()
+        max_age = policy.shared_max_age
+        if entry is not None:
+            age = now - entry[0]
+            if age < max_age:
+                environ['wsgiservice.cache'] = 'hit'
+                return self._get_response(entry, age), None
+            if age < max_age + (policy.stale_while_revalidate or 0):
+                environ['wsgiservice.cache'] = 'stale'
+                self._refresh_in_background(key, instance, policy, call)
+                return self._get_response(entry, age), None
+        environ['wsgiservice.cache'] = 'miss'
+        return None, (key, entry, now, policy, environ)
+
+    def store(self, state, response):
+        """Stores the response of the resource after :func:`lookup` returned
+        no response. Returns the response to send, which is the stale
+        cached one if the resource failed and the policy allows it.
+
+        :param state: The state returned by :func:`lookup`.
+        :type state: tuple
+        :param response: The response of the resource.
+        :type response: :class:`webob.Response`
+        """
+        key, entry, now, policy, environ = state
+        if response.status_int >= 500 and entry is not None:
+            age = now - entry[0]
+            if age < policy.shared_max_age + (policy.stale_if_error or 0):
+                environ['wsgiservice.cache'] = 'stale'
+                return self._get_response(entry, age)
+        self._store(key, response, policy, now)
+        return response
+
+    def _store(self, key, response, policy, now):
+        """Stores the response if its status code allows it."""
+        if response.status_int not in self.CACHEABLE_STATUS:
+            return
+        entry = (now, response.status, list(response.headerlist),
+                 response.body)
+        ttl = policy.shared_max_age + max(policy.stale_while_revalidate or 0,
+                                          policy.stale_if_error or 0)
+        self.backend.set(key, entry, ttl=ttl)
+
+    def _get_response(self, entry, age):
+        """Creates a new response object from a cache entry."""
+        stored, status, headerlist, body = entry
+        response = webob.Response(status=status, headerlist=list(headerlist),
+                                  body=body)
+        response.headers['Age'] = str(int(age))
+        return response
+
+    def _refresh_in_background(self, key, instance, policy, call=None):
+        """Starts a thread to recompute the response unless one is already
+        running for the same key."""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        request = instance.request.copy()
+        # The deadline, timing, trace and loaders belong to the client's
+        # request, which has already been answered.
+        for name in list(request.environ):
+            if name.startswith('wsgiservice.'):
+                del request.environ[name]
+        application = instance.application
+        timeout = getattr(application, 'DEADLINE', None)
+        if timeout is not None:
+            request.environ['wsgiservice.deadline'] = \
+                time.monotonic() + timeout
+        t = threading.Thread(target=self._refresh, args=(key, type(instance),
+            request, dict(instance.path_params), application, policy, call))
+        t.daemon = True
+        t.start()
+
+    def _refresh(self, key, resource, request, path_params, application,
+                 policy, call):
+        """Recomputes and stores a response. Runs in a background thread."""
+        try:
+            now = self.currtime()
+            instance = resource(request=request,
+                response=webob.Response(request=request),
+                path_params=path_params, application=application)
+            response = instance() if call is None else call(instance)
+            self._store(key, response, policy, now)
+        except Exception as e:
+            get_reporter().report(e,
+                "Refreshing a cached response failed: %s", log=logger)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+class NegativeCache(object):
+    """Remembers requests for which a resource raised one of its
+    :attr:`wsgiservice.Resource.NOT_FOUND` exceptions. Entries are grouped by
+    path, so all the entries of a path can be removed when the path is
+    written to.
+
+    :param max_paths: Maximum number of paths to remember. The oldest paths
+                      are removed first.
+    :type max_paths: int
+    :param currtime: Function used to find out the current time. This is
+                     used for testing and not required in production code.
+    :type currtime: Function returning a float
+    """
+
+    def __init__(self, max_paths=10000, currtime=time.time):
+        self.max_paths = max_paths
+        self.currtime = currtime
+        self._paths = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, resource, path, query, ttl):
+        """Remembers that the given request did not find anything.
+
+        :param resource: The resource class.
+        :type resource: :class:`wsgiservice.Resource`
+        :param path: The request path without extension.
+        :type path: str
+        :param query: The query string of the request.
+        :type query: str
+        :param ttl: Number of seconds to remember the request.
+        :type ttl: float
+        """
+        expires = self.currtime() + ttl
+        with self._lock:
+            entries = self._paths.get(path)
+            if entries is None:
+                entries = self._paths[path] = {}
+                while len(self._paths) > self.max_paths:
+                    self._paths.popitem(last=False)
+            entries[(resource, query)] = expires
+
+    def __contains__(self, key):
+        """Returns True if the given three-item tuple of resource, path and
+        query string is known not to exist."""
+        resource, path, query = key
+        entries = self._paths.get(path)
+        if not entries:
+            return False
+        expires = entries.get((resource, query))
+        if expires is None:
+            return False
+        if expires <= self.currtime():
+            with self._lock:
+                entries.pop((resource, query), None)
+            return False
+        return True
+
+    def clear_path(self, path):
+        """Removes all the entries of the given path.
+
+        :param path: The request path without extension.
+        :type path: str
+        """
+        if path in self._paths:
+            with self._lock:
+                self._paths.pop(path, None)
+
+    def __len__(self):
+        return sum(len(entries) for entries in list(self._paths.values()))
+
+
+class BloomFilter(object):
+    """Probabilistic set of keys. Membership tests never give false
+    negatives, but have a configurable rate of false positives. Used with
+    :attr:`wsgiservice.Resource.EXISTENCE_FILTER` to reject requests for
+    items which don't exist without calling the resource.
+
+    :param capacity: Number of keys the filter is sized for.
+    :type capacity: int
+    :param error_rate: Rate of false positives when the filter holds
+                       `capacity` keys.
+    :type error_rate: float
+    :param keys: Keys to add to the filter.
+    :type keys: iterable of strings
+    """
+
+    def __init__(self, capacity, error_rate=0.01, keys=None):
+        size = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.size = max(int(math.ceil(size)), 8)
+        self.hashes = max(int(round(self.size / float(capacity) *
+                                    math.log(2))), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+        for key in keys or ():
+            self.add(key)
+
+    def add(self, key):
+        """Adds the given key to the filter.
+
+        :param key: The key to add.
+        :type key: str
+        """
+        positions = self._get_positions(key)
+        with self._lock:
+            for pos in positions:
+                self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        bits = self._bits
+        for pos in self._get_positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def _get_positions(self, key):
+        """Returns the bit positions of the given key using double
+        hashing."""
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.sha1(key).digest()[:16])
+        h2 |= 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+
+def _limit(value, maximum):
+    """Returns the smaller of the two values, or None if the value is
+    None."""
+    if value is None:
+        return None
+    return min(value, maximum)
+
+
+def _to_seconds(duration):
+    """Converts a :class:`datetime.timedelta` to an integer number of
+    seconds. Other values are returned unmodified."""
+    if isinstance(duration, timedelta):
+        return int(timedelta_to_seconds(duration))
+    return duration
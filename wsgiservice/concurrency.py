@@ -0,0 +1,632 @@
+"""Helpers to coordinate work between the threads and processes serving
+requests."""
+import importlib
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from wsgiservice.exceptions import PoolFullException, TimeoutException
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    resource_tracker = shared_memory = None
+
+#: Thread and process pools by name. See :func:`get_thread_pool` and
+#: :func:`get_process_pool`.
+_thread_pools = {}
+_process_pools = {}
+_pools_lock = threading.Lock()
+
+#: Functions which can be called in a process pool, by their name. See
+#: :func:`register_function`.
+_functions = {}
+
+
+class SingleFlight(object):
+    """Executes a function only once for concurrent calls with the same key.
+    The first caller for a key executes the function while all the other
+    callers with that key wait for it and get the same result. If the
+    function raises an exception, that exception is raised for all the
+    callers.
+
+    Once the function returned, the next call with the same key executes the
+    function again. Results are not cached.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, timeout=None):
+        """Calls `func` unless a call for the same key is already in flight.
+        Returns a two-item tuple of the return value and a boolean which is
+        True if the value was shared from another caller's call.
+
+        :param key: Identifies the call. Must be hashable.
+        :param func: Function to call without any arguments.
+        :type func: callable
+        :param timeout: Maximum time in seconds to wait for another caller's
+                        call. None waits forever.
+        :type timeout: float
+
+        :raises: :class:`wsgiservice.exceptions.TimeoutException` if the
+                 other call did not finish within the timeout.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        if not leader:
+            if not call.done.wait(timeout):
+                raise TimeoutException(
+                    "Timeout waiting for concurrent call to finish.")
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+        try:
+            call.value = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value, False
+
+    def __len__(self):
+        """Returns the number of calls currently in flight."""
+        return len(self._calls)
+
+
+class _Call(object):
+    """State of one call of :class:`SingleFlight`."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class BackgroundThread(object):
+    """Daemon thread which calls a function over and over until it's
+    stopped. Used for the housekeeping of the process, like flushing logs or
+    sampling stacks. Thread-safe.
+
+    Threads don't survive a fork, so :func:`start` starts the thread again
+    if it was started in another process. Call it whenever the thread is
+    needed, it does nothing if the thread is already running.
+
+    :param func: Function called without arguments by the thread.
+    :type func: callable
+    :param interval: Number of seconds to wait before each call. None calls
+                     the function again right away, for functions which
+                     wait themselves, for example on a queue.
+    :type interval: float
+    :param name: Name of the thread.
+    :type name: str
+    :param on_error: Function called with the exceptions raised by `func`.
+                     They don't stop the thread.
+    :type on_error: callable
+    """
+
+    def __init__(self, func, interval=None, name=None, on_error=None):
+        self.func = func
+        self.interval = interval
+        self.name = name
+        self.on_error = on_error
+        self._thread = None
+        self._pid = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        """Whether the thread was started in this process and not stopped
+        since."""
+        return self._pid == os.getpid()
+
+    def start(self):
+        """Starts the thread unless it's already running in this process.
+        Returns True if a new thread was started."""
+        with self._lock:
+            pid = os.getpid()
+            if self._pid == pid:
+                return False
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._run,
+                args=(self._stopped,), name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = pid
+            return True
+
+    def stop(self, wake=None):
+        """Stops the thread and waits for it to finish its current call.
+
+        :param wake: Function called after signalling the thread to stop, to
+                     wake up a `func` which is waiting.
+        :type wake: callable
+        """
+        with self._lock:
+            thread, stopped = self._thread, self._stopped
+            running = thread is not None and self._pid == os.getpid()
+            self._thread = self._pid = None
+        if running:
+            stopped.set()
+            if wake is not None:
+                wake()
+            thread.join()
+
+    def is_alive(self):
+        """Returns True if the thread of this process is alive."""
+        thread = self._thread
+        return thread is not None and self.running and thread.is_alive()
+
+    def _run(self, stopped):
+        """Runs in the thread until `stopped` is set."""
+        while not stopped.is_set():
+            if self.interval is not None and stopped.wait(self.interval):
+                return
+            try:
+                self.func()
+            except Exception as e:
+                if self.on_error is None:
+                    raise
+                self.on_error(e)
+
+
+class ThreadPool(object):
+    """Bounded pool of worker threads. At most `size` functions run at the
+    same time and at most `max_queue` functions wait for a free worker.
+    Submitting more work raises a
+    :class:`wsgiservice.exceptions.PoolFullException`.
+
+    The time functions spent waiting in the queue and the time they spent
+    running are tracked separately, see :func:`get_stats`.
+
+    :param name: Name of the pool, used for the thread names.
+    :type name: str
+    :param size: Number of worker threads.
+    :type size: int
+    :param max_queue: Maximum number of functions waiting for a worker.
+    :type max_queue: int
+    """
+
+    def __init__(self, name='default', size=10, max_queue=100):
+        self.name = name
+        self.size = size
+        self.max_queue = max_queue
+        self._executor = self._create_executor()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._queue_time = 0.0
+        self._run_time = 0.0
+
+    def submit(self, func, *args, **kwargs):
+        """Schedules `func` to be called with the given arguments. Returns a
+        :class:`concurrent.futures.Future`.
+
+        :raises: :class:`wsgiservice.exceptions.PoolFullException` if the
+                 queue of the pool is full.
+        """
+        with self._lock:
+            if self._pending >= self.size + self.max_queue:
+                self._rejected += 1
+                raise PoolFullException(
+                    "Queue of thread pool {0} is full.".format(self.name))
+            self._pending += 1
+        try:
+            future = self._executor.submit(self._run, time.time(), func,
+                                           args, kwargs)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        future.add_done_callback(self._cancelled)
+        return future
+
+    def get_stats(self):
+        """Returns a dictionary with the current state and the cumulated
+        statistics of the pool. Times are in seconds."""
+        with self._lock:
+            return {
+                'size': self.size,
+                'max_queue': self.max_queue,
+                'queued': self._pending - self._running,
+                'running': self._running,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'queue_time': self._queue_time,
+                'run_time': self._run_time,
+            }
+
+    def is_saturated(self):
+        """Returns True if all the workers are busy, so newly submitted
+        functions have to wait in the queue."""
+        return self._running >= self.size
+
+    def shutdown(self, wait=True):
+        """Stops the worker threads once the queued work is done."""
+        self._executor.shutdown(wait=wait)
+
+    def _cancelled(self, future):
+        """Removes cancelled functions from the queue."""
+        if future.cancelled():
+            with self._lock:
+                self._pending -= 1
+
+    def _create_executor(self):
+        """Returns the executor running the submitted functions."""
+        return ThreadPoolExecutor(max_workers=self.size,
+            thread_name_prefix='wsgiservice-' + self.name)
+
+    def _run(self, submitted, func, args, kwargs):
+        """Runs in the worker thread. Calls the function and updates the
+        statistics."""
+        start = time.time()
+        with self._lock:
+            self._running += 1
+            self._queue_time += start - submitted
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._pending -= 1
+                self._completed += 1
+                self._run_time += time.time() - start
+
+
+def gather(funcs, timeouts=None, pool=None):
+    """Calls all the functions concurrently and returns a list of their
+    return values in the same order. The functions are called without any
+    arguments.
+
+    The first function is called in the current thread unless it has a
+    timeout, the others in the thread pool. Functions which could not be
+    queued because the queue of the pool is full, or which are still waiting
+    for a worker when their result is needed while all the workers are busy,
+    are called in the current thread as well. So nested calls can't
+    dead-lock the pool.
+
+    If any of the functions raises an exception, the exception of the first
+    function in the list is raised once its turn comes. The other functions
+    continue to run in the background. Likewise functions which time out
+    are not interrupted. Functions called in the current thread can't time
+    out.
+
+    :param funcs: The functions to call.
+    :type funcs: list
+    :param timeouts: List with the maximum time in seconds to wait for each
+                     function, counted from the start of the call. None
+                     values wait forever.
+    :type timeouts: list
+    :param pool: The pool to use. Defaults to the result of
+                 :func:`get_thread_pool`.
+    :type pool: :class:`ThreadPool`
+
+    :raises: :class:`wsgiservice.exceptions.TimeoutException` if a
+             function didn't return within its timeout.
+    """
+    funcs = list(funcs)
+    if not funcs:
+        return []
+    if timeouts is None:
+        timeouts = [None] * len(funcs)
+    if pool is None:
+        pool = get_thread_pool()
+    start = time.time()
+    futures = []
+    for i, func in enumerate(funcs):
+        future = None
+        if i > 0 or timeouts[0] is not None:
+            try:
+                future = pool.submit(func)
+            except PoolFullException:
+                pass
+        futures.append(future)
+    results = []
+    for func, future, timeout in zip(funcs, futures, timeouts):
+        if future is None or (pool.is_saturated() and future.cancel()):
+            results.append(func())
+            continue
+        if timeout is not None:
+            timeout = max(0, start + timeout - time.time())
+        try:
+            results.append(future.result(timeout))
+        except FutureTimeoutError:
+            raise TimeoutException(
+                "Call of {0!r} timed out after {1} seconds.".format(
+                    func, timeouts[len(results)]))
+    return results
+
+
+class ProcessPool(ThreadPool):
+    """Bounded pool of worker processes for CPU-bound functions. The worker
+    processes are started on first use and then reused for all the following
+    calls. Like with :class:`ThreadPool` at most `max_queue` calls wait for a
+    free worker.
+
+    Only functions registered with :func:`register_function` can be called.
+    Arguments and return values are pickled, except for large byte strings
+    returned by the function. Those are passed back to the calling process
+    using shared memory.
+
+    If a worker process dies, for example because it was killed for using
+    too much memory, the calls it was running fail with a
+    :class:`concurrent.futures.process.BrokenProcessPool` exception and the
+    workers are replaced with new ones for the following calls.
+
+    :param name: Name of the pool.
+    :type name: str
+    :param size: Number of worker processes. Defaults to the number of CPUs.
+    :type size: int
+    :param max_queue: Maximum number of calls waiting for a worker.
+    :type max_queue: int
+    :param context: The :mod:`multiprocessing` context used to start the
+                    workers. Defaults to the platform's default.
+    """
+
+    #: Minimum size in bytes of return values passed back through shared
+    #: memory. (Default: 65536)
+    SHARED_MEMORY_THRESHOLD = 65536
+
+    def __init__(self, name='default', size=None, max_queue=100,
+                 context=None):
+        self._context = context
+        ThreadPool.__init__(self, name, size=size or os.cpu_count() or 1,
+                            max_queue=max_queue)
+
+    def start(self):
+        """Starts all the worker processes, so the first requests don't pay
+        for starting them."""
+        futures = [self._executor.submit(os.getpid)
+                   for i in range(self.size)]
+        for future in futures:
+            future.result()
+
+    def call(self, func, args=(), kwargs=None, timeout=None):
+        """Calls the registered function `func` in a worker process and
+        returns its return value.
+
+        :param func: Function to call. Must have been registered with
+                     :func:`register_function`.
+        :type func: callable
+        :param args: Positional arguments for the function.
+        :type args: tuple
+        :param kwargs: Keyword arguments for the function.
+        :type kwargs: dict
+        :param timeout: Maximum time in seconds to wait for the return value.
+                        None waits forever.
+        :type timeout: float
+
+        :raises: :class:`wsgiservice.exceptions.PoolFullException` if the
+                 queue of the pool is full.
+        :raises: :class:`wsgiservice.exceptions.TimeoutException` if the
+                 function did not return within the timeout. The worker
+                 process keeps running the function until it returns.
+        """
+        future = self.submit(_call_function, get_function_name(func),
+                             tuple(args), kwargs or {},
+                             self.SHARED_MEMORY_THRESHOLD)
+        try:
+            return _SharedBytes.load(future.result(timeout))
+        except FutureTimeoutError:
+            future.add_done_callback(_release_result)
+            raise TimeoutException(
+                "Call of {0} in process pool {1} timed out.".format(
+                    get_function_name(func), self.name))
+
+    def submit(self, func, *args, **kwargs):
+        """Schedules `func` to be called in a worker process. `func` and the
+        arguments must be picklable. Returns a
+        :class:`concurrent.futures.Future`.
+
+        :raises: :class:`wsgiservice.exceptions.PoolFullException` if the
+                 queue of the pool is full.
+        """
+        with self._lock:
+            if self._pending >= self.size + self.max_queue:
+                self._rejected += 1
+                raise PoolFullException(
+                    "Queue of process pool {0} is full.".format(self.name))
+            self._pending += 1
+            self._running = min(self._pending, self.size)
+        submitted = time.time()
+        executor = self._executor
+        try:
+            try:
+                future = executor.submit(func, *args, **kwargs)
+            except BrokenProcessPool:
+                executor = self._replace_executor(executor)
+                future = executor.submit(func, *args, **kwargs)
+        except Exception:
+            self._done(submitted)
+            raise
+        future.add_done_callback(
+            lambda f: self._done(submitted, executor, f))
+        return future
+
+    def _create_executor(self):
+        """Returns the executor running the submitted functions."""
+        return ProcessPoolExecutor(max_workers=self.size,
+                                   mp_context=self._context)
+
+    def _replace_executor(self, broken):
+        """Replaces the executor with a new one if it's still the given
+        broken one. Returns the current executor."""
+        with self._lock:
+            if self._executor is broken:
+                self._executor = self._create_executor()
+            executor = self._executor
+        if executor is not broken:
+            broken.shutdown(wait=False)
+        return executor
+
+    def _done(self, submitted, executor=None, future=None):
+        """Updates the statistics once a call finished. The time calls wait
+        for a worker process is not known, so the whole time is counted as
+        run time. Calls beyond the size of the pool count as queued. Replaces
+        the executor if a worker process died during the call."""
+        with self._lock:
+            self._pending -= 1
+            self._running = min(self._pending, self.size)
+            self._completed += 1
+            self._run_time += time.time() - submitted
+        if future is not None and not future.cancelled() and \
+                isinstance(future.exception(), BrokenProcessPool):
+            self._replace_executor(executor)
+
+
+def get_thread_pool(name='default'):
+    """Returns the :class:`ThreadPool` with the given name. Pools which
+    haven't been set with :func:`set_thread_pool` are created with the
+    default settings on first use.
+
+    :param name: Name of the pool.
+    :type name: str
+    """
+    return _get_pool(_thread_pools, ThreadPool, name)
+
+
+def set_thread_pool(pool):
+    """Configures a thread pool. Replaces any previous pool with the same
+    name, which is shut down.
+
+    :param pool: The pool to use for its name.
+    :type pool: :class:`ThreadPool`
+    """
+    _set_pool(_thread_pools, pool)
+
+
+def get_process_pool(name='default'):
+    """Returns the :class:`ProcessPool` with the given name. Pools which
+    haven't been set with :func:`set_process_pool` are created with the
+    default settings on first use.
+
+    :param name: Name of the pool.
+    :type name: str
+    """
+    return _get_pool(_process_pools, ProcessPool, name)
+
+
+def set_process_pool(pool):
+    """Configures a process pool. Replaces any previous pool with the same
+    name, which is shut down.
+
+    :param pool: The pool to use for its name.
+    :type pool: :class:`ProcessPool`
+    """
+    _set_pool(_process_pools, pool)
+
+
+def _get_pool(pools, cls, name):
+    """Returns the pool from the dictionary, creating it if necessary."""
+    pool = pools.get(name)
+    if pool is None:
+        with _pools_lock:
+            pool = pools.get(name)
+            if pool is None:
+                pool = pools[name] = cls(name)
+    return pool
+
+
+def _set_pool(pools, pool):
+    """Stores the pool in the dictionary, shutting down the previous one."""
+    with _pools_lock:
+        previous = pools.get(pool.name)
+        pools[pool.name] = pool
+    if previous is not None and previous is not pool:
+        previous.shutdown(wait=False)
+
+
+def register_function(func):
+    """Registers a function so it can be called in a :class:`ProcessPool`.
+    Functions are looked up by module and qualified name in the worker
+    processes, so they must be registered when their module is imported.
+    That's what :func:`wsgiservice.decorators.cpu_bound` does. Returns the
+    name under which the function was registered.
+
+    :param func: The function to register.
+    :type func: callable
+    """
+    name = get_function_name(func)
+    _functions[name] = func
+    return name
+
+
+def get_function_name(func):
+    """Returns the name of the function for :func:`register_function`."""
+    module = func.__module__
+    if module == '__mp_main__':
+        module = '__main__'
+    return module + ':' + getattr(func, '__qualname__', func.__name__)
+
+
+def _call_function(name, args, kwargs, threshold):
+    """Runs in the worker process. Calls the registered function and returns
+    its return value, using shared memory for large byte strings."""
+    func = _functions.get(name)
+    if func is None:
+        importlib.import_module(name.split(':', 1)[0])
+        func = _functions[name]
+    value = func(*args, **kwargs)
+    if (shared_memory is not None and isinstance(value, bytes)
+            and len(value) >= threshold):
+        return _SharedBytes.store(value)
+    return value
+
+
+def _release_result(future):
+    """Frees the shared memory of the result of a call nobody waits for."""
+    if not future.cancelled() and future.exception() is None:
+        _SharedBytes.load(future.result())
+
+
+class _SharedBytes(object):
+    """Reference to a byte string in a shared memory segment."""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    @classmethod
+    def store(cls, value):
+        """Copies the value into a new segment. The segment is freed by the
+        process which loads the value."""
+        segment = shared_memory.SharedMemory(create=True,
+                                             size=max(len(value), 1))
+        try:
+            segment.buf[:len(value)] = value
+        finally:
+            segment.close()
+        # The receiving process unlinks the segment, so the resource
+        # tracker must not clean it up when this worker exits. The tracker
+        # knows POSIX segments by their name with the leading slash, which
+        # the name attribute strips. Windows has no tracker for them.
+        if os.name == 'posix':
+            resource_tracker.unregister('/' + segment.name, 'shared_memory')
+        return cls(segment.name, len(value))
+
+    @classmethod
+    def load(cls, value):
+        """Returns the byte string if value is a :class:`_SharedBytes` and
+        frees its segment. Other values are returned unchanged."""
+        if not isinstance(value, cls):
+            return value
+        segment = shared_memory.SharedMemory(name=value.name)
+        try:
+            return bytes(segment.buf[:value.size])
+        finally:
+            segment.close()
+            segment.unlink()
@@ -1,8 +1,15 @@
+import asyncio
+import inspect
+import threading
 import time
 from decorator import decorator
 from datetime import timedelta
 from webob import timedelta_to_seconds
 
+from wsgiservice.cache import CachePolicy, MemoryCache
+from wsgiservice.concurrency import (SingleFlight, get_process_pool,
+    register_function)
+
 
 def mount(path):
     """Decorator. Apply on a :class:`wsgiservice.Resource` to mount it at the
@@ -41,9 +48,11 @@ def validate(name, re=None, convert=None, doc=None):
     """
 
     def wrap(cls_or_func):
-        if not hasattr(cls_or_func, '_validations'):
-            cls_or_func._validations = {}
-        cls_or_func._validations[name] = {'re': re, 'convert': convert, 'doc': doc}
+        # Copy instead of updating in place, so validations of a subclass or
+        # a wrapped function never leak into the inherited dictionary.
+        validations = dict(getattr(cls_or_func, '_validations', {}))
+        validations[name] = {'re': re, 'convert': convert, 'doc': doc}
+        cls_or_func._validations = validations
         return cls_or_func
     return wrap
 
@@ -64,6 +73,8 @@ def expires(duration, vary=None, currtime=time.time):
     """
     if isinstance(duration, timedelta):
         duration = timedelta_to_seconds(duration)
+    if vary:
+        vary = tuple(vary)
 
     @decorator
     def _expires(func, *args, **kwargs):
@@ -74,11 +85,209 @@ def expires(duration, vary=None, currtime=time.time):
         res.expires = currtime() + duration
 
         if vary:
-            if res.vary is None:
+            current = res.vary
+            if not current:
                 res.vary = vary
             else:
-                # A bit completed because res.vary is usually a tuple.
-                res.vary = list(set(list(res.vary) + list(vary)))
+                res.vary = tuple(current) + tuple(
+                    v for v in vary if v not in current)
 
         return func(*args, **kwargs)
     return _expires
+
+
+def cache_policy(policy=None, **kwargs):
+    """Decorator. Apply on a :class:`wsgiservice.Resource` or any of its
+    methods to declare how the responses may be cached. Takes either an
+    existing :class:`wsgiservice.cache.CachePolicy` instance or the keyword
+    arguments to create one. Applying it on a class is the same as setting
+    the :attr:`wsgiservice.Resource.CACHE_POLICY` attribute.
+
+    The policy is only applied to successful responses of GET and HEAD
+    requests. See :func:`wsgiservice.Resource.set_response_cache_policy`.
+
+    :param policy: The cache policy to use.
+    :type policy: :class:`wsgiservice.cache.CachePolicy`
+    :param kwargs: Arguments for :class:`wsgiservice.cache.CachePolicy` if no
+                   policy is given.
+    """
+    if policy is None:
+        policy = CachePolicy(**kwargs)
+
+    def wrap(cls_or_func):
+        if isinstance(cls_or_func, type):
+            cls_or_func.CACHE_POLICY = policy
+        else:
+            cls_or_func._cache_policy = policy
+        return cls_or_func
+    return wrap
+
+
+def memoize(ttl=None, max_entries=1000, cache=None):
+    """Decorator. Apply on a :class:`wsgiservice.Resource` method to cache its
+    return value. The cache key consists of the resource class and the
+    parameters as passed in by :func:`wsgiservice.Resource.call_method`, so
+    after validation and conversion. Contrary to the response caching the
+    cached value is independent of the requested representation.
+
+    Concurrent calls with the same parameters which are not cached yet only
+    call the method once. All the callers get the same result. Coroutine
+    methods are awaited and their result is cached, concurrent calls in the
+    same event loop wait for the first one.
+
+    The decorated method gets an `invalidate` function which takes the
+    resource class and optionally the method parameters. Without parameters
+    all the values cached for that resource class are invalidated. Use
+    :func:`wsgiservice.Resource.invalidate_memoized` to do that for all
+    memoized methods of a resource.
+
+    :param ttl: Number of seconds after which the cached value expires. None
+                means values don't expire.
+    :type ttl: int
+    :param max_entries: Maximum number of values to cache. Only used if no
+                        cache is given.
+    :type max_entries: int
+    :param cache: Cache backend to store the values in. Defaults to a new
+                  :class:`wsgiservice.cache.MemoryCache`. Invalidating all
+                  values of a resource only affects the current process.
+    :type cache: :class:`wsgiservice.cache.CacheBackend`
+    """
+    if isinstance(ttl, timedelta):
+        ttl = timedelta_to_seconds(ttl)
+    if cache is None:
+        cache = MemoryCache(max_entries=max_entries)
+    flight = SingleFlight()
+    # Maps the event loops and keys of the running coroutine calls to the
+    # futures of their results
+    futures = {}
+    # Maps the resource classes to the current generation of their keys
+    generations = {}
+    lock = threading.Lock()
+
+    def get_key(name, cls, args):
+        return 'memoize:{0}:{1}.{2}:{3}:{4!r}'.format(name, cls.__module__,
+            cls.__name__, generations.get(cls, 0), tuple(args))
+
+    def wrap(func):
+        name = getattr(func, '__qualname__', func.__name__)
+
+        def _memoize(func, *args, **kwargs):
+            "Returns the cached return value of the method."
+            key = get_key(name, type(args[0]), args[1:])
+            value = cache.get(key)
+            if value is not None:
+                return value[0]
+
+            def compute():
+                value = func(*args, **kwargs)
+                cache.set(key, (value,), ttl=ttl)
+                return value
+            return flight.do(key, compute)[0]
+
+        async def _memoize_async(func, *args, **kwargs):
+            "Returns the cached result of the coroutine method."
+            key = get_key(name, type(args[0]), args[1:])
+            value = cache.get(key)
+            if value is not None:
+                return value[0]
+            loop = asyncio.get_running_loop()
+            with lock:
+                future = futures.get((loop, key))
+                leader = future is None
+                if leader:
+                    future = futures[(loop, key)] = loop.create_future()
+            if not leader:
+                # Shielded so a cancelled caller doesn't cancel the others
+                return await asyncio.shield(future)
+            try:
+                value = await func(*args, **kwargs)
+            except BaseException as e:
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+                    # Avoids the warning if nobody else was waiting
+                    future.exception()
+                raise
+            else:
+                cache.set(key, (value,), ttl=ttl)
+                future.set_result(value)
+                return value
+            finally:
+                with lock:
+                    futures.pop((loop, key), None)
+
+        def invalidate(cls, *args):
+            """Invalidates the cached value for the given parameters or all
+            the values of the resource class if no parameters are given."""
+            if args:
+                cache.delete(get_key(name, cls, args))
+            else:
+                with lock:
+                    generations[cls] = generations.get(cls, 0) + 1
+
+        if inspect.iscoroutinefunction(func):
+            wrapped = decorator(_memoize_async, func)
+        else:
+            wrapped = decorator(_memoize, func)
+        wrapped.invalidate = invalidate
+        return wrapped
+    return wrap
+
+
+def offload(pool='default'):
+    """Decorator. Apply on a :class:`wsgiservice.Resource` or any of its
+    methods to mark blocking code. When served by the ASGI adapter (see
+    :mod:`wsgiservice.asgi`) the method is called in the given thread pool
+    instead of on the event loop. Applying it on a class is the same as
+    setting the :attr:`wsgiservice.Resource.OFFLOAD_POOL` attribute. Has no
+    effect for WSGI, where each request already has its own thread.
+
+    :param pool: Name of the thread pool to use.
+    :type pool: str
+    """
+
+    def wrap(cls_or_func):
+        if isinstance(cls_or_func, type):
+            cls_or_func.OFFLOAD_POOL = pool
+        else:
+            cls_or_func._offload_pool = pool
+        return cls_or_func
+    return wrap
+
+
+def cpu_bound(pool='default', timeout=None):
+    """Decorator. Apply on a :class:`wsgiservice.Resource` method to run it in
+    a worker process of the given :class:`wsgiservice.concurrency.ProcessPool`
+    instead of the thread serving the request. Use this for CPU-heavy work
+    which would otherwise hold the interpreter lock and block all the other
+    requests of the process.
+
+    The method gets the parameters as passed in by
+    :func:`wsgiservice.Resource.call_method`, so after validation and
+    conversion. They and the return value must be picklable. Large byte
+    strings are returned through shared memory. As the worker process has no
+    access to the request, the method gets None instead of the resource
+    instance as its first argument.
+
+    If the queue of the pool is full the request is answered with a 503
+    status code, if the method doesn't return within the timeout with a 504
+    status code. Pools are configured with
+    :func:`wsgiservice.concurrency.set_process_pool`.
+
+    :param pool: Name of the process pool to use.
+    :type pool: str
+    :param timeout: Maximum time in seconds to wait for the method to return.
+                    None waits forever.
+    :type timeout: float
+    """
+
+    def wrap(func):
+        register_function(func)
+
+        def _cpu_bound(func, *args, **kwargs):
+            "Calls the method in the process pool."
+            return get_process_pool(pool).call(func, (None,) + args[1:],
+                                               kwargs, timeout=timeout)
+        return decorator(_cpu_bound, func)
+    return wrap
@@ -0,0 +1,212 @@
+"""Deduplicated and rate-limited logging of exceptions.
+
+A burst of failing requests, for example because a backend is down, would
+otherwise log the same traceback for every request. The
+:class:`ErrorReporter` groups exceptions by a fingerprint consisting of the
+exception type and the place where it was raised. The first occurrence of a
+fingerprint is logged with its traceback. Further occurrences are only
+counted and logged as a summary with the count once per
+:attr:`ErrorReporter.interval`. A background thread logs the summaries of
+fingerprints which stopped occurring, so the end of a burst isn't lost.
+
+WsgiService reports all the exceptions it handles through the reporter
+returned by :func:`get_reporter`. Replace it with :func:`set_reporter` to
+change the interval. The counters are available with
+:func:`ErrorReporter.get_stats` and on the ``/_internal/metrics`` resource,
+see :mod:`wsgiservice.metrics`.
+"""
+import functools
+import logging
+import threading
+import time
+
+from wsgiservice.concurrency import BackgroundThread
+
+logger = logging.getLogger(__name__)
+
+
+class ErrorReporter(object):
+    """Logs exceptions once per fingerprint and interval. Thread-safe.
+
+    The summaries of suppressed occurrences are logged by the next
+    occurrence after the interval, or by a background thread which flushes
+    them every interval. The thread is started with the first suppressed
+    occurrence and again after a fork.
+
+    :param interval: Minimum number of seconds between two log messages of
+                     the same fingerprint.
+    :type interval: float
+    :param max_fingerprints: Maximum number of fingerprints to keep. The
+                             least recently seen ones are forgotten first.
+    :type max_fingerprints: int
+    :param currtime: Function returning the current time in seconds.
+    """
+
+    def __init__(self, interval=60, max_fingerprints=1000,
+                 currtime=time.time):
+        self.interval = interval
+        self.max_fingerprints = max_fingerprints
+        self.currtime = currtime
+        self._errors = {}
+        self._lock = threading.Lock()
+        self._thread = BackgroundThread(
+            functools.partial(self.flush, force=False), interval,
+            name='wsgiservice-errors', on_error=self._on_flush_error)
+
+    def report(self, e, msg, level=logging.ERROR, log=None, exc_info=True):
+        """Reports the exception. Logs the message if it's the first
+        occurrence of its fingerprint or the interval has passed since the
+        last message, in which case the number of occurrences since then is
+        added. Returns the fingerprint.
+
+        :param e: The exception.
+        :type e: :class:`Exception`
+        :param msg: Log message. ``%s`` is replaced with the exception.
+        :type msg: str
+        :param level: Log level.
+        :type level: int
+        :param log: Logger to use. Defaults to the logger of this module.
+        :type log: :class:`logging.Logger`
+        :param exc_info: Whether to log the traceback with the first
+                         occurrence.
+        :type exc_info: bool
+        """
+        fingerprint = get_fingerprint(e)
+        now = self.currtime()
+        with self._lock:
+            error = self._errors.get(fingerprint)
+            if error is None:
+                error = self._add(fingerprint, now)
+            error['count'] += 1
+            error['pending'] += 1
+            error['last_seen'] = now
+            error['message'] = str(e)
+            error['log'] = log
+            error['level'] = level
+            first = error['count'] == 1
+            suppressed = not first and now - error['logged'] < self.interval
+            if not suppressed:
+                pending = error['pending']
+                error['pending'] = 0
+                error['logged'] = now
+        if suppressed:
+            if not self._thread.running:
+                self.start()
+            return fingerprint
+        log = log or logger
+        if first:
+            log.log(level, msg, e, exc_info=e if exc_info else None)
+        else:
+            log.log(level, msg + " (%d times in the last %d seconds, %s)",
+                    e, pending, self.interval, fingerprint)
+        return fingerprint
+
+    def flush(self, log=None, force=True):
+        """Logs a summary of the fingerprints which occurred since they were
+        last logged.
+
+        :param log: Logger to use. Defaults to the logger the exceptions
+                    were reported with.
+        :type log: :class:`logging.Logger`
+        :param force: Whether to log all of them. Otherwise only the
+                      fingerprints which were last logged at least
+                      :attr:`interval` seconds ago are logged.
+        :type force: bool
+        """
+        now = self.currtime()
+        with self._lock:
+            pending = []
+            for fingerprint, error in self._errors.items():
+                if error['pending'] and (
+                        force or now - error['logged'] >= self.interval):
+                    pending.append((fingerprint, error['pending'],
+                                    error['message'], error['log'],
+                                    error['level']))
+                    error['pending'] = 0
+                    error['logged'] = now
+        for fingerprint, count, message, error_log, level in pending:
+            (log or error_log or logger).log(level,
+                "%s occurred %d more times: %s", fingerprint, count, message)
+
+    def start(self):
+        """Starts the thread flushing the summaries unless it's already
+        running in this process."""
+        self._thread.start()
+
+    def stop(self):
+        """Stops the thread flushing the summaries. It's started again by
+        the next suppressed occurrence."""
+        self._thread.stop()
+
+    def get_stats(self):
+        """Returns a list of dictionaries with the ``fingerprint``, the total
+        ``count``, the ``first_seen`` and ``last_seen`` timestamps and the
+        last ``message`` of each fingerprint, most frequent first."""
+        with self._lock:
+            stats = [{'fingerprint': fingerprint, 'count': error['count'],
+                      'first_seen': error['first_seen'],
+                      'last_seen': error['last_seen'],
+                      'message': error['message']}
+                     for fingerprint, error in self._errors.items()]
+        stats.sort(key=lambda error: (-error['count'], error['fingerprint']))
+        return stats
+
+    def clear(self):
+        """Forgets all the fingerprints."""
+        with self._lock:
+            self._errors.clear()
+
+    def _add(self, fingerprint, now):
+        """Adds a new fingerprint, forgetting the least recently seen one if
+        there are too many. Must be called with the lock held."""
+        if len(self._errors) >= self.max_fingerprints:
+            oldest = min(self._errors,
+                         key=lambda key: self._errors[key]['last_seen'])
+            del self._errors[oldest]
+        error = self._errors[fingerprint] = {'count': 0, 'pending': 0,
+            'first_seen': now, 'last_seen': now, 'logged': now,
+            'message': None, 'log': None, 'level': logging.ERROR}
+        return error
+
+    def _on_flush_error(self, e):
+        """Logs an exception of the background thread. Not reported
+        through this reporter, which could fail the same way."""
+        logger.error("Flushing the error summaries failed: %s", e,
+                     exc_info=e)
+
+
+def get_fingerprint(e):
+    """Returns the fingerprint of the exception: the qualified name of its
+    type and the file and line where it was raised. Exceptions which were not
+    raised only have the type.
+
+    :param e: The exception.
+    :type e: :class:`Exception`
+    """
+    cls = type(e)
+    name = cls.__module__ + '.' + getattr(cls, '__qualname__', cls.__name__)
+    tb = e.__traceback__
+    if tb is None:
+        return name
+    while tb.tb_next is not None:
+        tb = tb.tb_next
+    return '{0}@{1}:{2}'.format(name, tb.tb_frame.f_code.co_filename,
+                                tb.tb_lineno)
+
+
+_reporter = ErrorReporter()
+
+
+def get_reporter():
+    """Returns the :class:`ErrorReporter` used by WsgiService."""
+    return _reporter
+
+
+def set_reporter(reporter):
+    """Replaces the :class:`ErrorReporter` used by WsgiService.
+
+    :param reporter: The new reporter.
+    :type reporter: :class:`ErrorReporter`
+    """
+    global _reporter
+    _reporter = reporter
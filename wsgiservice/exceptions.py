@@ -1,18 +1,12 @@
 """Declares different exceptions as used throughout WsgiService."""
-import logging
-
-logger = logging.getLogger(__name__)
 
 
 class ValidationException(Exception):
     """Exception thrown when a validation fails. See
-    :func:`wsgiservice.decorators.validate` for it's use.
+    :func:`wsgiservice.decorators.validate` for it's use. Logged when it's
+    handled by :func:`wsgiservice.Resource.handle_exception`.
     """
 
-    def __init__(self, *args, **kwargs):
-        logger.error("ValidationException: %s", args[0])
-        Exception.__init__(self, *args, **kwargs)
-
 
 class ResponseException(Exception):
     """Wraps a :class:`webob.Response` object to be thrown as an exception."""
@@ -24,3 +18,18 @@ class ResponseException(Exception):
         :type response: :class:`webob.Response`
         """
         self.response = response
+
+
+class TimeoutException(Exception):
+    """Exception thrown when waiting for a result took longer than
+    allowed."""
+
+
+class DeadlineExceededException(TimeoutException):
+    """Exception thrown when the deadline of the current request has passed.
+    See :attr:`wsgiservice.application.Application.DEADLINE`."""
+
+
+class PoolFullException(Exception):
+    """Exception thrown when work is submitted to a pool whose queue is
+    full."""
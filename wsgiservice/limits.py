@@ -0,0 +1,343 @@
+"""Limits on the number of requests handled concurrently and on the request
+rate of clients.
+
+An :class:`AdmissionController` set as
+:attr:`wsgiservice.application.Application.ADMISSION_CONTROLLER` limits the
+number of requests in flight. Requests beyond the limit wait in a bounded
+queue. When the queue is full or a request waited too long, the request is
+rejected with a 503 status code and a ``Retry-After`` header, instead of
+letting the latency of all requests grow until clients time out.
+
+Example::
+
+    app = get_app(globals())
+    app.ADMISSION_CONTROLLER = AdmissionController(max_in_flight=50,
+        max_queue=50, target_latency=0.5)
+
+A :class:`RateLimiter` set as
+:attr:`wsgiservice.application.Application.RATE_LIMITER` limits the number
+of requests per client with token buckets. The buckets are stored in a
+:class:`wsgiservice.shm.SharedTable`, so the limit applies to all the worker
+processes of the host together. Resources can have their own limits with
+:attr:`wsgiservice.Resource.RATE_LIMIT`. Requests beyond the limit are
+rejected with a 429 status code before the resource is called.
+
+Example::
+
+    app.RATE_LIMITER = RateLimiter(requests=100, period=60,
+                                   key='header:X-Api-Key',
+                                   name='myservice-ratelimit')
+"""
+import math
+import threading
+import time
+
+from wsgiservice.shm import SharedTable
+
+
+class AdmissionController(object):
+    """Limits the number of requests in flight.
+
+    If a target latency is given, the limit adapts to the observed latency:
+    it's decreased multiplicatively when requests take longer than the
+    target and increased additively while they are faster (AIMD). The limit
+    always stays between `min_in_flight` and `max_in_flight`.
+
+    :param max_in_flight: Maximum number of requests in flight.
+    :type max_in_flight: int
+    :param max_queue: Maximum number of requests waiting for admission.
+    :type max_queue: int
+    :param queue_timeout: Maximum number of seconds a request waits for
+                          admission.
+    :type queue_timeout: float
+    :param target_latency: Latency in seconds above which the limit is
+                           decreased. None disables the adaptive limit.
+    :type target_latency: float
+    :param min_in_flight: Lower bound of the adaptive limit.
+    :type min_in_flight: int
+    :param currtime: Function returning the current time in seconds.
+    """
+
+    #: Factor by which the adaptive limit is multiplied when requests are
+    #: too slow.
+    DECREASE_FACTOR = 0.9
+
+    #: Weight of the latest request in the moving average of the latency.
+    LATENCY_WEIGHT = 0.1
+
+    #: Upper bound of the computed ``Retry-After`` value in seconds.
+    MAX_RETRY_AFTER = 60
+
+    def __init__(self, max_in_flight=100, max_queue=100, queue_timeout=1.0,
+                 target_latency=None, min_in_flight=1, currtime=time.time):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.min_in_flight = min_in_flight
+        self.currtime = currtime
+        self._limit = float(max_in_flight)
+        self._in_flight = 0
+        self._waiting = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._latency = None
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        """The current maximum number of requests in flight."""
+        return int(self._limit)
+
+    def acquire(self, timeout=None):
+        """Admits a request. Waits in the queue if the limit is reached.
+        Returns True if the request was admitted, False if it must be
+        rejected. Every admitted request must call :func:`release`.
+
+        :param timeout: Maximum number of seconds to wait. Defaults to
+                        :attr:`queue_timeout`. 0 doesn't wait at all.
+        :type timeout: float
+        """
+        if timeout is None:
+            timeout = self.queue_timeout
+        with self._condition:
+            if self._in_flight < self.limit:
+                return self._admit()
+            if timeout <= 0 or self._waiting >= self.max_queue:
+                self._rejected += 1
+                return False
+            deadline = time.time() + timeout
+            self._waiting += 1
+            try:
+                while self._in_flight >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._rejected += 1
+                        return False
+                    self._condition.wait(remaining)
+                return self._admit()
+            finally:
+                self._waiting -= 1
+
+    def release(self, latency=None):
+        """Marks an admitted request as done and wakes up a waiting request.
+
+        :param latency: Time in seconds it took to handle the request. Used
+                        for the adaptive limit and :func:`get_retry_after`.
+        :type latency: float
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if latency is not None:
+                self._observe(latency)
+            self._condition.notify()
+
+    def get_retry_after(self):
+        """Returns the number of seconds after which rejected clients should
+        retry: the estimated time to handle all the requests in flight and
+        in the queue, between 1 and :attr:`MAX_RETRY_AFTER`."""
+        with self._condition:
+            pending = self._in_flight + self._waiting
+            latency = self._latency or 0
+            retry_after = int(math.ceil(latency * pending /
+                                        max(self.limit, 1)))
+        return min(max(retry_after, 1), self.MAX_RETRY_AFTER)
+
+    def get_stats(self):
+        """Returns a dictionary with the current state and the cumulated
+        statistics of the controller. Times are in seconds."""
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'in_flight': self._in_flight,
+                'waiting': self._waiting,
+                'admitted': self._admitted,
+                'rejected': self._rejected,
+                'latency': self._latency,
+            }
+
+    def _admit(self):
+        """Counts an admitted request. Must be called with the lock held."""
+        self._in_flight += 1
+        self._admitted += 1
+        return True
+
+    def _observe(self, latency):
+        """Updates the moving average of the latency and adapts the limit.
+        Must be called with the lock held."""
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += self.LATENCY_WEIGHT * (latency - self._latency)
+        if self.target_latency is None:
+            return
+        now = self.currtime()
+        if latency > self.target_latency:
+            # Decrease at most once per target latency, so one burst of slow
+            # requests doesn't collapse the limit.
+            if now - self._last_decrease >= self.target_latency:
+                self._last_decrease = now
+                self._limit = max(self.min_in_flight,
+                                  self._limit * self.DECREASE_FACTOR)
+        elif self._in_flight + 1 >= self.limit:
+            # Only grow while the limit is actually used
+            self._limit = min(self.max_in_flight,
+                              self._limit + 1.0 / self._limit)
+            self._condition.notify()
+
+
+class RateLimiter(object):
+    """Token bucket rate limiting per client. Each client can send
+    `requests` requests at once and then gets new tokens at a rate of
+    `requests` per `period`.
+
+    Clients are identified by the `key`, which is one of:
+
+        - ``'remote_addr'``: The IP address of the client.
+        - ``'remote_user'``: The authenticated user.
+        - ``'header:<name>'``: The value of the given request header, for
+          example ``'header:X-Api-Key'``.
+        - A function which gets the :class:`webob.Request` and returns the
+          key.
+
+    Requests without a key (for example without the header) are not limited.
+
+    :param requests: Number of requests per period. Also the maximum burst.
+    :type requests: int
+    :param period: Length of the period in seconds.
+    :type period: float
+    :param key: How clients are identified.
+    :type key: str or callable
+    :param table: Table storing the buckets. Defaults to the shared table
+                  with the given name.
+    :type table: :class:`wsgiservice.shm.SharedTable`
+    :param name: Name of the shared table storing the buckets. Required if
+                 no table is given. All the services on a host using the
+                 same name share the buckets, so give each one its own.
+    :type name: str
+    :param currtime: Function returning the current time in seconds.
+    """
+
+    def __init__(self, requests=60, period=60, key='remote_addr', table=None,
+                 name=None, currtime=time.time):
+        if table is None and not name:
+            raise ValueError("RateLimiter needs a table or a table name.")
+        self.requests = requests
+        self.period = period
+        self.key = key
+        self.table = table
+        self.name = name
+        self.currtime = currtime
+        self._lock = threading.Lock()
+
+    def check(self, request, resource):
+        """Takes a token from the bucket of the client for the resource.
+        Returns a :class:`RateLimit` with the outcome, or None if the request
+        is not limited.
+
+        :param request: The current request.
+        :type request: :class:`webob.Request`
+        :param resource: The resource class which is called.
+        :type resource: :class:`wsgiservice.Resource`
+        """
+        limit = resource.RATE_LIMIT
+        if limit is False:
+            return None
+        client = self.get_key(request, resource.RATE_LIMIT_KEY or self.key)
+        if client is None:
+            return None
+        if limit is None:
+            requests, period = self.requests, self.period
+            bucket = '*:' + client
+        else:
+            requests, period = limit
+            bucket = resource.__name__ + ':' + client
+        return self.take(bucket, requests, period)
+
+    def take(self, bucket, requests, period):
+        """Takes a token from the given bucket. Returns a :class:`RateLimit`.
+
+        :param bucket: Key of the bucket.
+        :type bucket: str
+        :param requests: Size of the bucket.
+        :type requests: int
+        :param period: Number of seconds in which the bucket is refilled.
+        :type period: float
+        """
+        rate = float(requests) / period
+        now = self.currtime()
+
+        def take(values):
+            if values is None:
+                tokens = float(requests)
+            else:
+                tokens, updated = values
+                tokens = min(requests, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            return (tokens, now), RateLimit(allowed, requests, period, tokens,
+                                            rate)
+        return self.get_table().update(bucket, take)
+
+    def get_key(self, request, key):
+        """Returns the key identifying the client of the request.
+
+        :param request: The current request.
+        :type request: :class:`webob.Request`
+        :param key: The key specification, see :class:`RateLimiter`.
+        :type key: str or callable
+        """
+        if callable(key):
+            return key(request)
+        if key.startswith('header:'):
+            return request.headers.get(key[7:]) or None
+        return getattr(request, key) or None
+
+    def get_table(self):
+        """Returns the table storing the buckets, opening the shared table
+        with the name of the limiter on first use."""
+        if self.table is None:
+            with self._lock:
+                if self.table is None:
+                    self.table = SharedTable(self.name, fields=2)
+        return self.table
+
+
+class RateLimit(object):
+    """Outcome of a :func:`RateLimiter.check`.
+
+    :param allowed: Whether the request may be handled.
+    :type allowed: bool
+    :param requests: Number of requests per period.
+    :type requests: int
+    :param period: Length of the period in seconds.
+    :type period: float
+    :param tokens: Number of tokens left in the bucket.
+    :type tokens: float
+    :param rate: Number of tokens added per second.
+    :type rate: float
+    """
+
+    def __init__(self, allowed, requests, period, tokens, rate):
+        self.allowed = allowed
+        self.requests = requests
+        self.period = period
+        self.remaining = int(tokens)
+        #: Number of seconds until the bucket is full again.
+        self.reset = int(math.ceil((requests - tokens) / rate))
+        #: Number of seconds until the next request is allowed.
+        self.retry_after = max(1, int(math.ceil((1 - tokens) / rate)))
+
+    def set_headers(self, response):
+        """Sets the ``RateLimit-*`` headers on the response.
+
+        :param response: The response.
+        :type response: :class:`webob.Response`
+        """
+        response.headers['RateLimit-Limit'] = str(self.requests)
+        response.headers['RateLimit-Remaining'] = str(self.remaining)
+        response.headers['RateLimit-Reset'] = str(self.reset)
+        response.headers['RateLimit-Policy'] = '{0};w={1}'.format(
+            self.requests, int(self.period))
@@ -0,0 +1,263 @@
+"""Request-scoped batching of lookups.
+
+A :class:`Loader` wraps a batch function which looks up many keys in one
+round trip, for example a ``SELECT ... WHERE id IN (...)`` query. Keys which
+are requested individually are collected and looked up together, and every
+key is looked up at most once per request.
+
+Resources get their loaders with :func:`wsgiservice.Resource.get_loader`.
+The loaders are stored in the WSGI environment, so all the resource
+instances of the same request, including the ones created by
+:func:`wsgiservice.Resource.get_resource` and
+:func:`wsgiservice.Resource.fan_out`, share them.
+
+Example::
+
+    class Item(Resource):
+        def load_many(self, ids):
+            return db.get_items(ids)
+
+        def GET(self, id):
+            return self.get_loader(Item).load(id)
+
+    class Items(Resource):
+        def GET(self, ids):
+            ids = ids.split(',')
+            # One round trip for all the items ...
+            self.get_loader(Item).load_many(ids)
+            # ... which are then served from the loader.
+            return [self.get_resource(Item).GET(id) for id in ids]
+"""
+import itertools
+import threading
+import time
+
+from wsgiservice.exceptions import DeadlineExceededException
+
+#: Value of keys which the batch function did not return.
+_MISSING = object()
+
+
+class Loader(object):
+    """Batches and memoizes calls to a batch function.
+
+    The batch function gets a list of keys. It returns either a list with
+    the values in the same order or a dictionary mapping the keys to their
+    values. Keys which are missing from the dictionary raise a
+    :class:`KeyError` when loaded.
+
+    :func:`load` looks up one key immediately. To batch individual keys use
+    :func:`defer`, which returns a function to get the value later. The
+    first of those functions called looks up all the keys deferred until
+    then. Under the ASGI adapter :func:`load_async` batches all the keys
+    requested in the same iteration of the event loop.
+
+    Loaders are thread-safe, but meant to be used for one request only. They
+    never expire values.
+
+    :param batch_func: Function to look up a list of keys.
+    :type batch_func: callable
+    :param max_batch_size: Maximum number of keys to pass to the batch
+                           function at once. None means no limit.
+    :type max_batch_size: int
+    :param deadline: Value of :func:`time.monotonic` after which the batch
+                     function is not called anymore. Loads which would need to call it raise a
+                     :class:`wsgiservice.exceptions.DeadlineExceededException`
+                     instead. None means no deadline.
+    :type deadline: float
+    """
+
+    def __init__(self, batch_func, max_batch_size=None, deadline=None):
+        self.batch_func = batch_func
+        self.max_batch_size = max_batch_size
+        self.deadline = deadline
+        #: Number of times the batch function was called.
+        self.batches = 0
+        self._values = {}
+        # Keys to look up, a dictionary is used as an ordered set
+        self._queue = {}
+        self._lock = threading.RLock()
+        self._futures = None
+
+    def load(self, key):
+        """Returns the value for the key. Looks up the key together with all
+        the deferred keys unless its value is known already.
+
+        :param key: The key to look up. Must be hashable.
+        """
+        with self._lock:
+            if key not in self._values:
+                self._enqueue(key)
+                self.dispatch()
+            return self._get(key)
+
+    def load_many(self, keys):
+        """Returns a list with the values of all the keys. Looks up all the
+        unknown keys in one batch.
+
+        :param keys: The keys to look up.
+        :type keys: list
+        """
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                if key not in self._values:
+                    self._enqueue(key)
+            self.dispatch()
+            return [self._get(key) for key in keys]
+
+    def defer(self, key):
+        """Queues the key and returns a function without arguments which
+        returns its value. Keys are looked up in one batch as soon as any of
+        those functions is called.
+
+        :param key: The key to look up. Must be hashable.
+        """
+        with self._lock:
+            if key not in self._values:
+                self._enqueue(key)
+        return lambda: self.load(key)
+
+    def load_async(self, key):
+        """Returns an :class:`asyncio.Future` for the value of the key. All
+        the keys requested in the same iteration of the event loop are looked
+        up in one batch. The batch function may be a coroutine function.
+
+        :param key: The key to look up. Must be hashable.
+        """
+        import asyncio
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            if self._futures is None:
+                self._futures = {}
+                loop.call_soon(self._dispatch_async, loop)
+            future = self._futures.get(key)
+            if future is None:
+                future = self._futures[key] = loop.create_future()
+                if key in self._values:
+                    self._resolve(future, key)
+                else:
+                    self._enqueue(key)
+            return future
+
+    def prime(self, key, value):
+        """Sets the value of a key without calling the batch function.
+
+        :param key: The key to set.
+        :param value: The value of the key.
+        """
+        with self._lock:
+            self._values[key] = value
+
+    def clear(self, key=None):
+        """Forgets the value of the given key or of all keys.
+
+        :param key: The key to forget. None forgets all keys.
+        """
+        with self._lock:
+            if key is None:
+                self._values.clear()
+            else:
+                self._values.pop(key, None)
+
+    def dispatch(self):
+        """Looks up all the queued keys."""
+        with self._lock:
+            while self._queue:
+                keys = list(itertools.islice(
+                    self._queue, self.max_batch_size or len(self._queue)))
+                for key in keys:
+                    del self._queue[key]
+                self._assert_deadline()
+                self._store(keys, self.batch_func(keys))
+
+    def __len__(self):
+        """Returns the number of known values."""
+        return len(self._values)
+
+    def _assert_deadline(self):
+        """Raises an exception if the deadline has passed."""
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise DeadlineExceededException(
+                "Deadline exceeded before calling {0!r}.".format(
+                    self.batch_func))
+
+    def _enqueue(self, key):
+        """Adds the key to the queue unless it's already queued."""
+        self._queue[key] = None
+
+    def _get(self, key):
+        """Returns the known value of the key."""
+        value = self._values.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def _store(self, keys, values):
+        """Remembers the values returned by the batch function."""
+        self.batches += 1
+        if isinstance(values, dict):
+            for key in keys:
+                self._values[key] = values.get(key, _MISSING)
+            return
+        values = list(values)
+        if len(values) != len(keys):
+            raise ValueError(
+                "Batch function returned {0} values for {1} keys.".format(
+                    len(values), len(keys)))
+        self._values.update(zip(keys, values))
+
+    def _dispatch_async(self, loop):
+        """Looks up the keys requested with :func:`load_async` and resolves
+        their futures."""
+        import asyncio
+        with self._lock:
+            futures, self._futures = self._futures, None
+            keys, self._queue = list(self._queue), {}
+        if not keys:
+            self._resolve_all(futures)
+            return
+        try:
+            self._assert_deadline()
+            values = self.batch_func(keys)
+        except Exception as e:
+            self._fail_all(futures, e)
+            return
+        if asyncio.isfuture(values) or asyncio.iscoroutine(values):
+            asyncio.ensure_future(values, loop=loop).add_done_callback(
+                lambda task: self._finish(futures, keys, task))
+        else:
+            self._finish(futures, keys, values)
+
+    def _finish(self, futures, keys, values):
+        """Stores the values of a batch started by :func:`load_async` and
+        resolves the futures. Values may be a finished
+        :class:`asyncio.Task`."""
+        try:
+            if hasattr(values, 'result') and hasattr(values, 'done'):
+                values = values.result()
+            with self._lock:
+                self._store(keys, values)
+        except Exception as e:
+            self._fail_all(futures, e)
+        else:
+            self._resolve_all(futures)
+
+    def _resolve_all(self, futures):
+        """Sets the results of all the futures."""
+        for key, future in futures.items():
+            if not future.done():
+                self._resolve(future, key)
+
+    def _resolve(self, future, key):
+        """Sets the result of the future to the value of the key."""
+        try:
+            future.set_result(self._get(key))
+        except KeyError as e:
+            future.set_exception(e)
+
+    def _fail_all(self, futures, e):
+        """Sets the exception on all the futures."""
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(e)
@@ -0,0 +1,460 @@
+"""Request metrics and the ``/_internal/metrics`` resource.
+
+A :class:`Metrics` instance set as
+:attr:`wsgiservice.application.Application.METRICS` records for every
+request:
+
+    - The number of requests by resource, method and status code.
+    - A histogram of the latency and of the response size by resource and
+      method, with the fixed buckets :data:`LATENCY_BUCKETS` and
+      :data:`SIZE_BUCKETS`.
+    - The number of requests in flight by resource. Each process counts its
+      own requests, the counts of processes which don't exist anymore are
+      dropped.
+    - The outcome of the lookups in the
+      :attr:`wsgiservice.application.Application.RESPONSE_CACHE` by
+      resource.
+    - The number of exceptions handled by the resources by exception type,
+      see :func:`wsgiservice.Resource.report_exception`.
+    - The limit, the requests in flight and waiting and the number of
+      rejected requests of the
+      :attr:`wsgiservice.application.Application.ADMISSION_CONTROLLER` and
+      of the bulkheads of the resources, see
+      :attr:`wsgiservice.Resource.BULKHEAD`.
+      Each process writes the state of its limiters at most once every
+      :attr:`Metrics.LIMITERS_INTERVAL` seconds, when it finishes a request.
+    - The number of requests coalesced with an identical request by
+      resource, see
+      :attr:`wsgiservice.application.Application.COALESCE_REQUESTS`.
+
+The values are stored in a :class:`wsgiservice.shm.SharedTable`, so in
+prefork deployments the :class:`MetricsResource` of any worker returns the
+totals of all the workers of the host. The table outlives the workers, so
+counters continue where they left off after a restart. Give every service
+on a host its own table name, :func:`wsgiservice.get_app` uses the name of
+the service.
+
+The easiest way to enable the metrics is ``get_app(globals(),
+add_metrics=True)``, which mounts :class:`MetricsResource` at
+``/_internal/metrics``. It returns the Prometheus text format by default and
+JSON for ``/_internal/metrics.json``.
+"""
+import errno
+import os
+import threading
+import time
+
+from wsgiservice.decorators import mount
+from wsgiservice.resource import Resource
+from wsgiservice.shm import SharedTable
+
+#: Upper bounds of the latency histogram buckets in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#: Upper bounds of the response size histogram buckets in bytes.
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class Metrics(object):
+    """Records request metrics in a shared table.
+
+    :param name: Name of the :class:`wsgiservice.shm.SharedTable`. Required
+                 if no table is given. All the services on a host using the
+                 same name share the metrics, so give each one its own.
+    :type name: str
+    :param table: Table to store the metrics in. Defaults to a new table with
+                  the given name. Must have at least
+                  ``len(latency_buckets) + len(size_buckets) + 4`` fields.
+    :type table: :class:`wsgiservice.shm.SharedTable`
+    :param latency_buckets: Upper bounds of the latency buckets in seconds.
+    :type latency_buckets: tuple
+    :param size_buckets: Upper bounds of the response size buckets in bytes.
+    :type size_buckets: tuple
+    """
+
+    #: Maximum number of distinct keys (combinations of resource, method,
+    #: status and cache outcome) of tables created by this class.
+    SLOTS = 4096
+
+    #: Minimum number of seconds between two writes of the state of the
+    #: limiters of a process, see :func:`update_limiters`.
+    LIMITERS_INTERVAL = 1.0
+
+    def __init__(self, name=None, table=None,
+                 latency_buckets=LATENCY_BUCKETS, size_buckets=SIZE_BUCKETS):
+        if table is None and not name:
+            raise ValueError("Metrics need a table or a table name.")
+        self.name = name
+        self.table = table
+        self.latency_buckets = tuple(latency_buckets)
+        self.size_buckets = tuple(size_buckets)
+        # One row holds both histograms: the counts of each bucket plus the
+        # +Inf bucket, followed by the sum.
+        self.fields = len(self.latency_buckets) + len(self.size_buckets) + 4
+        self._lock = threading.Lock()
+        self._limiters_written = None
+
+    def start(self, resource):
+        """Counts a request of the given resource as in flight.
+
+        :param resource: Name of the resource.
+        :type resource: str
+        """
+        self._add(('in_flight', resource, os.getpid()), 1)
+
+    def finish(self, resource, method, status, latency, size, cache=None):
+        """Records a finished request, which was passed to :func:`start`
+        before.
+
+        :param resource: Name of the resource.
+        :type resource: str
+        :param method: HTTP method of the request.
+        :type method: str
+        :param status: Status code of the response.
+        :type status: int
+        :param latency: Time in seconds it took to handle the request.
+        :type latency: float
+        :param size: Size of the response body in bytes.
+        :type size: int
+        :param cache: Outcome of the response cache lookup, if any:
+                      ``'hit'``, ``'stale'`` or ``'miss'``.
+        :type cache: str
+        """
+        self._add(('in_flight', resource, os.getpid()), -1)
+        self._add(('requests', resource, method, str(status)), 1)
+        if cache is not None:
+            self._add(('cache', resource, cache), 1)
+        increments = [0] * self.fields
+        offset = len(self.latency_buckets) + 1
+        increments[self._get_bucket(self.latency_buckets, latency)] = 1
+        increments[offset] = latency
+        increments[offset + 1 + self._get_bucket(self.size_buckets, size)] = 1
+        increments[-1] = size
+        self.get_table().add(self._get_key(('histogram', resource, method)),
+                             increments)
+
+    def count_exception(self, name):
+        """Counts an exception of the given type.
+
+        :param name: Name of the exception type.
+        :type name: str
+        """
+        self._add(('exceptions', name), 1)
+
+    def count_rejected(self, resource=None):
+        """Counts a request rejected by the bulkhead of the given resource,
+        or by the admission controller if no resource is given.
+
+        :param resource: Name of the resource.
+        :type resource: str
+        """
+        if resource is None:
+            self._add(('admission_rejected',), 1)
+        else:
+            self._add(('bulkhead_rejected', resource), 1)
+
+    def count_coalesced(self, resource):
+        """Counts a request which got the response of an identical
+        request.
+
+        :param resource: Name of the resource.
+        :type resource: str
+        """
+        self._add(('coalesced', resource), 1)
+
+    def update_limiters(self, admission, bulkheads, force=False):
+        """Stores the current limit and the number of requests in flight and
+        waiting of the limiters of this process. Does nothing if they were
+        stored less than :attr:`LIMITERS_INTERVAL` seconds ago, unless
+        `force` is set.
+
+        :param admission: Statistics of the admission controller as returned
+                          by its `get_stats` method, or None.
+        :type admission: dict
+        :param bulkheads: Statistics of the bulkheads by resource name, as
+                          returned by `Application.get_bulkheads`.
+        :type bulkheads: dict
+        :param force: Whether to store them in any case.
+        :type force: bool
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not force and self._limiters_written is not None and \
+                    now - self._limiters_written < self.LIMITERS_INTERVAL:
+                return
+            self._limiters_written = now
+        pid = os.getpid()
+        if admission is not None:
+            self._set(('admission', pid), self._get_limiter_values(admission))
+        for resource, stats in bulkheads.items():
+            self._set(('bulkhead', resource, pid),
+                      self._get_limiter_values(stats))
+
+    def collect(self):
+        """Returns the current values as a dictionary with the keys
+        ``requests``, ``latency``, ``size``, ``in_flight``, ``cache``,
+        ``exceptions``, ``admission``, ``bulkheads`` and ``coalesced``.
+        Each is a list of dictionaries. The histograms have cumulative
+        bucket counts like in Prometheus. ``admission`` has at most one
+        entry."""
+        data = {'requests': [], 'latency': [], 'size': [], 'in_flight': [],
+                'cache': [], 'exceptions': [], 'admission': [],
+                'bulkheads': [], 'coalesced': []}
+        cache = {}
+        in_flight = {}
+        # Maps None for the admission controller and the resource names for
+        # the bulkheads to their limit, in flight, waiting and rejected
+        limiters = {}
+        table = self.get_table()
+        for key, values in sorted(table.items()):
+            parts = key.split('|')
+            kind = parts[0]
+            if kind == 'requests' and len(parts) == 4:
+                data['requests'].append({'resource': parts[1],
+                    'method': parts[2], 'status': int(parts[3]),
+                    'count': int(values[0])})
+            elif kind == 'in_flight' and len(parts) == 3:
+                if self._is_alive(table, key, parts[2]):
+                    in_flight[parts[1]] = in_flight.get(parts[1], 0) + \
+                        int(values[0])
+            elif kind in ('admission', 'bulkhead') and \
+                    len(parts) == (2 if kind == 'admission' else 3):
+                if self._is_alive(table, key, parts[-1]):
+                    row = limiters.setdefault(
+                        parts[1] if kind == 'bulkhead' else None, [0] * 4)
+                    for i in range(3):
+                        row[i] += int(values[i])
+            elif kind == 'admission_rejected' and len(parts) == 1:
+                limiters.setdefault(None, [0] * 4)[3] = int(values[0])
+            elif kind == 'bulkhead_rejected' and len(parts) == 2:
+                limiters.setdefault(parts[1], [0] * 4)[3] = int(values[0])
+            elif kind == 'coalesced' and len(parts) == 2:
+                data['coalesced'].append({'resource': parts[1],
+                                          'count': int(values[0])})
+            elif kind == 'exceptions' and len(parts) == 2:
+                data['exceptions'].append({'type': parts[1],
+                                           'count': int(values[0])})
+            elif kind == 'cache' and len(parts) == 3:
+                cache.setdefault(parts[1], {})[parts[2]] = int(values[0])
+            elif kind == 'histogram' and len(parts) == 3:
+                offset = len(self.latency_buckets) + 1
+                for name, buckets, counts, total in (
+                        ('latency', self.latency_buckets,
+                         values[:offset], values[offset]),
+                        ('size', self.size_buckets,
+                         values[offset + 1:-1], values[-1])):
+                    data[name].append(self._get_histogram(parts[1], parts[2],
+                        buckets, counts, total))
+        for resource, value in sorted(in_flight.items()):
+            data['in_flight'].append({'resource': resource, 'value': value})
+        for resource, row in sorted(limiters.items(),
+                                    key=lambda item: item[0] or ''):
+            limiter = {'limit': row[0], 'in_flight': row[1],
+                       'waiting': row[2], 'rejected': row[3]}
+            if resource is None:
+                data['admission'].append(limiter)
+            else:
+                limiter['resource'] = resource
+                data['bulkheads'].append(limiter)
+        for resource, outcomes in sorted(cache.items()):
+            lookups = sum(outcomes.values())
+            hits = outcomes.get('hit', 0) + outcomes.get('stale', 0)
+            data['cache'].append({'resource': resource,
+                'hit': outcomes.get('hit', 0),
+                'stale': outcomes.get('stale', 0),
+                'miss': outcomes.get('miss', 0),
+                'hit_ratio': float(hits) / lookups if lookups else None})
+        return data
+
+    def to_prometheus(self, data):
+        """Returns the data returned by :func:`collect` in the Prometheus
+        text exposition format.
+
+        :param data: The collected metrics.
+        :type data: dict
+        """
+        lines = []
+
+        def header(name, kind, doc):
+            lines.append('# HELP {0} {1}'.format(name, doc))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+
+        def sample(name, labels, value):
+            lines.append('{0}{{{1}}} {2}'.format(name, ','.join(
+                '{0}="{1}"'.format(k, _escape_label(v)) for k, v in labels),
+                _format_value(value)))
+
+        name = 'wsgiservice_requests_total'
+        header(name, 'counter', 'Number of requests.')
+        for row in data['requests']:
+            sample(name, [('resource', row['resource']),
+                          ('method', row['method']),
+                          ('status', row['status'])], row['count'])
+        for name, key, doc in (
+                ('wsgiservice_request_duration_seconds', 'latency',
+                 'Time to handle a request.'),
+                ('wsgiservice_response_size_bytes', 'size',
+                 'Size of the response body.')):
+            header(name, 'histogram', doc)
+            for row in data[key]:
+                labels = [('resource', row['resource']),
+                          ('method', row['method'])]
+                for le, count in row['buckets']:
+                    sample(name + '_bucket', labels + [('le', le)], count)
+                sample(name + '_sum', labels, row['sum'])
+                sample(name + '_count', labels, row['count'])
+        name = 'wsgiservice_requests_in_flight'
+        header(name, 'gauge', 'Number of requests being handled.')
+        for row in data['in_flight']:
+            sample(name, [('resource', row['resource'])], row['value'])
+        name = 'wsgiservice_response_cache_total'
+        header(name, 'counter', 'Number of response cache lookups.')
+        for row in data['cache']:
+            for result in ('hit', 'stale', 'miss'):
+                sample(name, [('resource', row['resource']),
+                              ('result', result)], row[result])
+        name = 'wsgiservice_exceptions_total'
+        header(name, 'counter', 'Number of exceptions handled.')
+        for row in data['exceptions']:
+            sample(name, [('type', row['type'])], row['count'])
+        for prefix, key, doc in (
+                ('wsgiservice_admission', 'admission',
+                 'of the admission controller.'),
+                ('wsgiservice_bulkhead', 'bulkheads',
+                 'of the bulkhead of a resource.')):
+            for suffix, field, kind, description in (
+                    ('_limit', 'limit', 'gauge',
+                     'Maximum number of requests in flight'),
+                    ('_in_flight', 'in_flight', 'gauge',
+                     'Number of requests in flight'),
+                    ('_waiting', 'waiting', 'gauge',
+                     'Number of requests waiting for admission'),
+                    ('_rejected_total', 'rejected', 'counter',
+                     'Number of rejected requests')):
+                header(prefix + suffix, kind, description + ' ' + doc)
+                for row in data[key]:
+                    labels = []
+                    if 'resource' in row:
+                        labels.append(('resource', row['resource']))
+                    sample(prefix + suffix, labels, row[field])
+        name = 'wsgiservice_coalesced_requests_total'
+        header(name, 'counter',
+               'Number of requests which got the response of an identical '
+               'request.')
+        for row in data['coalesced']:
+            sample(name, [('resource', row['resource'])], row['count'])
+        return '\n'.join(lines) + '\n'
+
+    def get_table(self):
+        """Returns the table storing the metrics, opening it on first use."""
+        if self.table is None:
+            with self._lock:
+                if self.table is None:
+                    self.table = SharedTable(self.name, fields=self.fields,
+                        slots=self.SLOTS, key_size=128)
+        return self.table
+
+    def _set(self, parts, values):
+        """Sets the first fields of the key to the values."""
+        values = list(values) + [0] * (self.fields - len(values))
+        self.get_table().update(self._get_key(parts),
+                                lambda current: (values, None))
+
+    def _is_alive(self, table, key, pid):
+        """Returns True if the process with the given ID of the key
+        exists. Deletes the key otherwise, the process died, possibly in the
+        middle of requests."""
+        if _is_running(int(pid)):
+            return True
+        table.delete(key)
+        return False
+
+    def _get_limiter_values(self, stats):
+        """Returns the values stored for the statistics of a limiter."""
+        return (stats['limit'], stats['in_flight'], stats['waiting'])
+
+    def _add(self, parts, value):
+        """Adds the value to the first field of the key."""
+        increments = [0] * self.fields
+        increments[0] = value
+        self.get_table().add(self._get_key(parts), increments)
+
+    def _get_key(self, parts):
+        """Returns the table key for the given parts. The separator is
+        removed from the parts so keys can be split again."""
+        return '|'.join(str(part).replace('|', '') for part in parts)
+
+    def _get_bucket(self, buckets, value):
+        """Returns the index of the first bucket the value fits in, or the
+        index of the +Inf bucket."""
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                return i
+        return len(buckets)
+
+    def _get_histogram(self, resource, method, buckets, counts, total):
+        """Returns the dictionary for one histogram row of :func:`collect`.
+        """
+        cumulative = []
+        count = 0
+        for bound, value in zip(list(buckets) + ['+Inf'], counts):
+            count += int(value)
+            cumulative.append((_format_value(bound), count))
+        return {'resource': resource, 'method': method,
+                'buckets': cumulative, 'sum': total, 'count': count}
+
+
+def _is_running(pid):
+    """Returns True if the process with the given ID exists."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _escape_label(value):
+    """Escapes a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _format_value(value):
+    """Formats a number for the Prometheus text format."""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+@mount('/_internal/metrics')
+class MetricsResource(Resource):
+    """Exposes the :attr:`wsgiservice.application.Application.METRICS` of all
+    the workers of this host. Returns the Prometheus text format by default,
+    JSON and XML are available as well."""
+    EXTENSION_MAP = [('.txt', 'text/plain')] + Resource.EXTENSION_MAP
+    XML_ROOT_TAG = 'metrics'
+    NOT_FOUND = (KeyError,)
+
+    def GET(self):
+        """Returns the metrics of the application."""
+        metrics = self.get_metrics()
+        if metrics is None:
+            raise KeyError('metrics')
+        self.application.update_limiter_metrics(force=True)
+        return metrics.collect()
+
+    def get_metrics(self):
+        """Returns the :class:`Metrics` of the application or None."""
+        if self.application is None:
+            return None
+        return self.application.METRICS
+
+    def to_text_plain(self, raw):
+        """Returns the metrics in the Prometheus text format.
+
+        :param raw: The return value of :func:`GET`.
+        :type raw: dict
+        """
+        if 'error' in raw:
+            return raw['error'] + '\n'
+        return self.get_metrics().to_prometheus(raw)
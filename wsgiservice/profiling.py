@@ -0,0 +1,237 @@
+"""Deterministic profiling of individual requests.
+
+A :class:`RequestProfiler` set as
+:attr:`wsgiservice.application.Application.REQUEST_PROFILER` runs selected
+requests under :mod:`cProfile` and writes the statistics of each one to a
+file in its directory. A request is profiled if it has the
+:attr:`RequestProfiler.HEADER` with the value of the
+:attr:`wsgiservice.application.Application.INTERNAL_TOKEN`, or at random with
+the configured sample rate::
+
+    app.INTERNAL_TOKEN = 'secret'
+    app.REQUEST_PROFILER = RequestProfiler('/var/tmp/profiles',
+                                           sample_rate=0.001)
+
+The files are named after the resource and the request ID, see
+:func:`RequestProfiler.get_filename`, and can be read with :mod:`pstats`.
+Running this module aggregates the files by resource and prints the
+functions with the highest total time of each resource::
+
+    python -m wsgiservice.profiling [--top 20] [--sort tottime]
+                                    [--resource Document] /var/tmp/profiles
+"""
+import argparse
+import cProfile
+import hmac
+import logging
+import os
+import pstats
+import random
+import re
+import sys
+import uuid
+
+from wsgiservice.errors import get_reporter
+
+logger = logging.getLogger(__name__)
+
+
+class RequestProfiler(object):
+    """Profiles selected requests with :mod:`cProfile`.
+
+    :param directory: Directory to write the statistics to. Created if it
+                      doesn't exist.
+    :type directory: str
+    :param sample_rate: Fraction of the requests to profile in addition to
+                        the ones with the :attr:`HEADER`.
+    :type sample_rate: float
+    :param random: Function returning a random float between 0 and 1. Used
+                   for testing.
+    """
+
+    #: Request header with which clients holding the
+    #: :attr:`wsgiservice.application.Application.INTERNAL_TOKEN` can request
+    #: profiling. (Default: 'X-Profile')
+    HEADER = 'X-Profile'
+
+    #: Request header with the ID of the request, used in the file name. A
+    #: random ID is used if it's missing. (Default: 'X-Request-Id')
+    REQUEST_ID_HEADER = 'X-Request-Id'
+
+    def __init__(self, directory, sample_rate=0.0, random=random.random):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.random = random
+
+    def should_profile(self, instance):
+        """Returns True if the request of the resource instance is to be
+        profiled.
+
+        :param instance: The resource instance handling the request.
+        :type instance: :class:`wsgiservice.Resource`
+        """
+        value = instance.request.headers.get(self.HEADER)
+        token = getattr(instance.application, 'INTERNAL_TOKEN', None)
+        if value is not None and token is not None and hmac.compare_digest(
+                value.encode('utf-8'), token.encode('utf-8')):
+            return True
+        return self.sample_rate > 0 and self.random() < self.sample_rate
+
+    def call(self, instance, func):
+        """Calls the function and returns its return value. Profiles the
+        call if :func:`should_profile` returns True. Profiling fails open:
+        if the statistics can't be written, the error is reported and the
+        return value is returned anyway.
+
+        :param instance: The resource instance handling the request.
+        :type instance: :class:`wsgiservice.Resource`
+        :param func: Function to call without parameters, usually the
+                     resource instance itself.
+        :type func: callable
+        """
+        if not self.should_profile(instance):
+            return func()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return func()
+        try:
+            return func()
+        finally:
+            profile.disable()
+            self.dump(instance, profile)
+
+    def dump(self, instance, profile):
+        """Writes the statistics of the profile to the directory.
+
+        :param instance: The profiled resource instance.
+        :type instance: :class:`wsgiservice.Resource`
+        :param profile: The profile of the request.
+        :type profile: :class:`cProfile.Profile`
+        """
+        filename = os.path.join(self.directory, self.get_filename(instance))
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            profile.dump_stats(filename)
+        except OSError as e:
+            get_reporter().report(e, "Writing the profile failed: %s",
+                                  log=logger)
+        else:
+            logger.info("Profiled request to %s: %s",
+                        type(instance).__name__, filename)
+
+    def get_filename(self, instance):
+        """Returns the name of the file for the request of the instance:
+        ``<resource>.<request ID>.prof``. Characters other than letters,
+        digits, dashes and underscores are removed from the request ID.
+
+        :param instance: The profiled resource instance.
+        :type instance: :class:`wsgiservice.Resource`
+        """
+        request_id = instance.request.headers.get(self.REQUEST_ID_HEADER)
+        request_id = re.sub('[^A-Za-z0-9_-]', '', request_id or '')[:64]
+        return '{0}.{1}.prof'.format(type(instance).__name__,
+                                     request_id or uuid.uuid4().hex)
+
+
+def load(paths, resource=None):
+    """Returns a dictionary mapping the resource names to a tuple of the
+    number of files and the :class:`pstats.Stats` combining the files of
+    that resource.
+
+    :param paths: Files written by :class:`RequestProfiler` and directories
+                  containing them.
+    :type paths: list
+    :param resource: Only load the files of this resource.
+    :type resource: str
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name)
+                         for name in sorted(os.listdir(path))
+                         if name.endswith('.prof'))
+        else:
+            files.append(path)
+    loaded = {}
+    for filename in files:
+        name = os.path.basename(filename).split('.', 1)[0]
+        if resource is not None and name != resource:
+            continue
+        if name in loaded:
+            count, stats = loaded[name]
+            stats.add(filename)
+            loaded[name] = (count + 1, stats)
+        else:
+            loaded[name] = (1, pstats.Stats(filename))
+    return loaded
+
+
+def get_hot_spots(stats, count=20, sort='tottime'):
+    """Returns the functions of the statistics with the highest `sort` value
+    as a list of dictionaries with the ``function``, the number of
+    ``calls``, the time spent in the function itself (``tottime``) and
+    including the functions it called (``cumtime``).
+
+    :param stats: The statistics.
+    :type stats: :class:`pstats.Stats`
+    :param count: Maximum number of functions to return.
+    :type count: int
+    :param sort: Value to sort by: ``tottime``, ``cumtime`` or ``calls``.
+    :type sort: str
+    """
+    rows = []
+    for key, (primitive, calls, tottime, cumtime, callers) \
+            in stats.stats.items():
+        rows.append({'function': pstats.func_std_string(key),
+                     'calls': calls, 'tottime': tottime,
+                     'cumtime': cumtime})
+    rows.sort(key=lambda row: (-row[sort], row['function']))
+    return rows[:count]
+
+
+def main(argv=None, output=None):
+    """Prints the hot spots of each resource in the profiles written by
+    :class:`RequestProfiler`. Resources are ordered by their total time.
+
+    :param argv: Command line arguments. Defaults to :data:`sys.argv`.
+    :type argv: list
+    :param output: File to print to. Defaults to :data:`sys.stdout`.
+    :type output: file
+    """
+    parser = argparse.ArgumentParser(prog='python -m wsgiservice.profiling',
+        description='Aggregate request profiles by resource.')
+    parser.add_argument('paths', nargs='+',
+                        help='profile files or directories containing them')
+    parser.add_argument('--top', type=int, default=20,
+                        help='number of functions per resource')
+    parser.add_argument('--sort', default='tottime',
+                        choices=['tottime', 'cumtime', 'calls'])
+    parser.add_argument('--resource', help='only show this resource')
+    args = parser.parse_args(argv)
+    output = output or sys.stdout
+    loaded = load(args.paths, resource=args.resource)
+    if not loaded:
+        output.write('No profiles found.\n')
+        return 1
+    resources = sorted(loaded.items(),
+                       key=lambda item: (-item[1][1].total_tt, item[0]))
+    for name, (count, stats) in resources:
+        output.write('{0}: {1} requests, {2:.3f} seconds, {3:.3f} seconds '
+                     'per request\n'.format(name, count, stats.total_tt,
+                                            stats.total_tt / count))
+        output.write('{0:>10} {1:>10} {2:>10}  {3}\n'.format(
+            'calls', 'tottime', 'cumtime', 'function'))
+        for row in get_hot_spots(stats, args.top, args.sort):
+            output.write('{0:>10} {1:>10.4f} {2:>10.4f}  {3}\n'.format(
+                row['calls'], row['tottime'], row['cumtime'],
+                row['function']))
+        output.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,26 @@
+import contextlib
+import functools
 import hashlib
+import hmac
 import inspect
 import json
 import logging
 import re
+import time
 from xml.sax.saxutils import escape as xml_escape
 
 import six
 
 import webob
 from wsgiservice import xmlserializer
+from wsgiservice.concurrency import gather, get_thread_pool
 from wsgiservice.decorators import mount
-from wsgiservice.exceptions import ResponseException, ValidationException
+from wsgiservice.errors import get_reporter
+from wsgiservice.loader import Loader
+from wsgiservice.tracing import trace_methods
+from wsgiservice.exceptions import (DeadlineExceededException,
+    PoolFullException, ResponseException, TimeoutException,
+    ValidationException)
 from wsgiservice.status import *
 
 logger = logging.getLogger(__name__)
@@ -48,6 +58,20 @@ class Resource(object):
     #: tuple occurs. (Default: Empty tuple)
     NOT_FOUND = ()
 
+    #: Number of seconds to remember GET and HEAD requests for which the
+    #: method raised one of the :attr:`NOT_FOUND` exceptions. Repeated
+    #: requests for the same path and query string are answered with a 404
+    #: without calling the method. Requests with any other method to the same
+    #: path clear the entries. Set to None to disable. (Default: None)
+    NEGATIVE_CACHE_TTL = None
+
+    #: :class:`wsgiservice.cache.BloomFilter` (or any other container) with
+    #: the keys of all the existing items of this resource. GET and HEAD
+    #: requests for keys which are not in the filter are answered with a 404
+    #: without calling the method. See :func:`get_existence_key` for the keys.
+    #: (Default: None)
+    EXISTENCE_FILTER = None
+
     #: A tuple of absolute paths that should return a 404. By default this is
     #: used to ignored requests for favicon.ico and robots.txt so that
     #: browsers don't cause too many exceptions.
@@ -80,6 +104,77 @@ class Resource(object):
     #: sending this.
     charset = 'UTF-8'
 
+    #: :class:`wsgiservice.cache.CachePolicy` applied to successful GET and
+    #: HEAD responses. Can be overwritten per method with the
+    #: :func:`wsgiservice.decorators.cache_policy` decorator. (Default: None)
+    CACHE_POLICY = None
+
+    #: Name of the thread pool in which the ASGI adapter calls this resource
+    #: if it has no coroutine methods. See :mod:`wsgiservice.asgi`. (Default:
+    #: None, which uses the pool ``default``)
+    OFFLOAD_POOL = None
+
+    #: Number of seconds after which clients may retry requests which were
+    #: rejected with a 503 status code because the service is overloaded.
+    #: Sent in the ``Retry-After`` header. (Default: 1)
+    RETRY_AFTER = 1
+
+    #: Maximum number of requests of this resource handled concurrently
+    #: (bulkhead), so a slow resource can't occupy all the threads of the
+    #: application. Requests beyond it wait up to
+    #: :attr:`BULKHEAD_TIMEOUT` seconds and are then rejected with a 503
+    #: status code. None means no limit. (Default: None)
+    BULKHEAD = None
+
+    #: Maximum number of requests waiting for the :attr:`BULKHEAD`.
+    #: (Default: 10)
+    BULKHEAD_QUEUE = 10
+
+    #: Maximum number of seconds a request waits for the :attr:`BULKHEAD`.
+    #: (Default: 0.1)
+    BULKHEAD_TIMEOUT = 0.1
+
+    #: Rate limit of this resource as a tuple of the number of requests and
+    #: the period in seconds, for example ``(100, 60)``. Counted per client
+    #: for this resource only. None uses the default limit of the
+    #: :attr:`wsgiservice.application.Application.RATE_LIMITER`, shared by
+    #: all resources without their own limit. False disables the rate limit.
+    #: (Default: None)
+    RATE_LIMIT = None
+
+    #: How clients are identified for the :attr:`RATE_LIMIT`, see
+    #: :class:`wsgiservice.limits.RateLimiter`. None uses the key of the rate
+    #: limiter. (Default: None)
+    RATE_LIMIT_KEY = None
+
+    #: Number of seconds after which a running request of this resource is
+    #: reported as slow by the
+    #: :attr:`wsgiservice.application.Application.WATCHDOG`. None uses the
+    #: threshold of the watchdog. False disables the reports. (Default:
+    #: None)
+    SLOW_REQUEST_THRESHOLD = None
+
+    #: Name of the thread pool used by :func:`fan_out`. Configure it with
+    #: :func:`wsgiservice.concurrency.set_thread_pool`. (Default: 'fan-out')
+    FAN_OUT_POOL = 'fan-out'
+
+    #: Methods whose return value is discarded with a 504 status code if the
+    #: deadline passed while they ran. Only safe methods, as clients may
+    #: retry the request and apply a write twice. (Default: ('GET', 'HEAD',
+    #: 'OPTIONS'))
+    DEADLINE_CHECKED_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+    #: Status codes of the responses to which the cache policy is applied.
+    #: (Default: (200, 203, 204, 206, 300, 301, 304, 308))
+    CACHEABLE_STATUS = (200, 203, 204, 206, 300, 301, 304, 308)
+
+    #: Status codes of the error responses which may be cached for up to
+    #: :attr:`NEGATIVE_CACHE_TTL` seconds, see
+    #: :func:`wsgiservice.cache.CachePolicy.get_error_policy`. Without a
+    #: :attr:`NEGATIVE_CACHE_TTL` they get no caching headers.
+    #: (Default: (404, 410))
+    NEGATIVE_CACHE_STATUS = (404, 410)
+
     # Cache for the `data` property
     _data = None
 
@@ -122,6 +217,12 @@ class Resource(object):
         """Main entry point for calling this resource. Handles the method
         dispatching, response conversion, etc. for this resource.
 
+        The deadline of the request is checked before the conditions, before
+        calling the method and, for the safe methods in
+        :attr:`DEADLINE_CHECKED_METHODS`, before converting its return value,
+        see :func:`assert_deadline`. If timing is enabled, the end of each phase
+        is recorded, see :mod:`wsgiservice.timing`.
+
         Catches all exceptions:
 
             - :class:`webob.exceptions.ResponseException`: Replaces the
@@ -131,27 +232,166 @@ class Resource(object):
             - :class:`wsgiservice.exceptions.ValidationException`:
               :func:`handle_exception` is called and the response code is set
               to 400 (Bad Request).
+            - :class:`wsgiservice.exceptions.PoolFullException`:
+              :func:`handle_exception_503` is called.
+            - :class:`wsgiservice.exceptions.TimeoutException`:
+              :func:`handle_exception_504` is called.
             - For all other exceptions deriving from the :class:`Exception`
               base class, the :func:`handle_exception` method is called.
         """
+        timing = self.get_timing()
+        if timing is not None:
+            timing.mark('admission')
         self.type = self.get_content_type()
         try:
             self.method = self.get_method()
             self.handle_ignored_resources()
+            self.assert_exists()
+            self.assert_deadline('routing')
             self.assert_conditions()
+            if timing is not None:
+                timing.mark('conditions')
+            self.assert_deadline('conditions')
             self.response.body_raw = self.call_method(self.method)
-        except ResponseException as e:
+            self.forget_not_found()
+            if timing is not None:
+                timing.mark('method')
+            if self.method in self.DEADLINE_CHECKED_METHODS:
+                self.assert_deadline(self.method)
+        except Exception as e:
+            self.handle_call_exception(e)
+        self.convert_response()
+        if timing is not None:
+            timing.mark('serialization')
+        self.set_response_headers()
+        if timing is not None:
+            timing.mark('headers')
+        return self.response
+
+    def handle_call_exception(self, e):
+        """Handles an exception raised while calling the resource. See
+        :func:`__call__` for how the different exceptions are treated.
+
+        :param e: Exception which is being handled.
+        :type e: :class:`Exception`
+        """
+        if isinstance(e, ResponseException):
             # a response was raised, catch it
             self.response = e.response
             r = e.response
             if r.status_int == 404 and not r.body and not hasattr(r, 'body_raw'):
                 self.handle_exception_404(e)
-        except self.NOT_FOUND as e:
+        elif isinstance(e, self.NOT_FOUND):
+            self.remember_not_found()
             self.handle_exception_404(e)
-        except ValidationException as e:
+        elif isinstance(e, ValidationException):
             self.handle_exception(e, status=400)
-        except Exception as e:
+        elif isinstance(e, PoolFullException):
+            self.handle_exception_503(e)
+        elif isinstance(e, TimeoutException):
+            self.handle_exception_504(e)
+        else:
             self.handle_exception(e)
+
+    def get_deadline(self):
+        """Returns the deadline of the current request as a value of
+        :func:`time.monotonic`, or None if the request has no deadline. See
+        :attr:`wsgiservice.application.Application.DEADLINE`."""
+        if self.request is None:
+            return None
+        return self.request.environ.get('wsgiservice.deadline')
+
+    def get_timing(self):
+        """Returns the :class:`wsgiservice.timing.RequestTiming` of the
+        current request, or None if timing is disabled. See
+        :attr:`wsgiservice.application.Application.TIMING`."""
+        if self.request is None:
+            return None
+        return self.request.environ.get('wsgiservice.timing')
+
+    def get_trace(self):
+        """Returns the :class:`wsgiservice.tracing.RequestTrace` of the
+        current request, or None if it's not traced. See
+        :attr:`wsgiservice.application.Application.TRACER`."""
+        if self.request is None:
+            return None
+        return self.request.environ.get('wsgiservice.trace')
+
+    def trace(self, name, args=None):
+        """Returns a context manager adding a span with the given name for
+        the code it runs to the trace of the current request. Does nothing
+        if the request is not traced.
+
+        :param name: Name of the span.
+        :type name: str
+        :param args: Dictionary with additional information shown with the
+                     span.
+        :type args: dict
+        """
+        trace = self.get_trace()
+        if trace is None:
+            return contextlib.nullcontext()
+        return trace.span(name, args=args)
+
+    def get_remaining_time(self):
+        """Returns the number of seconds until the deadline of the current
+        request, or None if it has no deadline. Pass this on as the timeout
+        of calls to other services. 0 if the deadline has passed."""
+        deadline = self.get_deadline()
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
+
+    def assert_deadline(self, phase=None):
+        """Aborts the request if its deadline has passed. Called by
+        :func:`__call__` between the phases of the request. Long-running
+        methods can call it as well to stop work nobody is waiting for
+        anymore.
+
+        :param phase: Name of the phase which was just completed. Only used
+                      in the error message.
+        :type phase: str
+        :raises: :class:`wsgiservice.exceptions.DeadlineExceededException`,
+                 which results in a 504 status code.
+        """
+        deadline = self.get_deadline()
+        if deadline is None:
+            return
+        overdue = time.monotonic() - deadline
+        if overdue >= 0:
+            msg = "Deadline exceeded"
+            if phase:
+                msg += " after " + phase
+            raise DeadlineExceededException(
+                "{0} by {1:.3f} seconds.".format(msg, overdue))
+
+    def assert_internal_token(self):
+        """Aborts the request with a 403 status code unless it contains the
+        :attr:`wsgiservice.application.Application.INTERNAL_TOKEN` of the
+        application. Call this at the start of the methods of internal
+        resources which must not be public.
+        """
+        application = self.application
+        token = getattr(application, 'INTERNAL_TOKEN', None)
+        if token is None:
+            raise_403(self, msg='Internal token not configured.')
+        value = self.request.headers.get(
+            application.INTERNAL_TOKEN_HEADER, '')
+        if not hmac.compare_digest(value.encode('utf-8'),
+                                   token.encode('utf-8')):
+            raise_403(self, msg='Invalid internal token.')
+
+    def get_exception_response(self, e):
+        """Returns the response for an exception raised outside of
+        :func:`__call__`, for example when the request was rejected before
+        calling the resource. The exception is handled the same way as in
+        :func:`__call__`.
+
+        :param e: Exception which is being handled.
+        :type e: :class:`Exception`
+        """
+        self.type = self.get_content_type()
+        self.handle_call_exception(e)
         self.convert_response()
         self.set_response_headers()
         return self.response
@@ -180,18 +420,107 @@ class Resource(object):
     def get_resource(self, resource, **kwargs):
         """Returns a new instance of the resource class passed in as resource.
         This is a helper to make future-compatibility easier when new
-        arguments get added to the constructor.
+        arguments get added to the constructor. If the request is traced,
+        calls of the HTTP methods of the new instance are added to the trace,
+        see :mod:`wsgiservice.tracing`.
 
         :param resource: Resource class to instantiate. Gets called with the
                          named arguments as required for the constructor.
         :type resource: :class:`Resource`
         :param kwargs: Additional named arguments to pass to the constructor
-                       function.
+                       function. May also override the default arguments,
+                       for example to give the new instance its own
+                       response.
         :type kwargs: dict
         """
-        return resource(request=self.request, response=self.response,
-            path_params=self.path_params, application=self.application,
-            **kwargs)
+        args = {'request': self.request, 'response': self.response,
+                'path_params': self.path_params,
+                'application': self.application}
+        args.update(kwargs)
+        instance = resource(**args)
+        trace = self.get_trace()
+        if trace is not None:
+            trace_methods(instance, trace)
+        return instance
+
+    def fan_out(self, calls, timeout=None):
+        """Calls methods of other resources concurrently and returns a list
+        of their return values in the same order. Use this instead of
+        calling :func:`get_resource` in a loop when the calls are
+        independent of each other.
+
+        Each call gets a new resource instance with its own response, so the
+        calls don't interfere with each other's response headers. The
+        threads come from the pool :attr:`FAN_OUT_POOL`, see
+        :func:`wsgiservice.concurrency.gather` for the details.
+
+        Exceptions are raised unchanged, so a
+        :class:`wsgiservice.exceptions.ResponseException` or a
+        :attr:`NOT_FOUND` exception of a call is handled the same way as if
+        the method had been called directly. If several calls fail, the
+        exception of the first one in the list is raised. Calls which time
+        out abort the request with a 504 status code.
+
+        :param calls: List of tuples of the resource class, the name of the
+                      method and a dictionary with the named arguments for
+                      the method. A fourth item can be given to override the
+                      timeout of the call.
+        :type calls: list
+        :param timeout: Maximum time in seconds to wait for each call.
+                        Defaults to the remaining time of the request, see
+                        :func:`get_remaining_time`. None waits forever.
+        :type timeout: float
+        """
+        if timeout is None:
+            timeout = self.get_remaining_time()
+        funcs = []
+        timeouts = []
+        for call in calls:
+            resource, method, kwargs = call[:3]
+            instance = self.get_resource(resource, response=webob.Response())
+            funcs.append(functools.partial(getattr(instance, method),
+                                           **kwargs))
+            timeouts.append(call[3] if len(call) > 3 else timeout)
+        return gather(funcs, timeouts, get_thread_pool(self.FAN_OUT_POOL))
+
+    def get_loader(self, resource, method='load_many', max_batch_size=None):
+        """Returns the :class:`wsgiservice.loader.Loader` of the current
+        request for the given batch method. The loader is created on first
+        use and shared by all the resource instances of the request. See
+        :mod:`wsgiservice.loader` for an example.
+
+        :param resource: Resource class which implements the batch method.
+        :type resource: :class:`Resource`
+        :param method: Name of the batch method. It gets a list of keys and
+                       returns a list of values in the same order or a
+                       dictionary.
+        :type method: str
+        :param max_batch_size: Maximum number of keys per call of the batch
+                               method. Only used when creating the loader.
+        :type max_batch_size: int
+        """
+        if self.request is not None:
+            loaders = self.request.environ.setdefault('wsgiservice.loaders',
+                                                      {})
+        else:
+            loaders = self.__dict__.setdefault('_loaders', {})
+        loader = loaders.get((resource, method))
+        if loader is None:
+            batch_func = getattr(self.get_resource(resource), method)
+            loader = loaders.setdefault((resource, method),
+                Loader(batch_func, max_batch_size=max_batch_size,
+                       deadline=self.get_deadline()))
+        return loader
+
+    @classmethod
+    def invalidate_memoized(cls):
+        """Invalidates all the values cached by methods of this resource
+        which use the :func:`wsgiservice.decorators.memoize` decorator.
+        """
+        for name in dir(cls):
+            invalidate = getattr(getattr(cls, name, None), 'invalidate', None)
+            if callable(invalidate):
+                invalidate(cls)
 
     def get_method(self, method=None):
         """Returns the method to call on this instance as a string. Raises a
@@ -258,6 +587,62 @@ class Resource(object):
                 self.request.path_qs in self.IGNORED_PATHS):
             raise_404(self)
 
+    def assert_exists(self):
+        """Aborts GET and HEAD requests with a 404 status code if the item is
+        known not to exist, either because it's not in the
+        :attr:`EXISTENCE_FILTER` or because the same request recently
+        resulted in a :attr:`NOT_FOUND` exception (see
+        :attr:`NEGATIVE_CACHE_TTL`). For all other methods the remembered
+        requests of the current path are forgotten, see
+        :func:`forget_not_found`.
+
+        :raises: :class:`webob.exceptions.ResponseException` of status 404 if
+                 the item does not exist.
+        """
+        if self.request.method not in ('GET', 'HEAD'):
+            self.forget_not_found()
+            return
+        negative_cache = None
+        if self.NEGATIVE_CACHE_TTL and self.application is not None:
+            negative_cache = self.application.negative_cache
+        if self.EXISTENCE_FILTER is not None and \
+                self.get_existence_key() not in self.EXISTENCE_FILTER:
+            raise_404(self)
+        if negative_cache is not None and (type(self), self.request_path,
+                self.request.query_string) in negative_cache:
+            raise_404(self)
+
+    def get_existence_key(self):
+        """Returns the key which is looked up in the :attr:`EXISTENCE_FILTER`.
+        That's the value of the path parameters ordered by their names,
+        joined by slashes. So for a resource mounted at ``/{id}`` it's just
+        the ID and for ``/{user}/{doc}`` it's ``<doc>/<user>``.
+        """
+        return '/'.join(value
+                        for key, value in sorted(self.path_params.items())
+                        if key != '_extension')
+
+    def remember_not_found(self):
+        """Stores the current request in the negative cache of the
+        application if :attr:`NEGATIVE_CACHE_TTL` is set. Called when the
+        method raised one of the :attr:`NOT_FOUND` exceptions.
+        """
+        if self.NEGATIVE_CACHE_TTL and self.application is not None and \
+                self.request.method in ('GET', 'HEAD'):
+            self.application.negative_cache.add(type(self), self.request_path,
+                self.request.query_string, self.NEGATIVE_CACHE_TTL)
+
+    def forget_not_found(self):
+        """Removes the remembered requests of the current path from the
+        negative cache of the application if the request is not a GET or
+        HEAD request. Called before and again after the method of such
+        requests, so a 404 response stored by a concurrent GET request while
+        the method was running doesn't hide the item which it created.
+        """
+        if self.NEGATIVE_CACHE_TTL and self.application is not None and \
+                self.request.method not in ('GET', 'HEAD'):
+            self.application.negative_cache.clear_path(self.request_path)
+
     def assert_conditions(self):
         """Handles various HTTP conditions and raises HTTP exceptions to
         abort the request.
@@ -373,6 +758,23 @@ class Resource(object):
         """
         return None
 
+    def get_cache_policy(self, method=None):
+        """Returns the :class:`wsgiservice.cache.CachePolicy` for the given
+        method. That's the policy set with the
+        :func:`wsgiservice.decorators.cache_policy` decorator on the method
+        or else :attr:`CACHE_POLICY`.
+
+        :param method: Name of the method. Defaults to the method of the
+                       current request.
+        :type method: str
+        """
+        if method is None:
+            method = self.request.method
+            if method == 'HEAD':
+                method = 'GET'
+        return getattr(getattr(self, method, None), '_cache_policy', None) \
+            or self.CACHE_POLICY
+
     def get_allowed_methods(self):
         """Returns a coma-separated list of method names that are allowed on
         this instance. Useful to set the ``Allowed`` response header.
@@ -533,18 +935,49 @@ class Resource(object):
 
     def handle_exception(self, e, status=500):
         """Handle the given exception. Log, sets the response code and
-        output the exception message as an error message.
+        output the exception message as an error message. Server errors are
+        logged as errors with the traceback, client errors as warnings, see
+        :func:`report_exception`.
 
         :param e: Exception which is being handled.
         :type e: :class:`Exception`
         :param status: Status code to set.
         :type status: int
         """
-        logger.exception(
-            "An exception occurred while handling the request: %s", e)
+        if status >= 500:
+            self.report_exception(e,
+                "An exception occurred while handling the request: %s")
+        else:
+            self.report_exception(e, "Invalid request: %s",
+                                  level=logging.WARNING, exc_info=False)
         self.response.body_raw = {'error': six.text_type(e)}
         self.response.status = status
 
+    def report_exception(self, e, msg, level=logging.ERROR, exc_info=True):
+        """Logs the exception through the
+        :class:`wsgiservice.errors.ErrorReporter`, so repeated exceptions are
+        only logged as periodic summaries. Also counts the exception in the
+        :attr:`wsgiservice.application.Application.METRICS`.
+
+        :param e: Exception which is being handled.
+        :type e: :class:`Exception`
+        :param msg: Log message. ``%s`` is replaced with the exception.
+        :type msg: str
+        :param level: Log level.
+        :type level: int
+        :param exc_info: Whether to log the traceback of the first
+                         occurrence.
+        :type exc_info: bool
+        """
+        get_reporter().report(e, msg, level=level, log=logger,
+                              exc_info=exc_info)
+        metrics = getattr(self.application, 'METRICS', None)
+        if metrics is not None:
+            try:
+                metrics.count_exception(type(e).__name__)
+            except (OSError, ValueError) as error:
+                logger.debug("Counting the exception failed: %s", error)
+
     def handle_exception_404(self, e):
         """Handle the given exception. Log, sets the response code to 404 and
         output the exception message as an error message.
@@ -557,10 +990,38 @@ class Resource(object):
         self.response.body_raw = {'error': 'Not Found'}
         self.response.status = 404
 
+    def handle_exception_503(self, e):
+        """Handle the given exception raised because the service is
+        overloaded. Log, sets the response code to 503 and the
+        ``Retry-After`` header to :attr:`RETRY_AFTER`.
+
+        :param e: Exception which is being handled.
+        :type e: :class:`Exception`
+        """
+        self.report_exception(e, "Rejecting request: %s",
+                              level=logging.WARNING, exc_info=False)
+        self.response.body_raw = {'error': 'Service Unavailable'}
+        self.response.status = 503
+        self.response.headers['Retry-After'] = str(self.RETRY_AFTER)
+
+    def handle_exception_504(self, e):
+        """Handle the given exception raised because a call took too long.
+        Log, sets the response code to 504 and output the exception message
+        as an error message.
+
+        :param e: Exception which is being handled.
+        :type e: :class:`Exception`
+        """
+        self.report_exception(e, "Timeout: %s", level=logging.WARNING,
+                              exc_info=False)
+        self.response.body_raw = {'error': six.text_type(e)}
+        self.response.status = 504
+
     def set_response_headers(self):
         """Sets all the calculated response headers."""
         self.set_response_content_type()
         self.set_response_content_md5()
+        self.set_response_cache_policy()
 
     def set_response_content_type(self):
         """Set the Content-Type in the response. Uses the :attr:`type`
@@ -575,6 +1036,28 @@ class Resource(object):
         elif 'Content-Type' in self.response.headers:
             del self.response.headers['Content-Type']
 
+    def set_response_cache_policy(self):
+        """Set the caching response headers of the cache policy returned by
+        :func:`get_cache_policy`. Only done for GET and HEAD requests with a
+        status code in :attr:`CACHEABLE_STATUS`. Responses with a status code
+        in :attr:`NEGATIVE_CACHE_STATUS` get the shorter error policy of
+        :attr:`NEGATIVE_CACHE_TTL` if it's set.
+        """
+        if self.request.method not in ('GET', 'HEAD'):
+            return
+        status = self.response.status_int
+        if status in self.CACHEABLE_STATUS:
+            policy = self.get_cache_policy()
+        elif status in self.NEGATIVE_CACHE_STATUS and \
+                self.NEGATIVE_CACHE_TTL is not None:
+            policy = self.get_cache_policy()
+            if policy is not None:
+                policy = policy.get_error_policy(self.NEGATIVE_CACHE_TTL)
+        else:
+            return
+        if policy is not None:
+            policy.apply(self.response, self.path_params)
+
     def set_response_content_md5(self):
         """Set the Content-MD5 response header. Calculated from the the
         response body by creating the MD5 hash from it.
@@ -656,6 +1139,7 @@ class Help(Resource):
                     'EXTENSION_MAP': dict((key[1:], value) for key, value
                         in res.EXTENSION_MAP),
                     'NOT_FOUND': [ex.__name__ for ex in res.NOT_FOUND],
+                    'BULKHEAD': res.BULKHEAD,
                 },
                 'methods': self._get_methods(res),
                 'path': self.request.script_name + res._path,
@@ -706,7 +1190,7 @@ class Help(Resource):
         :param method: The method to get parameters from.
         :type method: Python function
         """
-        argspec = self._get_argspec(method)
+        method, argspec = self._get_argspec(method)
         method_params = argspec.args
         if method_params:
             method_params.pop(0)  # pop the self off
@@ -1173,6 +1657,9 @@ class Help(Resource):
                 in resource['properties']['EXTENSION_MAP'].items()]
             retval.append('<tr><th>Representations</th><td>{0}</td>'.format(
                 xml_escape(', '.join(representations))))
+            if resource['properties']['BULKHEAD']:
+                retval.append('<tr><th>Concurrency limit</th><td>{0}</td>'.format(
+                    resource['properties']['BULKHEAD']))
             retval.append('</table>')
             self.to_text_html_methods(retval, resource)
             retval.append('</div>')
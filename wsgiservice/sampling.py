@@ -0,0 +1,250 @@
+"""Sampling profiler and the ``/_internal/profile`` resource.
+
+A :class:`SamplingProfiler` set as
+:attr:`wsgiservice.application.Application.PROFILER` records the Python
+stacks of the threads which are handling requests at a fixed interval. Each
+sample is tagged with the resource and the HTTP method of the request the
+thread was handling. Sampling is cheap enough to leave on in production: the
+request threads only register and unregister themselves, the stacks are
+read by a background thread started with the first request. Resources with
+coroutine methods served by :mod:`wsgiservice.asgi` run on the event loop
+and are not sampled.
+
+The easiest way to enable the profiler is ``get_app(globals(),
+add_profiler=True)``, which mounts :class:`ProfileResource` at
+``/_internal/profile``. It returns the samples of the last minute in the
+collapsed stack format, which is the input of flame graph tools::
+
+    $ curl -H 'X-Internal-Token: secret' \\
+        'http://localhost:8000/_internal/profile?seconds=30' > stacks.txt
+    $ flamegraph.pl stacks.txt > flamegraph.svg
+
+``/_internal/profile.json`` returns the stacks and the functions with the
+most samples. The resource is only available to requests with the
+:attr:`wsgiservice.application.Application.INTERNAL_TOKEN`.
+"""
+import collections
+import logging
+import sys
+import threading
+import time
+
+from wsgiservice.concurrency import BackgroundThread
+from wsgiservice.decorators import mount, validate
+from wsgiservice.errors import get_reporter
+from wsgiservice.resource import Resource
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of the threads handling requests in a background
+    thread. Thread-safe.
+
+    :param interval: Number of seconds between two samples.
+    :type interval: float
+    :param max_samples: Maximum number of samples to keep. The oldest ones
+                        are discarded first.
+    :type max_samples: int
+    :param max_depth: Maximum number of frames of a stack. The outermost
+                      frames are discarded first.
+    :type max_depth: int
+    :param currtime: Function returning the current time in seconds.
+    """
+
+    def __init__(self, interval=0.01, max_samples=100000, max_depth=64,
+                 currtime=time.time):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.currtime = currtime
+        self._samples = collections.deque(maxlen=max_samples)
+        self._active = {}
+        self._names = {}
+        self._thread = BackgroundThread(self.sample, interval,
+            name='wsgiservice-profiler', on_error=self._on_sample_error)
+
+    def enter(self, resource, method):
+        """Registers the current thread as handling a request. Starts the
+        sampling thread on first use and again after a fork.
+
+        :param resource: Name of the resource handling the request.
+        :type resource: str
+        :param method: HTTP method of the request.
+        :type method: str
+        """
+        if not self._thread.running:
+            self.start()
+        self._active[threading.get_ident()] = (resource, method)
+
+    def exit(self):
+        """Unregisters the current thread."""
+        self._active.pop(threading.get_ident(), None)
+
+    def start(self):
+        """Starts the sampling thread unless it's already running in this
+        process."""
+        self._thread.start()
+
+    def stop(self):
+        """Stops the sampling thread. Keeps the samples."""
+        self._thread.stop()
+
+    def sample(self):
+        """Records the stacks of the threads which are currently handling a
+        request. Called by the sampling thread every :attr:`interval`
+        seconds."""
+        frames = sys._current_frames()
+        now = self.currtime()
+        for ident, (resource, method) in list(self._active.items()):
+            frame = frames.get(ident)
+            if frame is not None:
+                self._samples.append((now, resource, method,
+                                      self._get_stack(frame)))
+
+    def get_samples(self, seconds=None):
+        """Returns the samples as a list of ``(timestamp, resource, method,
+        stack)`` tuples, oldest first. The stacks are tuples of function
+        names, outermost first.
+
+        :param seconds: Only return the samples of this many seconds before
+                        now. None for all the samples.
+        :type seconds: float
+        """
+        samples = list(self._samples)
+        if seconds is not None:
+            since = self.currtime() - seconds
+            samples = [sample for sample in samples if sample[0] >= since]
+        return samples
+
+    def get_stacks(self, seconds=None):
+        """Returns a list of ``(stack, count)`` tuples with the number of
+        samples of each distinct stack, most frequent first. The resource and
+        the method are the outermost frames of the stacks.
+
+        :param seconds: Only include the samples of this many seconds before
+                        now. None for all the samples.
+        :type seconds: float
+        """
+        counts = collections.Counter(
+            (resource, method) + stack
+            for timestamp, resource, method, stack
+            in self.get_samples(seconds))
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+    def get_collapsed(self, seconds=None):
+        """Returns the samples in the collapsed stack format used by flame
+        graph tools: one line per distinct stack with the frames separated by
+        semicolons and the number of samples. See :func:`get_stacks`.
+
+        :param seconds: Only include the samples of this many seconds before
+                        now. None for all the samples.
+        :type seconds: float
+        """
+        return ''.join('{0} {1}\n'.format(';'.join(stack), count)
+                       for stack, count in self.get_stacks(seconds))
+
+    def get_top(self, count=20, seconds=None):
+        """Returns the functions which appear in the most samples as a list
+        of dictionaries with the ``function``, the number of samples in which
+        it was running (``self``) and in which it was on the stack
+        (``total``).
+
+        :param count: Maximum number of functions to return.
+        :type count: int
+        :param seconds: Only include the samples of this many seconds before
+                        now. None for all the samples.
+        :type seconds: float
+        """
+        own = collections.Counter()
+        total = collections.Counter()
+        for timestamp, resource, method, stack in self.get_samples(seconds):
+            if stack:
+                own[stack[-1]] += 1
+            total.update(set(stack))
+        functions = sorted(total, key=lambda f: (-own[f], -total[f], f))
+        return [{'function': function, 'self': own[function],
+                 'total': total[function]}
+                for function in functions[:count]]
+
+    def clear(self):
+        """Discards all the samples."""
+        self._samples.clear()
+
+    def _on_sample_error(self, e):
+        """Reports an exception of the sampling thread."""
+        get_reporter().report(e, "Sampling the stacks failed: %s",
+                              log=logger)
+
+    def _get_stack(self, frame):
+        """Returns the names of the functions on the stack of the frame,
+        outermost first."""
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            stack.append(self._get_name(frame))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    def _get_name(self, frame):
+        """Returns the name of the function of the frame, consisting of the
+        module and the qualified name of the function."""
+        code = frame.f_code
+        name = self._names.get(code)
+        if name is None:
+            name = '{0}.{1}'.format(frame.f_globals.get('__name__', '?'),
+                getattr(code, 'co_qualname', code.co_name))
+            # Spaces and semicolons separate the collapsed format
+            name = self._names[code] = name.replace(' ', '_').replace(
+                ';', ':')
+        return name
+
+
+@mount('/_internal/profile')
+class ProfileResource(Resource):
+    """Exposes the samples of the
+    :attr:`wsgiservice.application.Application.PROFILER`. Returns the
+    collapsed stacks by default, JSON and XML include the functions with the
+    most samples as well. Requires the
+    :attr:`wsgiservice.application.Application.INTERNAL_TOKEN`."""
+    EXTENSION_MAP = [('.txt', 'text/plain')] + Resource.EXTENSION_MAP
+    XML_ROOT_TAG = 'profile'
+    NOT_FOUND = (KeyError,)
+
+    @validate('seconds', re='[0-9]+(\\.[0-9]+)?', convert=float,
+              doc='Number of seconds of samples to include.')
+    @validate('top', re='[0-9]+', convert=int,
+              doc='Number of functions with the most samples to include.')
+    def GET(self, seconds='60', top='20'):
+        """Returns the samples of the last seconds."""
+        self.assert_internal_token()
+        profiler = self.get_profiler()
+        if profiler is None:
+            raise KeyError('profiler')
+        samples = profiler.get_samples(seconds)
+        return {
+            'interval': profiler.interval,
+            'seconds': seconds,
+            'samples': len(samples),
+            'top': profiler.get_top(top, seconds),
+            'stacks': [{'stack': ';'.join(stack), 'count': count}
+                       for stack, count in profiler.get_stacks(seconds)],
+        }
+
+    def get_profiler(self):
+        """Returns the :class:`SamplingProfiler` of the application or
+        None."""
+        if self.application is None:
+            return None
+        return self.application.PROFILER
+
+    def to_text_plain(self, raw):
+        """Returns the collapsed stacks.
+
+        :param raw: The return value of :func:`GET`.
+        :type raw: dict
+        """
+        if 'error' in raw:
+            return raw['error'] + '\n'
+        return ''.join('{0} {1}\n'.format(row['stack'], row['count'])
+                       for row in raw['stacks'])
+
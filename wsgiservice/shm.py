@@ -0,0 +1,331 @@
+"""Tables in shared memory, to share state between the worker processes of a
+host.
+
+A :class:`SharedTable` maps string keys to a fixed number of floats. It's
+stored in a memory-mapped file, by default in ``/dev/shm``, so all the
+processes which open a table with the same name see the same data. Updates
+are atomic across threads and processes.
+
+Tables have a fixed number of slots. The slots are grouped into buckets and
+each key can only be stored in the bucket its hash maps to. When a bucket is
+full, the least recently written key of the bucket is evicted. So tables
+should be sized generously for the number of keys they are expected to hold.
+
+Only available on platforms with :mod:`fcntl`. Elsewhere the tables are
+still thread-safe but not shared between processes.
+
+The file locks of :mod:`fcntl` belong to the process, not to the file
+descriptor, and closing any descriptor of a file releases all the locks of
+the process on it. So all the :class:`SharedTable` instances of a process
+which use the same file share one descriptor, mapping and set of thread
+locks. The file is closed when the last of them is closed.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+#: The open :class:`_SharedFile` instances by file name.
+_files = {}
+_files_lock = threading.Lock()
+
+
+class SharedTable(object):
+    """Table of float values in shared memory.
+
+    :param name: Name of the table. Processes using the same name share the
+                 table, so use a name which is unique to the service on the
+                 host.
+    :type name: str
+    :param fields: Number of float values per key.
+    :type fields: int
+    :param slots: Number of keys the table can hold.
+    :type slots: int
+    :param key_size: Maximum length of the keys in bytes. Longer keys are
+                     hashed, :func:`items` doesn't return their original
+                     value.
+    :type key_size: int
+    :param path: Directory in which the table file is created. Defaults to
+                 ``/dev/shm`` if it exists, to the temporary directory
+                 otherwise.
+    :type path: str
+    """
+
+    #: Number of slots per bucket.
+    BUCKET_SIZE = 8
+
+    #: Number of locks synchronising the threads of a process.
+    THREAD_LOCKS = 64
+
+    _HEADER = struct.Struct('<8sIII')
+    _MAGIC = b'wsgisvc1'
+
+    def __init__(self, name, fields=2, slots=65536, key_size=64, path=None):
+        self.name = name
+        self.fields = fields
+        self.key_size = key_size
+        self.buckets = max(1, -(-slots // self.BUCKET_SIZE))
+        self.slots = self.buckets * self.BUCKET_SIZE
+        self._slot = struct.Struct('<H{0}sd{1}d'.format(key_size, fields))
+        self._bucket_bytes = self._slot.size * self.BUCKET_SIZE
+        if path is None:
+            path = '/dev/shm' if os.path.isdir('/dev/shm') \
+                else tempfile.gettempdir()
+        self.filename = os.path.join(path, 'wsgiservice-' + name)
+        size = self._HEADER.size + self.buckets * self._bucket_bytes
+        self._file = _SharedFile.open(self.filename, size)
+        self._map = self._file.map
+        self._locks = self._file.locks
+        self._file.lock(0, self._HEADER.size)
+        try:
+            self._check_header()
+        except Exception:
+            self._file.unlock(0, self._HEADER.size)
+            self._file.close()
+            raise
+        self._file.unlock(0, self._HEADER.size)
+
+    def get(self, key):
+        """Returns the tuple of values of the key, or None if the key is not
+        in the table.
+
+        :param key: The key to look up.
+        :type key: str
+        """
+        return self.update(key, lambda values: (None, values))
+
+    def update(self, key, func):
+        """Updates the values of the key atomically. `func` gets the tuple
+        of current values, or None if the key is not in the table. It returns
+        a two-item tuple of the new values (or None to leave them unchanged)
+        and the return value of this method.
+
+        :param key: The key to update.
+        :type key: str
+        :param func: Function computing the new values.
+        :type func: callable
+        """
+        encoded = self._encode_key(key)
+        bucket = self._get_bucket(encoded)
+        offset = self._HEADER.size + bucket * self._bucket_bytes
+        with self._locks[bucket % self.THREAD_LOCKS]:
+            self._file.lock(offset, self._bucket_bytes)
+            try:
+                slot_offset, values = self._find(offset, encoded)
+                new_values, retval = func(values)
+                if new_values is not None:
+                    self._slot.pack_into(self._map, slot_offset,
+                        len(encoded), encoded, time.time(),
+                        *[float(v) for v in new_values])
+                return retval
+            finally:
+                self._file.unlock(offset, self._bucket_bytes)
+
+    def add(self, key, increments):
+        """Adds the increments to the values of the key and returns the new
+        values. Missing keys start with all values set to 0.
+
+        :param key: The key to update.
+        :type key: str
+        :param increments: One number per field.
+        :type increments: tuple
+        """
+        def add(values):
+            values = tuple(a + b for a, b in zip(
+                values or (0.0,) * self.fields, increments))
+            return values, values
+        return self.update(key, add)
+
+    def delete(self, key):
+        """Removes the key from the table.
+
+        :param key: The key to remove.
+        :type key: str
+        """
+        encoded = self._encode_key(key)
+        bucket = self._get_bucket(encoded)
+        offset = self._HEADER.size + bucket * self._bucket_bytes
+        with self._locks[bucket % self.THREAD_LOCKS]:
+            self._file.lock(offset, self._bucket_bytes)
+            try:
+                slot_offset, values = self._find(offset, encoded)
+                if values is not None:
+                    self._map[slot_offset:slot_offset + self._slot.size] = \
+                        b'\0' * self._slot.size
+            finally:
+                self._file.unlock(offset, self._bucket_bytes)
+
+    def items(self):
+        """Returns a list of all the keys and their tuple of values. The
+        buckets are read one after the other, so concurrent updates may be
+        partially visible."""
+        retval = []
+        for bucket in range(self.buckets):
+            offset = self._HEADER.size + bucket * self._bucket_bytes
+            with self._locks[bucket % self.THREAD_LOCKS]:
+                self._file.lock(offset, self._bucket_bytes)
+                try:
+                    for i in range(self.BUCKET_SIZE):
+                        slot = self._slot.unpack_from(
+                            self._map, offset + i * self._slot.size)
+                        if slot[0]:
+                            retval.append((slot[1][:slot[0]].decode('utf-8',
+                                'replace'), tuple(slot[3:])))
+                finally:
+                    self._file.unlock(offset, self._bucket_bytes)
+        return retval
+
+    def clear(self):
+        """Removes all the keys."""
+        for bucket in range(self.buckets):
+            offset = self._HEADER.size + bucket * self._bucket_bytes
+            with self._locks[bucket % self.THREAD_LOCKS]:
+                self._file.lock(offset, self._bucket_bytes)
+                try:
+                    self._map[offset:offset + self._bucket_bytes] = \
+                        b'\0' * self._bucket_bytes
+                finally:
+                    self._file.unlock(offset, self._bucket_bytes)
+
+    def close(self):
+        """Closes the table. The file is unmapped once all the tables of
+        this process using it are closed. The file stays, so the data is
+        kept for other processes."""
+        self._file.close()
+
+    def unlink(self):
+        """Deletes the file of the table."""
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+    def _check_header(self):
+        """Writes the header of a new table or verifies the one of an
+        existing table."""
+        magic, fields, slots, key_size = self._HEADER.unpack_from(self._map, 0)
+        if magic == b'\0' * len(self._MAGIC):
+            self._HEADER.pack_into(self._map, 0, self._MAGIC, self.fields,
+                                   self.slots, self.key_size)
+        elif (magic, fields, slots, key_size) != (self._MAGIC, self.fields,
+                                                  self.slots, self.key_size):
+            raise ValueError(
+                "Shared table {0} exists with a different layout.".format(
+                    self.filename))
+
+    def _find(self, offset, encoded):
+        """Returns the offset of the slot for the key in the bucket at the
+        given offset and the current values of the key (None if the key is
+        not stored). Picks an empty or the least recently written slot for
+        new keys."""
+        free_offset = None
+        oldest = None
+        for i in range(self.BUCKET_SIZE):
+            slot_offset = offset + i * self._slot.size
+            slot = self._slot.unpack_from(self._map, slot_offset)
+            length, key, written = slot[:3]
+            if length == len(encoded) and key[:length] == encoded:
+                return slot_offset, tuple(slot[3:])
+            if not length:
+                if free_offset is None:
+                    free_offset = slot_offset
+            elif free_offset is None and (oldest is None or
+                                          written < oldest[0]):
+                oldest = (written, slot_offset)
+        if free_offset is not None:
+            return free_offset, None
+        return oldest[1], None
+
+    def _encode_key(self, key):
+        """Returns the key as bytes of at most :attr:`key_size` bytes."""
+        encoded = key.encode('utf-8')
+        if len(encoded) > self.key_size:
+            encoded = hashlib.md5(encoded).hexdigest().encode('ascii')
+        return encoded
+
+    def _get_bucket(self, encoded):
+        """Returns the index of the bucket for the encoded key."""
+        digest = hashlib.md5(encoded).digest()
+        return struct.unpack('<I', digest[:4])[0] % self.buckets
+
+
+class _SharedFile(object):
+    """The descriptor, memory map and thread locks of a table file, shared
+    by all the :class:`SharedTable` instances of the process which use the
+    file. Use :func:`open` to get one.
+
+    :param filename: Name of the file.
+    :type filename: str
+    :param size: Minimum size of the file in bytes.
+    :type size: int
+    """
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        #: Locks synchronising the threads of the process, see
+        #: :attr:`SharedTable.THREAD_LOCKS`.
+        self.locks = [threading.Lock()
+                      for i in range(SharedTable.THREAD_LOCKS)]
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+        self._references = 1
+        try:
+            self.lock(0, size)
+            try:
+                if os.fstat(self.fd).st_size < size:
+                    os.ftruncate(self.fd, size)
+                self.map = mmap.mmap(self.fd, os.fstat(self.fd).st_size)
+            finally:
+                self.unlock(0, size)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    @classmethod
+    def open(cls, filename, size):
+        """Returns the open file with the given name, opening it if this
+        process doesn't have it open yet. Must be closed with
+        :func:`close`.
+
+        :param filename: Name of the file.
+        :type filename: str
+        :param size: Minimum size of the file in bytes.
+        :type size: int
+        """
+        key = os.path.realpath(filename)
+        with _files_lock:
+            shared = _files.get(key)
+            if shared is None:
+                shared = _files[key] = cls(filename, size)
+            else:
+                shared._references += 1
+        return shared
+
+    def close(self):
+        """Releases the file. Closes it when it's not used anymore."""
+        with _files_lock:
+            self._references -= 1
+            if self._references > 0:
+                return
+            for key, shared in list(_files.items()):
+                if shared is self:
+                    del _files[key]
+        self.map.close()
+        os.close(self.fd)
+
+    def lock(self, offset, length):
+        """Locks the given range of the file for other processes."""
+        if fcntl is not None:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, offset)
+
+    def unlock(self, offset, length):
+        """Unlocks the given range of the file."""
+        if fcntl is not None:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
@@ -323,6 +323,23 @@ def raise_415(instance, msg=None):
     raise ResponseException(instance.response)
 
 
+def raise_429(instance, retry_after=None):
+    """Abort the current request with a 429 (Too Many Requests) response
+    code. Sets the ``Retry-After`` header if a value is given.
+
+    :param instance: Resource instance (used to access the response)
+    :type instance: :class:`webob.resource.Resource`
+    :param retry_after: Number of seconds after which the client may retry
+                        the request.
+    :type retry_after: int
+    :raises: :class:`webob.exceptions.ResponseException` of status 429
+    """
+    instance.response.status = 429
+    if retry_after is not None:
+        instance.response.headers['Retry-After'] = str(int(retry_after))
+    raise ResponseException(instance.response)
+
+
 def raise_500(instance, msg=None):
     """Abort the current request with a 500 (Internal Server Error) response
     code. If the message is given it's output as an error message in the
@@ -352,15 +369,35 @@ def raise_501(instance):
     raise ResponseException(instance.response)
 
 
-def raise_503(instance):
+def raise_503(instance, retry_after=None):
     """Abort the current request with a 503 (Service Unavailable) response
-    code.
+    code. Sets the ``Retry-After`` header if a value is given.
 
     :param instance: Resource instance (used to access the response)
     :type instance: :class:`webob.resource.Resource`
+    :param retry_after: Number of seconds after which the client may retry
+                        the request.
+    :type retry_after: int
     :raises: :class:`webob.exceptions.ResponseException` of status 503
     """
     instance.response.status = 503
+    if retry_after is not None:
+        instance.response.headers['Retry-After'] = str(int(retry_after))
+    raise ResponseException(instance.response)
+
+
+def raise_504(instance, msg=None):
+    """Abort the current request with a 504 (Gateway Timeout) response code.
+    If the message is given it's output as an error message in the response
+    body (correctly converted to the requested MIME type).
+
+    :param instance: Resource instance (used to access the response)
+    :type instance: :class:`webob.resource.Resource`
+    :raises: :class:`webob.exceptions.ResponseException` of status 504
+    """
+    instance.response.status = 504
+    if msg:
+        instance.response.body_raw = {'error': msg}
     raise ResponseException(instance.response)
 
 
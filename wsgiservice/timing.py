@@ -0,0 +1,153 @@
+"""Timing of the phases of a request.
+
+With :attr:`wsgiservice.application.Application.TIMING` enabled every
+request gets a :class:`RequestTiming`, which records a timestamp at each
+boundary between the phases of the request:
+
+    - ``routing``: Finding the resource and creating its instance.
+    - ``admission``: Rate limiting, admission control, the bulkhead and the
+      response cache, up to the call of the resource.
+    - ``conditions``: Method lookup and the conditional request headers,
+      including :func:`wsgiservice.Resource.get_etag` and
+      :func:`wsgiservice.Resource.get_last_modified`.
+    - ``method``: The resource method itself.
+    - ``serialization``: :func:`wsgiservice.Resource.convert_response`.
+    - ``headers``: :func:`wsgiservice.Resource.set_response_headers`,
+      including the ``Content-MD5`` header.
+
+Phases which are skipped, for example because the method raised an
+exception, are missing. The time they would have taken is part of the next
+phase which is recorded.
+
+The timing is available in the ``wsgiservice.timing`` key of the WSGI
+environment and with :func:`wsgiservice.Resource.get_timing`. The
+application aggregates the timings per resource in a :class:`TimingStats`
+instance and adds them to the response as a ``Server-Timing`` header if
+:attr:`wsgiservice.application.Application.SERVER_TIMING` is set.
+"""
+import threading
+import time
+
+#: Names of the phases of a request in their order.
+PHASES = ('routing', 'admission', 'conditions', 'method', 'serialization',
+          'headers')
+
+
+class RequestTiming(object):
+    """Durations of the phases of one request. Uses a monotonic clock.
+
+    :param start: Value of :func:`time.perf_counter` at which the request
+                  started. Defaults to now.
+    :type start: float
+    """
+
+    def __init__(self, start=None):
+        if start is None:
+            start = time.perf_counter()
+        #: Start of the request.
+        self.start = start
+        #: List of two-item tuples of phase name and duration in seconds.
+        self.phases = []
+        #: Total duration of the request in seconds. Set by :func:`finish`.
+        self.total = None
+        self._last = start
+
+    def mark(self, phase):
+        """Ends the given phase, which started at the end of the previous
+        one. Does nothing once the request is finished.
+
+        :param phase: Name of the phase.
+        :type phase: str
+        """
+        if self.total is None:
+            now = time.perf_counter()
+            self.phases.append((phase, now - self._last))
+            self._last = now
+
+    def finish(self):
+        """Ends the request and sets :attr:`total`."""
+        if self.total is None:
+            self.total = time.perf_counter() - self.start
+
+    def get(self, phase):
+        """Returns the duration of the given phase in seconds or None if the
+        phase was not recorded.
+
+        :param phase: Name of the phase.
+        :type phase: str
+        """
+        for name, duration in self.phases:
+            if name == phase:
+                return duration
+        return None
+
+    def get_current_phase(self):
+        """Returns the name of the phase the request is in: the one after
+        the last recorded phase in :data:`PHASES`. None once the request is
+        finished."""
+        if self.total is not None:
+            return None
+        if not self.phases:
+            return PHASES[0]
+        last = self.phases[-1][0]
+        if last not in PHASES or last == PHASES[-1]:
+            return None
+        return PHASES[PHASES.index(last) + 1]
+
+    def get_header(self):
+        """Returns the value of the ``Server-Timing`` header, with the
+        durations in milliseconds."""
+        metrics = list(self.phases)
+        if self.total is not None:
+            metrics.append(('total', self.total))
+        return ', '.join('{0};dur={1:.3f}'.format(name, duration * 1000)
+                         for name, duration in metrics)
+
+
+class TimingStats(object):
+    """Aggregates :class:`RequestTiming` instances per resource. Thread-safe.
+    """
+
+    def __init__(self):
+        self._resources = {}
+        self._lock = threading.Lock()
+
+    def add(self, resource, timing):
+        """Adds the finished timing of a request.
+
+        :param resource: Name of the resource which handled the request.
+        :type resource: str
+        :param timing: The timing of the request.
+        :type timing: :class:`RequestTiming`
+        """
+        metrics = list(timing.phases)
+        if timing.total is not None:
+            metrics.append(('total', timing.total))
+        with self._lock:
+            phases = self._resources.setdefault(resource, {})
+            for name, duration in metrics:
+                stats = phases.get(name)
+                if stats is None:
+                    phases[name] = [1, duration, duration]
+                else:
+                    stats[0] += 1
+                    stats[1] += duration
+                    if duration > stats[2]:
+                        stats[2] = duration
+
+    def get_stats(self):
+        """Returns a dictionary mapping the resource names to dictionaries
+        with the statistics of each phase: ``count``, ``total``, ``mean``
+        and ``max``. Times are in seconds."""
+        with self._lock:
+            return dict(
+                (resource, dict(
+                    (name, {'count': count, 'total': total,
+                            'mean': total / count, 'max': maximum})
+                    for name, (count, total, maximum) in phases.items()))
+                for resource, phases in self._resources.items())
+
+    def clear(self):
+        """Removes all the statistics."""
+        with self._lock:
+            self._resources.clear()
@@ -0,0 +1,270 @@
+"""Request traces in the Chrome trace event format.
+
+A :class:`Tracer` set as :attr:`wsgiservice.application.Application.TRACER`
+records a trace of the selected requests and writes it to local files which
+can be opened offline in ``chrome://tracing`` or the Perfetto UI. Each
+request is a span on the timeline of the thread handling it, with nested
+spans for the phases of the request (see :mod:`wsgiservice.timing`) and for
+the HTTP methods of other resources called on instances returned by
+:func:`wsgiservice.Resource.get_resource`, including the ones of
+:func:`wsgiservice.Resource.fan_out`. Resources can add their own spans with
+:func:`wsgiservice.Resource.trace`.
+
+Every traced request gets a request ID, taken from the
+:attr:`Tracer.REQUEST_ID_HEADER` of the request if it has one and generated
+otherwise, which is returned in the same response header. Each process
+writes to its own file in the directory of the tracer, ``trace.<pid>.json``,
+which is rotated when it reaches the maximum size::
+
+    app.TRACER = Tracer('/var/tmp/traces', sample_rate=0.01)
+
+The files use the JSON array format without the closing bracket, which the
+trace viewers accept, so events can be appended.
+"""
+import contextlib
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+from wsgiservice.errors import get_reporter
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTrace(object):
+    """Spans of one request. Spans can be added from any thread.
+
+    :param request_id: ID of the request.
+    :type request_id: str
+    """
+
+    def __init__(self, request_id):
+        #: ID of the request.
+        self.request_id = request_id
+        #: List of the trace events of the spans.
+        self.events = []
+
+    def add(self, name, start, end, category='wsgiservice', args=None,
+            thread=None):
+        """Adds a span.
+
+        :param name: Name of the span.
+        :type name: str
+        :param start: Value of :func:`time.perf_counter` at which the span
+                      started.
+        :type start: float
+        :param end: Value of :func:`time.perf_counter` at which the span
+                    ended.
+        :type end: float
+        :param category: Category of the span.
+        :type category: str
+        :param args: Dictionary with additional information shown with the
+                     span.
+        :type args: dict
+        :param thread: ID of the thread of the span. Defaults to the current
+                       thread.
+        :type thread: int
+        """
+        event = {'name': name, 'cat': category, 'ph': 'X',
+                 'ts': round(start * 1000000, 3),
+                 'dur': round((end - start) * 1000000, 3),
+                 'pid': os.getpid(),
+                 'tid': thread or threading.get_ident()}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category='wsgiservice', args=None):
+        """Context manager adding a span for the code it runs.
+
+        :param name: Name of the span.
+        :type name: str
+        :param category: Category of the span.
+        :type category: str
+        :param args: Dictionary with additional information shown with the
+                     span.
+        :type args: dict
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter(), category, args)
+
+
+class Tracer(object):
+    """Traces selected requests and writes the traces to files. Thread-safe.
+
+    :param directory: Directory to write the traces to. Created if it
+                      doesn't exist.
+    :type directory: str
+    :param sample_rate: Fraction of the requests to trace.
+    :type sample_rate: float
+    :param max_bytes: Size in bytes after which the file is rotated.
+    :type max_bytes: int
+    :param backup_count: Number of rotated files to keep, as
+                         ``trace.<pid>.json.1`` and so on.
+    :type backup_count: int
+    :param random: Function returning a random float between 0 and 1. Used
+                   for testing.
+    """
+
+    #: Request header with the ID of the request. Set on the responses of
+    #: traced requests. (Default: 'X-Request-Id')
+    REQUEST_ID_HEADER = 'X-Request-Id'
+
+    def __init__(self, directory, sample_rate=1.0, max_bytes=10485760,
+                 backup_count=5, random=random.random):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.random = random
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self, request):
+        """Returns a new :class:`RequestTrace` for the request if it is
+        selected for tracing, None otherwise.
+
+        :param request: Object representing the current request.
+        :type request: :class:`webob.Request`
+        """
+        if self.sample_rate < 1.0 and self.random() >= self.sample_rate:
+            return None
+        request_id = request.headers.get(self.REQUEST_ID_HEADER)
+        return RequestTrace(request_id or uuid.uuid4().hex)
+
+    def finish(self, instance, trace, timing, response):
+        """Adds the spans of the request and its phases to the trace and
+        writes it.
+
+        :param instance: The resource instance which handled the request.
+        :type instance: :class:`wsgiservice.Resource`
+        :param trace: The trace returned by :func:`start`.
+        :type trace: :class:`RequestTrace`
+        :param timing: The finished timing of the request.
+        :type timing: :class:`wsgiservice.timing.RequestTiming`
+        :param response: The response sent to the client.
+        :type response: :class:`webob.Response`
+        """
+        request = instance.request
+        start = timing.start
+        for phase, duration in timing.phases:
+            trace.add(phase, start, start + duration, category='phase')
+            start += duration
+        trace.add('{0} {1}'.format(request.method, request.path_info),
+                  timing.start, timing.start + timing.total,
+                  category='request',
+                  args={'request_id': trace.request_id,
+                        'resource': type(instance).__name__,
+                        'status': response.status_int})
+        response.headers[self.REQUEST_ID_HEADER] = trace.request_id
+        self.write(trace.events)
+
+    def write(self, events):
+        """Appends the events to the file of this process, rotating it if
+        it's full. Fails open: errors are reported and the events are
+        discarded.
+
+        :param events: List of trace events.
+        :type events: list
+        """
+        data = ''.join(json.dumps(event, sort_keys=True) + ',\n'
+                       for event in events)
+        with self._lock:
+            try:
+                output = self._get_file()
+                if output.tell() + len(data) > self.max_bytes and \
+                        output.tell() > 2:
+                    self._rotate()
+                    output = self._get_file()
+                output.write(data)
+                output.flush()
+            except OSError as e:
+                get_reporter().report(e, "Writing the trace failed: %s",
+                                      log=logger)
+
+    def get_filename(self):
+        """Returns the name of the file of this process."""
+        return os.path.join(self.directory,
+                            'trace.{0}.json'.format(os.getpid()))
+
+    def close(self):
+        """Closes the file."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = self._pid = None
+
+    def _get_file(self):
+        """Returns the file of this process, opening it on first use and
+        again after a fork. New files start with the opening bracket. Must be
+        called with the lock held."""
+        pid = os.getpid()
+        if self._pid != pid:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self._file = open(self.get_filename(), 'a')
+            self._pid = pid
+            if self._file.tell() == 0:
+                self._file.write('[\n')
+        return self._file
+
+    def _rotate(self):
+        """Closes the file and renames it and its backups. Must be called
+        with the lock held."""
+        self._file.close()
+        self._file = self._pid = None
+        filename = self.get_filename()
+        if self.backup_count <= 0:
+            os.remove(filename)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '{0}.{1}'.format(filename, i)
+            if os.path.exists(source):
+                os.replace(source, '{0}.{1}'.format(filename, i + 1))
+        os.replace(filename, filename + '.1')
+
+
+def trace_methods(instance, trace):
+    """Replaces the HTTP methods of the resource instance with wrappers
+    adding a span for each call to the trace. Coroutine functions are left
+    unchanged. Used by :func:`wsgiservice.Resource.get_resource`.
+
+    :param instance: The resource instance.
+    :type instance: :class:`wsgiservice.Resource`
+    :param trace: The trace of the current request.
+    :type trace: :class:`RequestTrace`
+    """
+    resource = type(instance)
+    for name in instance.KNOWN_METHODS:
+        func = getattr(resource, name, None)
+        if func is None or not inspect.isfunction(func) or \
+                inspect.iscoroutinefunction(func):
+            continue
+        instance.__dict__[name] = _get_traced_method(instance, func, trace)
+
+
+def _get_traced_method(instance, func, trace):
+    """Returns a wrapper of the method of the instance adding a span for
+    each call. The wrapper has the signature of the unbound function, so
+    :func:`wsgiservice.Resource.call_method` passes the right parameters."""
+    method = func.__get__(instance, type(instance))
+    name = '{0}.{1}'.format(type(instance).__name__, func.__name__)
+
+    @functools.wraps(func)
+    def traced(*args, **kwargs):
+        with trace.span(name, category='resource'):
+            return method(*args, **kwargs)
+    del traced.__wrapped__
+    traced.__signature__ = inspect.signature(func)
+    return traced
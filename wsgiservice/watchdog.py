@@ -0,0 +1,204 @@
+"""Detection of slow requests while they are running.
+
+A :class:`Watchdog` set as
+:attr:`wsgiservice.application.Application.WATCHDOG` checks the running
+requests from a background thread. Once a request has been running for
+longer than the threshold of its resource, the watchdog takes a snapshot of
+the stack of the thread handling it and notes the phase the request is in,
+see :mod:`wsgiservice.timing`. The phase is only known with
+:attr:`wsgiservice.application.Application.TIMING` enabled. Each slow
+request is logged once as a warning and kept in a ring buffer of the most
+recent reports. Resources can set their own threshold with
+:attr:`wsgiservice.Resource.SLOW_REQUEST_THRESHOLD`.
+
+The easiest way to enable the watchdog is ``get_app(globals(),
+add_watchdog=True)``, which mounts :class:`SlowRequestsResource` at
+``/_internal/slow``. The resource is only available to requests with the
+:attr:`wsgiservice.application.Application.INTERNAL_TOKEN`. Resources with
+coroutine methods served by :mod:`wsgiservice.asgi` are not watched.
+"""
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from wsgiservice.concurrency import BackgroundThread
+from wsgiservice.decorators import mount
+from wsgiservice.errors import get_reporter
+from wsgiservice.resource import Resource
+
+logger = logging.getLogger(__name__)
+
+
+class Watchdog(object):
+    """Reports requests which run for longer than a threshold. Thread-safe.
+
+    :param threshold: Number of seconds after which requests are reported,
+                      unless their resource has its own
+                      :attr:`wsgiservice.Resource.SLOW_REQUEST_THRESHOLD`.
+    :type threshold: float
+    :param interval: Number of seconds between two checks.
+    :type interval: float
+    :param max_reports: Number of reports to keep. The oldest ones are
+                        discarded first.
+    :type max_reports: int
+    :param currtime: Function returning the current time in seconds.
+    """
+
+    #: Request header with the ID of the request. Included in the reports as
+    #: ``request_id``. (Default: 'X-Request-Id')
+    REQUEST_ID_HEADER = 'X-Request-Id'
+
+    def __init__(self, threshold=1.0, interval=0.1, max_reports=100,
+                 currtime=time.time):
+        self.threshold = threshold
+        self.interval = interval
+        self.currtime = currtime
+        self._reports = collections.deque(maxlen=max_reports)
+        self._active = {}
+        self._thread = BackgroundThread(self.check, interval,
+            name='wsgiservice-watchdog', on_error=self._on_check_error)
+
+    def enter(self, instance):
+        """Starts watching the request of the resource instance, which is
+        handled by the current thread. Starts the watchdog thread on first
+        use and again after a fork.
+
+        :param instance: The resource instance handling the request.
+        :type instance: :class:`wsgiservice.Resource`
+        """
+        threshold = self.get_threshold(type(instance))
+        if threshold is None:
+            return
+        if not self._thread.running:
+            self.start()
+        self._active[threading.get_ident()] = [instance, self.currtime(),
+                                               threshold, False]
+
+    def exit(self):
+        """Stops watching the request of the current thread."""
+        self._active.pop(threading.get_ident(), None)
+
+    def get_threshold(self, resource):
+        """Returns the threshold of the resource class in seconds, or None
+        if its requests are not watched.
+
+        :param resource: The resource class.
+        :type resource: :class:`wsgiservice.Resource`
+        """
+        threshold = getattr(resource, 'SLOW_REQUEST_THRESHOLD', None)
+        if threshold is False:
+            return None
+        if threshold is None:
+            return self.threshold
+        return threshold
+
+    def start(self):
+        """Starts the watchdog thread unless it's already running in this
+        process."""
+        self._thread.start()
+
+    def stop(self):
+        """Stops the watchdog thread. Keeps the reports."""
+        self._thread.stop()
+
+    def check(self):
+        """Reports the watched requests which exceeded their threshold and
+        were not reported yet. Called by the watchdog thread every
+        :attr:`interval` seconds."""
+        frames = sys._current_frames()
+        now = self.currtime()
+        for ident, entry in list(self._active.items()):
+            instance, started, threshold, reported = entry
+            if reported or now - started < threshold:
+                continue
+            entry[3] = True
+            frame = frames.get(ident)
+            stack = []
+            if frame is not None:
+                stack = ['{0}:{1} in {2}'.format(filename, lineno, name)
+                         for filename, lineno, name, line
+                         in traceback.extract_stack(frame)]
+            report = self.get_report(instance, now, now - started,
+                                     threshold, stack)
+            self._reports.append(report)
+            logger.warning("Slow request to %s: %s %s running for %.3f "
+                "seconds in phase %s, request ID %s. Stack:\n  %s",
+                report['resource'], report['method'], report['path'],
+                report['elapsed'], report['phase'], report['request_id'],
+                '\n  '.join(stack))
+
+    def get_report(self, instance, timestamp, elapsed, threshold, stack):
+        """Returns the dictionary describing a slow request. Override this
+        to change the fields.
+
+        :param instance: The resource instance handling the request.
+        :type instance: :class:`wsgiservice.Resource`
+        :param timestamp: Time at which the request was found to be slow.
+        :type timestamp: float
+        :param elapsed: Number of seconds the request has been running.
+        :type elapsed: float
+        :param threshold: The threshold of the resource in seconds.
+        :type threshold: float
+        :param stack: Frames of the handling thread as ``file:line in
+                      function`` strings, outermost first.
+        :type stack: list
+        """
+        request = instance.request
+        timing = instance.get_timing()
+        return {
+            'time': timestamp,
+            'resource': type(instance).__name__,
+            'method': request.method,
+            'path': request.path_info,
+            'query': request.query_string,
+            'remote_addr': request.remote_addr,
+            'request_id': request.headers.get(self.REQUEST_ID_HEADER),
+            'elapsed': elapsed,
+            'threshold': threshold,
+            'phase': timing.get_current_phase() if timing else None,
+            'stack': stack,
+        }
+
+    def get_reports(self):
+        """Returns the reports of the most recent slow requests, newest
+        first."""
+        reports = list(self._reports)
+        reports.reverse()
+        return reports
+
+    def clear(self):
+        """Discards all the reports."""
+        self._reports.clear()
+
+    def _on_check_error(self, e):
+        """Reports an exception of the watchdog thread."""
+        get_reporter().report(e, "Checking for slow requests failed: %s",
+                              log=logger)
+
+
+@mount('/_internal/slow')
+class SlowRequestsResource(Resource):
+    """Exposes the reports of the most recent slow requests found by the
+    :attr:`wsgiservice.application.Application.WATCHDOG`. Requires the
+    :attr:`wsgiservice.application.Application.INTERNAL_TOKEN`."""
+    XML_ROOT_TAG = 'slow'
+    NOT_FOUND = (KeyError,)
+    SLOW_REQUEST_THRESHOLD = False
+
+    def GET(self):
+        """Returns the reports of the most recent slow requests."""
+        self.assert_internal_token()
+        watchdog = self.get_watchdog()
+        if watchdog is None:
+            raise KeyError('watchdog')
+        return {'threshold': watchdog.threshold,
+                'reports': watchdog.get_reports()}
+
+    def get_watchdog(self):
+        """Returns the :class:`Watchdog` of the application or None."""
+        if self.application is None:
+            return None
+        return self.application.WATCHDOG